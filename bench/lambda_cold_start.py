@@ -0,0 +1,91 @@
+#!/usr/bin/python
+"""
+Measure the import time of the lambda handler and the cold vs warm invocation time.
+
+Run from the root of the project:
+python bench/lambda_cold_start.py [-n <repeats>]
+"""
+import getopt
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src")
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import aws_lambda
+elapsed = time.perf_counter() - start
+heavy = [name for name in ("feedparser", "boto3", "psycopg2") if name in sys.modules]
+print("%f %s" % (elapsed, ",".join(heavy)))
+"""
+
+INVOKE_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import aws_lambda
+event = {"DRYRUN": True, "FILES": [sys.argv[1]]}
+aws_lambda.lambda_handler(event, None)
+cold = time.perf_counter() - start
+warm = []
+for i in range(int(sys.argv[2])):
+    start = time.perf_counter()
+    aws_lambda.lambda_handler(event, None)
+    warm.append(time.perf_counter() - start)
+print("%f %s" % (cold, ",".join("%f" % w for w in warm)))
+"""
+
+
+def _run(script, *args, env=None):
+    output = subprocess.check_output([sys.executable, "-c", script] + list(args), cwd=SRC, env=env,
+                                     stderr=subprocess.DEVNULL)
+    # the handler logs to stdout - the result is the last line
+    return output.decode("utf-8").strip().splitlines()[-1].split(" ")
+
+
+def bench_import(repeats):
+    times = []
+    heavy = ""
+    for i in range(repeats):
+        output = _run(IMPORT_SCRIPT)
+        times.append(float(output[0]))
+        heavy = output[1] if len(output) > 1 else ""
+    print("import aws_lambda: median %.1f ms, min %.1f ms" % (statistics.median(times) * 1000, min(times) * 1000))
+    print("heavy modules loaded at import: %s" % (heavy if heavy else "none"))
+
+
+def bench_invoke(repeats):
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = os.path.join(tmp, "config")
+        # no feeds - the benchmark measures the handler overhead, not the network
+        open(config_file, "w").close()
+
+        env = dict(os.environ, APP_TWITTER_KEY="key", APP_TWITTER_SECRET="secret", USER_TWITTER_KEY="key",
+                   USER_TWITTER_SECRET="secret", STORE_FILE_NAME=os.path.join(tmp, "store"))
+        colds = []
+        warms = []
+        for i in range(repeats):
+            (cold, warm) = _run(INVOKE_SCRIPT, config_file, "10", env=env)
+            colds.append(float(cold))
+            warms.extend(float(w) for w in warm.split(","))
+
+    print("cold invocation (import + first call): median %.1f ms" % (statistics.median(colds) * 1000))
+    print("warm invocation: median %.2f ms" % (statistics.median(warms) * 1000))
+
+
+def main(params):
+    opts, args = getopt.getopt(params, "n:", ["repeats="])
+    repeats = 5
+    for option, var in opts:
+        if option in ("-n", "--repeats"):
+            repeats = int(var)
+
+    bench_import(repeats)
+    bench_invoke(repeats)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+"""
+Benchmark of the feed parser backends - feedparser and the fast C accelerated ElementTree one. Every backend parses
+the same corpus several times, the entries are reduced to the records the run keeps and compared with the ones of
+feedparser so a backend disagreeing with it is reported. The corpus is generated the same way the feed server of
+process_benchmark generates the feeds, or read from the directory of the feed documents.
+
+Run from the root of the project:
+python bench/parser_benchmark.py [--feeds 100] [--items 20] [--item-size 500] [--format rss|atom|mixed]
+    [--corpus <directory>] [--repeat 3] [--json]
+"""
+import getopt
+import json
+import os
+import sys
+import time
+
+BENCH = os.path.dirname(os.path.realpath(__file__))
+SRC = os.path.join(BENCH, "..", "src")
+
+
+def generated_corpus(feeds, items, item_size, feed_format):
+    from stand_ins import FeedServer
+
+    server = FeedServer(items, item_size, feed_format=feed_format)
+    try:
+        return [server.feed(number)[0] for number in range(feeds)]
+    finally:
+        # the server was never started - only its socket is closed
+        server._server.server_close()
+
+
+def directory_corpus(directory):
+    corpus = []
+    for file_name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file_name)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                corpus.append(f.read())
+    return corpus
+
+
+def backends():
+    from xml.etree.ElementTree import ParseError
+    from feedparser import parse
+    from feed_parser import fast_parse
+
+    def fast(data):
+        try:
+            return fast_parse(data), False
+        except ParseError:
+            return parse(data), True
+
+    return [("feedparser", lambda data: (parse(data), False)), ("fast", fast)]
+
+
+def run(corpus, repeat):
+    from feed_parser import to_record
+
+    expected = None
+    results = []
+    size = sum(len(data) for data in corpus)
+    for name, parse in backends():
+        best = None
+        for _ in range(repeat):
+            fallbacks = 0
+            records = []
+            start = time.perf_counter()
+            for data in corpus:
+                (feeds, fell_back) = parse(data)
+                fallbacks += fell_back
+                records.append([to_record(entry) for entry in feeds.get("entries", [])])
+            wall = time.perf_counter() - start
+            best = wall if best is None else min(best, wall)
+
+        expected = records if expected is None else expected
+        results.append({"parser": name, "feeds": len(corpus), "entries": sum(len(feed) for feed in records),
+                        "wall": best, "feeds_ps": len(corpus) / best if best else 0,
+                        "mb_ps": size / (1024.0 * 1024.0) / best if best else 0, "fallbacks": fallbacks,
+                        "mismatches": sum(1 for feed, other in zip(records, expected) if feed != other)})
+    return results
+
+
+def report(results):
+    print("%-10s %7s %8s %9s %9s %8s %9s %10s" % ("parser", "feeds", "entries", "wall s", "feeds/s", "MB/s",
+                                                "fallbacks", "mismatches"))
+    for result in results:
+        print("%-10s %7i %8i %9.3f %9.1f %8.1f %9i %10i" % (
+            result["parser"], result["feeds"], result["entries"], result["wall"], result["feeds_ps"], result["mb_ps"],
+            result["fallbacks"], result["mismatches"]))
+
+
+def main(params):
+    opts, args = getopt.getopt(params, "", ["feeds=", "items=", "item-size=", "format=", "corpus=", "repeat=",
+                                            "json"])
+    options = {"feeds": 100, "items": 20, "item_size": 500, "format": "rss", "corpus": None, "repeat": 3}
+    as_json = False
+    for option, var in opts:
+        if option == "--feeds":
+            options["feeds"] = int(var)
+        elif option == "--items":
+            options["items"] = int(var)
+        elif option == "--item-size":
+            options["item_size"] = int(var)
+        elif option == "--format":
+            options["format"] = var
+        elif option == "--corpus":
+            options["corpus"] = var
+        elif option == "--repeat":
+            options["repeat"] = max(1, int(var))
+        elif option == "--json":
+            as_json = True
+
+    sys.path.insert(0, SRC)
+    sys.path.insert(0, BENCH)
+    corpus = directory_corpus(options["corpus"]) if options["corpus"] else \
+        generated_corpus(options["feeds"], options["items"], options["item_size"], options["format"])
+    results = run(corpus, options["repeat"])
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+"""
+End to end benchmark of process_rss. The feeds are served by the local feed server, the tweets are posted to the fake
+twitter endpoint of the same server and the stores are backed by the local file, the S3 stand-in, the Postgres
+stand-in or the local SQLite database. Every scenario runs in its own process so the peak RSS is measured per
+scenario. Each scenario runs twice - the first run publishes everything, the second one is the steady state where the
+feeds did not change. The stages are the ones of the RunReport that process_rss reports in production, every scenario
+runs once per policy - the order policy fetches the feeds lazily and stops once the budget of the run is spent.
+
+Run from the root of the project:
+python bench/process_benchmark.py [-s 10,100,1000] [-t local,aws,db,sqlite] [--items 20] [--item-size 500] [--latency 0]
+    [--error-rate 0] [--format rss|atom|mixed] [--policies date,order] [--budget N] [--streaming] [--json]
+"""
+import getopt
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.realpath(__file__))
+SRC = os.path.join(BENCH, "..", "src")
+ROOT = os.path.join(BENCH, "..")
+
+# fetch and parse add up the time of the fetch threads so they can be more than the wall time
+STAGES = ("config", "store_read", "fetch", "parse", "stream", "cleanup_feeds", "prepare", "post", "write_store")
+ROUNDS = 2
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def write_config(file_name, base_url, sections, num_posts):
+    with open(file_name, "w") as f:
+        for number in range(sections):
+            f.write("[feed%i]\nurl=%s/feed/%i\nnumPosts=%i\n" % (number, base_url, number, num_posts))
+
+
+def run_scenario(options):
+    """
+    Child process - run the rounds of the scenario against the server started by the parent
+    """
+    sys.path.insert(0, SRC)
+    sys.path.insert(0, BENCH)
+    sys.path.insert(0, ROOT)
+    from unittest import mock
+
+    import process_rss
+    import twitter_post
+    from feed_config import Config
+    from metrics import RunReport
+    from stand_ins import FakePostgres, TWITTER_PATH
+    from test.fake_s3 import FakeS3
+
+    twitter_post.TWITTER_STATUS_POST_URL = options["url"] + TWITTER_PATH + "?"
+    s3 = FakeS3()
+    db = FakePostgres()
+
+    patches = [mock.patch("boto3.client", return_value=s3), mock.patch("psycopg2.connect", db.connect),
+               mock.patch("psycopg2.extras.execute_values", db.execute_values)]
+    for patch in patches:
+        patch.start()
+
+    rounds = []
+    for round_number in range(ROUNDS):
+        # the same stages as process_rss.process so the numbers match the production reports
+        report = RunReport()
+        start = time.perf_counter()
+        with report.stage("config"):
+            config = Config(options["config"])
+        with report.stage("store_read"):
+            store = process_rss.create_store(config, options["type"])
+        tp = twitter_post.TwitterPost(config.globalConfig("TWITTER"), outbox=store)
+        process_rss.process_services(config, store, tp, report=report)
+        wall = time.perf_counter() - start
+
+        stages = report.to_dict()["stages"]
+        rounds.append({"wall": wall, "counters": report.to_dict()["counters"],
+                       "stages": dict((stage, stages[stage]["seconds"] if stage in stages else 0.0)
+                                      for stage in STAGES)})
+
+    for patch in patches:
+        patch.stop()
+    return {"rounds": rounds, "peak_rss_mb": _peak_rss_mb()}
+
+
+def run(store_type, sections, policy, server, options, tmp):
+    config_file = os.path.join(tmp, "config-%i" % sections)
+    write_config(config_file, server.url, sections, options["num_posts"])
+    budget = options["budget"] or sections * options["num_posts"]
+    store_file = os.path.join(tmp, "store-%s-%s-%i" % (store_type, policy, sections))
+
+    env = dict(os.environ, APP_TWITTER_KEY="key", APP_TWITTER_SECRET="secret", USER_TWITTER_KEY="key",
+               USER_TWITTER_SECRET="secret", TWEETS_AT_ONE_TIME=str(budget), POLICY=policy,
+               STORE_FILE_NAME=store_file, SQLITE_FILE_NAME=store_file + ".db",
+               DATABASE_URL="postgres://bench", FETCH_STREAMING="true" if options["streaming"] else "false")
+    child = dict(options, type=store_type, config=config_file, url=server.url)
+
+    results = []
+    server.reset_counts()
+    output = subprocess.check_output([sys.executable, os.path.realpath(__file__), "--child", json.dumps(child)],
+                                     env=env, stderr=subprocess.DEVNULL)
+    scenario = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    counts = dict(server.counts)
+
+    for round_number, result in enumerate(scenario["rounds"]):
+        results.append({"store": store_type, "sections": sections, "policy": policy, "round": round_number + 1,
+                        "wall": result["wall"], "stages": result["stages"], "counters": result["counters"],
+                        "peak_rss_mb": scenario["peak_rss_mb"]})
+    total_wall = sum(result["wall"] for result in results)
+    requests = counts["feed"] + counts["not_modified"] + counts["error"]
+    for result in results:
+        result["requests"] = counts
+        result["feed_rps"] = requests / total_wall if total_wall else 0
+        result["tweets_ps"] = counts["tweet"] / total_wall if total_wall else 0
+    return results
+
+
+def report(results):
+    print("%-6s %8s %-6s %5s %9s %s %8s %9s %9s" % ("store", "sections", "policy", "round", "wall s",
+                                                     " ".join("%13s" % stage for stage in STAGES), "rss MB",
+                                                     "feed rps", "tweets/s"))
+    for result in results:
+        print("%-6s %8i %-6s %5i %9.3f %s %8.1f %9.1f %9.1f" % (
+            result["store"], result["sections"], result["policy"], result["round"], result["wall"],
+            " ".join("%13.3f" % result["stages"][stage] for stage in STAGES), result["peak_rss_mb"],
+            result["feed_rps"], result["tweets_ps"]))
+
+
+def main(params):
+    opts, args = getopt.getopt(params, "s:t:", ["sections=", "types=", "items=", "item-size=", "latency=",
+                                                "error-rate=", "format=", "num-posts=", "policies=", "budget=",
+                                                "streaming", "json", "child="])
+    sections = [10, 100, 1000]
+    types = ["local", "aws", "db", "sqlite"]
+    policies = ["date", "order"]
+    options = {"items": 20, "item_size": 500, "latency": 0.0, "error_rate": 0.0, "format": "rss", "num_posts": 5,
+               "budget": 0, "streaming": False}
+    as_json = False
+    for option, var in opts:
+        if option == "--child":
+            print(json.dumps(run_scenario(json.loads(var))))
+            return
+        elif option in ("-s", "--sections"):
+            sections = [int(value) for value in var.split(",")]
+        elif option in ("-t", "--types"):
+            types = var.split(",")
+        elif option == "--items":
+            options["items"] = int(var)
+        elif option == "--item-size":
+            options["item_size"] = int(var)
+        elif option == "--latency":
+            options["latency"] = float(var)
+        elif option == "--error-rate":
+            options["error_rate"] = float(var)
+        elif option == "--format":
+            options["format"] = var
+        elif option == "--num-posts":
+            options["num_posts"] = int(var)
+        elif option == "--policies":
+            policies = var.split(",")
+        elif option == "--budget":
+            options["budget"] = int(var)
+        elif option == "--streaming":
+            options["streaming"] = True
+        elif option == "--json":
+            as_json = True
+
+    sys.path.insert(0, BENCH)
+    from stand_ins import FeedServer
+
+    server = FeedServer(options["items"], options["item_size"], options["latency"], options["error_rate"],
+                        options["format"]).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for store_type in types:
+                for count in sections:
+                    for policy in policies:
+                        results.extend(run(store_type, count, policy, server, options, tmp))
+    finally:
+        server.stop()
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
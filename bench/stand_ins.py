@@ -0,0 +1,227 @@
+"""
+Local stand-ins for the services the application talks to - the feed hosts, the twitter api and Postgres. S3 is
+the stand-in of the tests, see test/fake_s3.py
+The feed server generates the synthetic feeds on the fly so any number of sections can be served
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+
+from collections import namedtuple
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TWITTER_PATH = "/1.1/statuses/update.json"
+
+RSS = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>feed %(feed)i</title><link>http://localhost/%(feed)i</link>
+%(items)s
+</channel></rss>"""
+
+RSS_ITEM = """<item><guid isPermaLink="false">feed%(feed)i-post%(post)i</guid>
+<title>Post %(post)i of feed %(feed)i</title><link>http://localhost/%(feed)i/%(post)i</link>
+<pubDate>%(date)s</pubDate><description>%(content)s</description></item>"""
+
+ATOM = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>feed %(feed)i</title><id>tag:localhost,2017:%(feed)i</id>
+%(items)s
+</feed>"""
+
+ATOM_ITEM = """<entry><id>tag:localhost,2017:feed%(feed)i-post%(post)i</id>
+<title>Post %(post)i of feed %(feed)i</title><link href="http://localhost/%(feed)i/%(post)i"/>
+<published>%(iso)s</published><summary>%(content)s</summary></entry>"""
+
+
+class FeedServer(object):
+    """
+    HTTP server serving /feed/<n> - the synthetic feed with the number of items of the given size - and the twitter
+    status update endpoint. Every feed has a fixed ETag so the conditional GETs of the second run get 304
+    """
+
+    def __init__(self, items=20, item_size=500, latency=0.0, error_rate=0.0, feed_format="rss", seed=1):
+        self.items = items
+        self.item_size = item_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.feed_format = feed_format
+        self.counts = {"feed": 0, "not_modified": 0, "error": 0, "tweet": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%i" % self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counts(self):
+        with self._lock:
+            for key in self.counts:
+                self.counts[key] = 0
+
+    def feed(self, number):
+        """
+        :return: tuple of the body and the ETag of the feed
+        """
+        if number not in self._cache:
+            atom = self.feed_format == "atom" or (self.feed_format == "mixed" and number % 2)
+            now = int(time.time())
+            items = []
+            for post in range(self.items, 0, -1):
+                # the feeds publish at different rates - newest post first
+                stamp = now - (self.items - post + 1) * (60 + number % 3600)
+                values = {"feed": number, "post": post, "content": "x" * self.item_size,
+                          "date": formatdate(stamp, usegmt=True),
+                          "iso": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(stamp))}
+                items.append((ATOM_ITEM if atom else RSS_ITEM) % values)
+            body = ((ATOM if atom else RSS) % {"feed": number, "items": "\n".join(items)}).encode("utf-8")
+            self._cache[number] = (body, '"%s"' % hashlib.md5(body).hexdigest())
+        return self._cache[number]
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def _failed(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately - without it every keep-alive response waits for delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                if not self.path.startswith("/feed/"):
+                    return self._reply(404, b"")
+                if server._failed():
+                    server._count("error")
+                    return self._reply(500, b"")
+
+                (body, etag) = server.feed(int(self.path.split("/")[-1]))
+                if self.headers.get("If-None-Match") == etag:
+                    server._count("not_modified")
+                    return self._reply(304, b"", {"ETag": etag})
+                server._count("feed")
+                self._reply(200, body, {"ETag": etag, "Content-Type": "application/rss+xml"})
+
+            def do_POST(self):
+                if not self.path.startswith(TWITTER_PATH):
+                    return self._reply(404, b"")
+                length = int(self.headers.get("Content-Length", 0))
+                if length:
+                    self.rfile.read(length)
+                server._count("tweet")
+                reset = int(time.time()) + 15 * 60
+                self._reply(200, json.dumps({"id": 1}).encode("utf-8"),
+                            {"Content-Type": "application/json", "x-rate-limit-limit": "1000000",
+                             "x-rate-limit-remaining": "1000000", "x-rate-limit-reset": str(reset)})
+
+            def _reply(self, status, body, headers=None):
+                self.send_response(status)
+                for name, value in (headers if headers else {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+        return Handler
+
+
+class FakePostgres(object):
+    """
+    Postgres stand-in for the store table - psycopg2.connect and psycopg2.extras.execute_values are replaced with
+    connect and execute_values of the instance
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.statements = 0
+        self._lock = threading.Lock()
+
+    def connect(self, *args, **kwargs):
+        return FakeConnection(self)
+
+    def execute_values(self, cursor, query, rows, page_size=100):
+        written = []
+        with self._lock:
+            self.statements += 1
+            for row in rows:
+                # (v_last_id, t_stamp, v_etag, v_modified, j_seen, j_outbox, v_hash, v_name)
+                record = (row[-1],) + tuple(row[:-1])
+                # the upsert leaves the equal rows alone
+                if self.rows.get(row[-1]) != record:
+                    self.rows[row[-1]] = record
+                    written.append((row[-1],))
+        # the names of the rows written are returned by the statement
+        cursor._rows = written
+
+
+class FakeConnection(object):
+    # psycopg2 pool checks the transaction status of the returned connection - 0 is TRANSACTION_STATUS_IDLE
+    info = namedtuple("ConnectionInfo", "transaction_status")(0)
+
+    def __init__(self, db):
+        self.db = db
+        self.closed = 0
+        self.autocommit = False
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor(object):
+    def __init__(self, db):
+        self.db = db
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, params=None):
+        with self.db._lock:
+            self.db.statements += 1
+            self._rows = list(self.db.rows.values()) if "from store" in query else [(1,)]
+
+    def fetchall(self):
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def close(self):
+        pass
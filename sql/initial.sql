@@ -1,6 +1,39 @@
-create table store(v_name varchar(128) not null primary key, v_last_id varchar(4000), t_stamp bigint);
+-- the script is run again on the existing stores to upgrade them - every statement can be repeated
+create table if not exists store(v_name varchar(128) not null primary key, v_last_id varchar(4000), t_stamp bigint,
+                                 v_etag varchar(1024), v_modified varchar(128), j_seen text, j_outbox text,
+                                 v_hash varchar(64));
 
-create table store_audit(v_name varchar(128) not null, v_last_id varchar(4000), t_stamp bigint, update_ts timestamp);
+-- upgrade of the stores created before the conditional GET support
+alter table store add column if not exists v_etag varchar(1024);
+alter table store add column if not exists v_modified varchar(128);
+-- upgrade of the stores created before the seen post index
+alter table store add column if not exists j_seen text;
+-- upgrade of the stores created before the outbox of the posts waiting to be confirmed
+alter table store add column if not exists j_outbox text;
+-- upgrade of the stores created before the hash of the feed body
+alter table store add column if not exists v_hash varchar(64);
+
+-- leases of the services claimed by the workers of the sharded processing, the lease of the crashed worker is taken
+-- over after t_expires
+create table if not exists store_lease(v_name varchar(128) not null primary key, v_owner varchar(256) not null,
+                                       t_expires timestamp with time zone not null);
+
+-- the audit table is partitioned by day so the retention of clean_db drops the whole partitions of the expired days.
+-- clean_db creates the partitions of the days to come - the rows of a day without the partition go to the default one
+create table if not exists store_audit(v_name varchar(128) not null, v_last_id varchar(4000), t_stamp bigint,
+                                       update_ts timestamp not null) partition by range (update_ts);
+
+-- the stores created before the partitioning keep the plain table, the default partition is created for the new ones
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'store_audit'::regclass) THEN
+    CREATE TABLE IF NOT EXISTS store_audit_default PARTITION OF store_audit DEFAULT;
+  END IF;
+END
+$$;
+
+-- the retention deletes the rows of the default partition and of the plain table in the batches found by the index
+create index if not exists store_audit_update_ts on store_audit(update_ts);
 
 CREATE OR REPLACE FUNCTION log_store()
   RETURNS trigger AS
@@ -13,7 +46,11 @@ END;
 $$
 LANGUAGE 'plpgsql';
 
+-- only the moves of the cursor are logged - the updates of the validators, the seen ids and the outbox are not. The
+-- trigger of the older stores logged every update, it is replaced
+DROP TRIGGER IF EXISTS store_log_trigger ON store;
 CREATE TRIGGER store_log_trigger
   AFTER UPDATE ON store
   FOR EACH ROW
+  WHEN (OLD.v_last_id IS DISTINCT FROM NEW.v_last_id OR OLD.t_stamp IS DISTINCT FROM NEW.t_stamp)
   EXECUTE PROCEDURE log_store();
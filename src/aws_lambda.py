@@ -1,21 +1,92 @@
 import logging
+import os
 import sys
 
-from process_rss import process
+from data_store import close_pools
+from feed_config import Config, ENV_VARIABLES
+from metrics import RunReport, emit
+from process_rss import claim_shard, create_store, process_services
+from twitter_post import TwitterPost
+
+log = logging.getLogger(__name__)
+
+# the config, store and twitter publisher outlive the invocation - the warm lambda reuses them until the config files
+# or the env variables change
+_context = {}
+
+
+def _context_key(dry_run, run_type, files):
+    mtimes = []
+    for file_name in files:
+        path = os.path.expanduser(file_name)
+        mtimes.append((file_name, os.path.getmtime(path) if os.path.exists(path) else None))
+    return dry_run, run_type, tuple(mtimes), tuple(os.environ.get(name) for name in ENV_VARIABLES)
+
+
+def get_context(dry_run, run_type, files, report=None):
+    """
+    :return: tuple of config, store and twitter publisher - cached ones if the lambda is warm
+    """
+    report = report if report else RunReport()
+    key = _context_key(dry_run, run_type, files)
+    if _context.get("key") == key:
+        log.debug("Reusing warm context")
+        # another instance of the lambda may have written the store in the meantime
+        with report.stage("store_refresh"):
+            _context["store"].refresh()
+        return _context["config"], _context["store"], _context["tp"]
+
+    if _context:
+        log.info("Config changed, dropping warm context")
+        close_pools()
+        _context.clear()
+
+    with report.stage("config"):
+        config = Config(*files)
+    with report.stage("store_read"):
+        store = create_store(config, run_type, dry_run)
+    tp = TwitterPost(config.globalConfig("TWITTER"), dry_run, outbox=store)
+    _context.update(key=key, config=config, store=store, tp=tp)
+    return config, store, tp
+
+
+def _setup_logging(log_level):
+    root = logging.getLogger()
+    root.setLevel(log_level)
+    if not any(getattr(handler, "rss_to_twitter", False) for handler in root.handlers):
+        logging.basicConfig(level=log_level)
+        h = logging.StreamHandler(sys.stdout)
+        h.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        h.rss_to_twitter = True
+        root.addHandler(h)
+
 
 def lambda_handler(event, context):
     dry_run = "DRYRUN" in event
-    is_aws = "IS_AWS" in event
+    run_type = event["TYPE"] if "TYPE" in event else "aws" if "IS_AWS" in event else "local"
     log_level = logging.DEBUG if "VERBOSE" in event else logging.INFO
     files = event["FILES"]
 
-    logging.basicConfig(level=log_level)
+    _setup_logging(log_level)
+    log.debug("In lambda handler -> %s %s %s" % (dry_run, run_type, files))
 
-    h = logging.StreamHandler(sys.stdout)
-    h.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
-    logging.getLogger().addHandler(h)
+    report = RunReport()
+    (config, store, tp) = get_context(dry_run, run_type, files, report)
 
-    log = logging.getLogger(__name__)
-    log.debug("In lambda handler -> %s %s %s" % (dry_run, is_aws, files))
+    (leases, services) = claim_shard(config, run_type, dry_run, report)
+    if leases and not services:
+        log.info("All the services are leased by the other workers")
+        emit(report, config.globalConfig("METRICS"))
+        return []
 
-    return process(dry_run, is_aws, *files)
+    try:
+        if leases:
+            # the store was read before the services were claimed - their previous owner may have written it since
+            with report.stage("store_refresh"):
+                store.refresh()
+        (data, feeds) = process_services(config, store, tp, services, report=report)
+    finally:
+        if leases:
+            leases.release()
+    emit(report, config.globalConfig("METRICS"))
+    return data
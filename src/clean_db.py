@@ -5,15 +5,17 @@ import dateutil.relativedelta
 
 from datetime import datetime
 from time import mktime
-from data_store import DBBasedDataStore
+from data_store import DBBasedDataStore, SQLiteBasedDataStore
 from feed_config import Config
 
 log = logging.getLogger(__name__)
 
-def process(dry_run=False, *data):
+def process(dry_run=False, run_type="db", *data):
     config = Config()
-    db = config.globalConfig("DB")
-    store = DBBasedDataStore(db, dry_run)
+    if run_type == "sqlite":
+        store = SQLiteBasedDataStore(config.globalConfig("SQLITE"), dry_run)
+    else:
+        store = DBBasedDataStore(config.globalConfig("DB"), dry_run)
     days = int(data[0])
 
     log.info("Audit log cleanup for %s " % days)
@@ -22,6 +24,7 @@ def process(dry_run=False, *data):
 def usage():
     print("""Usage: clean_db -d <days back>
              Where:
+             -t | --type [Optional] - can be db or sqlite - defaults to db
              -d | --dryrun: do not publish to twitter - just get data and update the store
              -v | --verbose: the verbose output
              -h | --help: help
@@ -31,15 +34,18 @@ def usage():
     
 def main(params):
     try:
-        opts, args = getopt.getopt(params, "dh:v", ["dryRun", "help", "verbose"])
+        opts, args = getopt.getopt(params, "t:dh:v", ["type", "dryRun", "help", "verbose"])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
 
     is_dry_run = False
     log_level = logging.INFO
+    run_type = "db"
     for option, var in opts:
-        if option in ("-h", "--help"):
+        if option in ("-t", "--type"):
+            run_type = var.strip()
+        elif option in ("-h", "--help"):
             usage()
             sys.exit()
         elif option in ("-d", "--dryrun"):
@@ -47,8 +53,12 @@ def main(params):
         elif option in ("-v", "--verbose"):
             log_level = logging.DEBUG
 
+    if run_type not in ["db", "sqlite"]:
+        usage()
+        sys.exit(2)
+
     logging.basicConfig(level=log_level)
-    process(is_dry_run, *args)
+    process(is_dry_run, run_type, *args)
     
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+"""
+Long running mode of the application. The state is kept in memory between the polls and every service is polled on
+its own schedule - the polling interval of the service is learned from the publish timestamps of its posts
+"""
+import heapq
+import logging
+import sys
+import time
+
+from collections import deque
+
+from data_store import close_pools
+from feed_config import Config
+from metrics import RunReport, emit
+from process_rss import create_store, process_services, parse_options
+from twitter_post import TwitterPost
+
+log = logging.getLogger(__name__)
+
+# number of the most recent publish timestamps the interval of the service is learned from
+HISTORY_SIZE = 10
+
+
+class PollState(object):
+    """
+    Polling state of one service
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.newest = None
+        self.history = deque(maxlen=HISTORY_SIZE)
+
+
+class PollScheduler(object):
+    """
+    Purpose of the class is to decide when each of the services is polled next. The interval of the service is the
+    median gap between its recent posts bounded by the floor and the ceiling of the service. Each poll that brings
+    nothing new - the feed was not modified, has no newer posts or could not be fetched - multiplies the interval by
+    the backoff factor so the quiet feeds are polled less and less often
+    """
+
+    def __init__(self, daemon_config, clock=time.time):
+        self._config = daemon_config
+        self._clock = clock
+        self._states = {}
+        self._queue = []
+
+    def add(self, conf_data):
+        """
+        Schedule the service to be polled right away
+        """
+        self._states[conf_data.serviceName] = PollState(self._floor(conf_data))
+        heapq.heappush(self._queue, (self._clock(), conf_data.serviceName))
+
+    def due(self):
+        """
+        :return: the list of services to poll now - each of them has to be passed to update after the poll
+        """
+        now = self._clock()
+        services = []
+        while self._queue and self._queue[0][0] <= now:
+            services.append(heapq.heappop(self._queue)[1])
+        return services
+
+    def next_due(self):
+        """
+        :return: the time the next service is due at, None if there is nothing scheduled
+        """
+        return self._queue[0][0] if self._queue else None
+
+    def interval(self, service):
+        return self._states[service].interval
+
+    def update(self, conf_data, feeds):
+        """
+        Learn the interval of the service from the result of the poll and schedule the next one
+        :param conf_data: service config
+        :param feeds: the fetched feed, empty if fetching failed
+        """
+        state = self._states[conf_data.serviceName]
+        stamps = sorted(post.timestamp for post in feeds.get('entries', []) if post.timestamp is not None)
+        new = [stamp for stamp in stamps if state.newest is None or stamp > state.newest]
+
+        if new:
+            state.history.extend(new)
+            state.newest = new[-1]
+            history = list(state.history)
+            gaps = sorted(later - earlier for earlier, later in zip(history, history[1:]) if later > earlier)
+            interval = gaps[len(gaps) // 2] if gaps else state.interval
+        else:
+            interval = state.interval * self._config.backoff
+
+        state.interval = min(max(interval, self._floor(conf_data)), self._ceiling(conf_data))
+        log.debug("Next poll of %s in %is" % (conf_data.serviceName, state.interval))
+        heapq.heappush(self._queue, (self._clock() + state.interval, conf_data.serviceName))
+
+    def postpone(self, conf_data):
+        """
+        Poll the service again after the shortest interval - it was due but its feed was not fetched
+        """
+        heapq.heappush(self._queue, (self._clock() + self._floor(conf_data), conf_data.serviceName))
+
+    def _floor(self, conf_data):
+        return conf_data.minInterval if conf_data.minInterval else self._config.minInterval
+
+    def _ceiling(self, conf_data):
+        return max(conf_data.maxInterval if conf_data.maxInterval else self._config.maxInterval,
+                   self._floor(conf_data))
+
+
+def run(config, store, tp, clock=time.time, sleep=time.sleep, max_cycles=None):
+    """
+    Poll the services when they are due until stopped
+    :param config: config
+    :param store: data store kept open for the whole run
+    :param tp: twitter publisher - posts held back by the rate limit are retried on the next cycle
+    :param max_cycles: stop after the number of polling cycles, run forever by default
+    """
+    scheduler = PollScheduler(config.globalConfig("DAEMON"), clock)
+    for service in config.services():
+        scheduler.add(config[service])
+    if scheduler.next_due() is None:
+        log.warning("No services to poll")
+        return scheduler
+
+    cycles = 0
+    while max_cycles is None or cycles < max_cycles:
+        services = scheduler.due()
+        if services or tp.pending():
+            log.info("Polling %s" % services)
+            feeds = None
+            report = RunReport()
+            try:
+                (data, feeds) = process_services(config, store, tp, services, report)
+            except Exception as e:
+                log.exception("Polling %s failed: %s" % (services, e))
+                report.incr("cycle_errors")
+            emit(report, config.globalConfig("METRICS"))
+
+            for service in services:
+                if feeds is not None and service not in feeds:
+                    # the budget of the cycle was used up before the feed was fetched
+                    scheduler.postpone(config[service])
+                else:
+                    scheduler.update(config[service], feeds.get(service, {}) if feeds else {})
+            cycles += 1
+
+        wait = scheduler.next_due() - clock()
+        # the held posts are retried as soon as the shortest interval allows
+        if tp.pending():
+            wait = min(wait, config.globalConfig("DAEMON").minInterval)
+        if wait > 0:
+            sleep(wait)
+    return scheduler
+
+
+def usage():
+    print("""Usage: rssDaemon -d <config files>
+             Where:
+             -t | --type [Optional] - can be local, db, sqlite or aws - defaults to local
+             -d | --dryrun: do not publish to twitter - just get data and update the store
+             -p | --parser [Optional] - can be feedparser or fast - overrides FETCH_PARSER
+             -v | --verbose: the verbose output
+             -h | --help: help
+
+             <config files> - the list of config files to use
+             """)
+
+
+def main(params):
+    (is_dry_run, run_type, log_level, parser, args) = parse_options(params, usage)
+    logging.basicConfig(level=log_level)
+
+    config = Config(*args, parser=parser)
+    log.info("Running daemon with %s, %s" % (run_type, is_dry_run))
+    try:
+        store = create_store(config, run_type, is_dry_run)
+        run(config, store, TwitterPost(config.globalConfig("TWITTER"), is_dry_run, outbox=store))
+    except KeyboardInterrupt:
+        log.info("Stopped")
+    finally:
+        close_pools()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
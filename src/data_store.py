@@ -1,22 +1,100 @@
+import hashlib
+import json
 import logging
 import os
+import socket
+import sqlite3
+import threading
+import time
 import util
+import uuid
 
-from collections import namedtuple
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 log = logging.getLogger(__name__)
 
-STORE = namedtuple("Store", "serviceName lastProcessedId lastProcessedUpdateTimestamp")
+# etag and modified are the http validators of the last feed response used for the conditional GET
+# seen is the tuple of the most recently posted ids of the service, oldest first
+# outbox is the tuple of OUTBOX posts of the service prepared but not confirmed by twitter yet
+# bodyHash is the hash of the last feed body handled in full - the same body is not parsed again
+STORE = namedtuple("Store",
+                   "serviceName lastProcessedId lastProcessedUpdateTimestamp etag modified seen outbox bodyHash",
+                   defaults=(None, None, (), (), None))
+# the post waiting in the outbox - attempts is the number of failed attempts, nextAttempt the time in seconds since
+# epoch the post can be sent again at
+OUTBOX = namedtuple("Outbox", "postId timestamp text attempts nextAttempt", defaults=(0, 0))
+
+
+class SeenIndex(object):
+    """
+    Bounded index of the recently posted ids of a service. The ids are kept in the ring buffer so the oldest id is
+    dropped once the index is full, the set mirrors the buffer for O(1) membership check
+    """
+
+    def __init__(self, ids=(), size=50):
+        self._ids = deque(maxlen=size)
+        self._members = set()
+        for post_id in ids:
+            self.add(post_id)
+
+    def add(self, post_id):
+        if post_id in self._members:
+            return
+        if len(self._ids) == self._ids.maxlen:
+            self._members.discard(self._ids[0])
+        self._ids.append(post_id)
+        self._members.add(post_id)
+
+    def ids(self):
+        """
+        :return: tuple of ids, oldest first - the form the ids are kept in STORE.seen
+        """
+        return tuple(self._ids)
+
+    def __contains__(self, post_id):
+        return post_id in self._members
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def _dump_ids(ids):
+    # '|' is the column separator of the file store, the escaped form is still valid json
+    return json.dumps(list(ids)).replace('|', '\\u007c') if ids else ''
+
+
+def _load_ids(text):
+    return tuple(json.loads(text)) if text else ()
+
+
+def _dump_outbox(outbox):
+    return _dump_ids([list(post) for post in outbox])
+
+
+def _load_outbox(text):
+    return tuple(OUTBOX(*post) for post in _load_ids(text))
+
+
+def _is_record(last_id, seen, outbox):
+    # the cursor of the feed without the dates has no timestamp, the service may have only the seen ids left once its
+    # outbox is emptied or only the posts in the outbox before the first one was confirmed
+    return bool(last_id or seen or outbox)
 
 
 class DataStore(object):
     def __init__(self, dry_run=False):
         self._dry_run = dry_run
         self._stores = {}
+        self._changed = set()
+        # number of the records the last write_store left as they were because they did not change
+        self.skipped = 0
 
     def __setitem__(self, section, store):
         """
         Given the section and a service information the method will update the data in store.
+        The section is marked as changed only if the record differs from the one in store.
         Will raise SystemError if None is passed as section or service
         :param section: section to search
         :return: values
@@ -26,7 +104,18 @@ class DataStore(object):
         if not store:
             raise SystemError("Store is empty for %s" % section)
 
-        self._stores[util.encode(section)] = store
+        section = util.encode(section)
+        if section in self._stores and self._stores[section] == store:
+            return
+
+        self._stores[section] = store
+        self._changed.add(section)
+
+    def changed(self):
+        """
+        :return: names of the sections changed since the store was read or written
+        """
+        return sorted(self._changed)
 
     def __getitem__(self, section):
         """
@@ -37,6 +126,59 @@ class DataStore(object):
         section = util.encode(section)
         return self._stores[section] if section in self._stores else None
 
+    def enqueue(self, key, text):
+        """
+        Put the post to the outbox of the service, the post already waiting there is left as it is
+        :param key: tuple of the service name, post id and the publish timestamp
+        :param text: text of the tweet
+        """
+        (service, post_id, timestamp) = key
+        record = self[service] if self[service] else STORE(util.encode(service), None, None)
+        if any(post.postId == post_id for post in record.outbox):
+            return
+        self[service] = record._replace(outbox=record.outbox + (OUTBOX(post_id, timestamp, text),))
+
+    def outbox(self, now=None, services=None):
+        """
+        :param now: only the posts that can be sent at the time are returned, all of them by default
+        :param services: limit the posts to the services, all the services by default
+        :return: list of tuples of the key as passed to enqueue and the OUTBOX post, oldest first
+        """
+        names = set(util.encode(service) for service in services) if services is not None else None
+        posts = [((name, post.postId, post.timestamp), post) for name, record in self._stores.items()
+                 if record and (names is None or name in names)
+                 for post in record.outbox if now is None or post.nextAttempt <= now]
+        # the posts without the publish date go after the dated ones
+        return sorted(posts, key=lambda item: (item[1].timestamp is None, item[1].timestamp or 0, item[0][0]))
+
+    def reschedule(self, key, attempts, next_attempt):
+        """
+        Keep the failed post in the outbox until the next attempt
+        """
+        record = self[key[0]]
+        if record:
+            self[key[0]] = record._replace(outbox=tuple(
+                post._replace(attempts=attempts, nextAttempt=next_attempt) if post.postId == key[1] else post
+                for post in record.outbox))
+
+    def remove(self, key):
+        """
+        Take the post out of the outbox once it was posted or given up on, the post is added to the seen ids so it is
+        not taken from the feed again
+        """
+        record = self[key[0]]
+        if record and any(post.postId == key[1] for post in record.outbox):
+            seen = record.seen if key[1] in record.seen else record.seen + (key[1],)
+            self[key[0]] = record._replace(outbox=tuple(post for post in record.outbox if post.postId != key[1]),
+                                           seen=seen)
+
+    def refresh(self):
+        """
+        Read the store again so the long living instance sees the records written by the other processes.
+        The changes that were not written are dropped
+        """
+        self._read_store()
+
     def __len__(self):
         """
         returns the number of configured services
@@ -60,6 +202,7 @@ class FileBasedDataStore(DataStore):
         :return dict of store objects indexed by service name
         """
         self._stores = {}
+        self._changed = set()
         f_path = os.path.expanduser(self._config.storeFileName)
         log.info("reading store %s" % f_path)
 
@@ -73,8 +216,14 @@ class FileBasedDataStore(DataStore):
 
                 time = int(data[2]) if data[2] else None
                 last_id = data[1] if data[1] else None
-                if time and last_id:
-                    record = STORE(section_name, data[1], time)
+                # validators were added later - older stores have 3 columns only
+                etag = data[3] if len(data) > 3 and data[3] else None
+                modified = data[4] if len(data) > 4 and data[4] else None
+                seen = _load_ids(data[5]) if len(data) > 5 else ()
+                outbox = _load_outbox(data[6]) if len(data) > 6 else ()
+                body_hash = data[7] if len(data) > 7 and data[7] else None
+                if _is_record(last_id, seen, outbox):
+                    record = STORE(section_name, last_id, time, etag, modified, seen, outbox, body_hash)
                     log.debug("processing store record %s" % (record,))
                     self._stores[section_name] = record
                 else:
@@ -84,25 +233,41 @@ class FileBasedDataStore(DataStore):
     def write_store(self, result_text=None):
         """
         After the services were updated with latest information the writeStore has to be called to persists the
-        data into the file. The file will be read on startup
+        data into the file. The file will be read on startup. The file is not touched when nothing changed
         :param result_text the list item that will be populated with text writen to file
         :return: number of items written
         """
         f_path = os.path.expanduser(self._config.storeFileName)
-        log.info("writing store %s" % f_path)
+        if not self._changed:
+            log.info("store %s has not changed" % f_path)
+            self.skipped = len(self._stores)
+            if result_text is not None:
+                result_text.append([])
+            return 0
+
+        log.info("writing store %s, changed %s" % (f_path, ",".join(self.changed())))
 
         def write(service_name, store):
             post_id = store.lastProcessedId if store.lastProcessedId else ''
             time = '%i' % store.lastProcessedUpdateTimestamp if store.lastProcessedUpdateTimestamp else ''
-            text = '%s|%s|%s\n' % (service_name, post_id, time)
-            return text
+            etag = store.etag if store.etag else ''
+            modified = store.modified if store.modified else ''
+            columns = [service_name, post_id, time, etag, modified, _dump_ids(store.seen), _dump_outbox(store.outbox),
+                       store.bodyHash if store.bodyHash else '']
+            # the trailing empty columns are left out so the stores without them stay readable by older versions
+            while len(columns) > 6 and not columns[-1]:
+                columns.pop()
+            return '|'.join(columns) + '\n'
 
         # write everything in store
         results = list(map(lambda sname: write(sname, self._stores[sname]), self._stores.keys()))
         if not self._dry_run:
             with open(f_path, 'w') as f:
                 f.writelines(results)
+            self._changed = set()
 
+        # the file is written whole
+        self.skipped = 0
         log.info("Saved %i records" % len(results))
         if result_text is not None:
             result_text.append(results)
@@ -110,30 +275,209 @@ class FileBasedDataStore(DataStore):
 
 
 class S3BasedDataStore(FileBasedDataStore):
+    """
+    File store synced with the object in S3. The local file is kept as a cache together with the ETag of the object
+    it was downloaded from. The object is downloaded only when its ETag changed and uploaded only when the content of
+    the file differs from the object
+    """
+
     def __init__(self, config, aws_config, dry_run=False):
         self._aws_config = aws_config
         self._aws_file_name = self._aws_config.awsFileName
+        self._etag_file_name = os.path.expanduser(config.storeFileName) + ".etag"
 
-        from boto3 import resource
+        from boto3 import client
 
-        self._connection = resource('s3') \
-            if not aws_config.awsAccessKey or not aws_config.awsAccessSecret \
-            else resource('s3', aws_access_key_id=aws_config.awsAccessKey,
-                          aws_secret_access_key=aws_config.awsAccessSecret)
+        kwargs = {}
+        if aws_config.awsAccessKey and aws_config.awsAccessSecret:
+            kwargs["aws_access_key_id"] = aws_config.awsAccessKey
+            kwargs["aws_secret_access_key"] = aws_config.awsAccessSecret
+        if aws_config.awsEndpointUrl:
+            kwargs["endpoint_url"] = aws_config.awsEndpointUrl
+        self._connection = client('s3', **kwargs)
         log.debug("s3 connection opened")
 
-        self._connection.Bucket(aws_config.awsBucket).download_file(self._aws_file_name, config.storeFileName)
-        log.debug("%s file copied from s3" % config.storeFileName)
+        self._etag = self._download(os.path.expanduser(config.storeFileName))
 
         FileBasedDataStore.__init__(self, config, dry_run=dry_run)
 
     def write_store(self, result_text=None):
-        super(S3BasedDataStore, self).write_store(result_text=result_text)
-        if not self._dry_run:
-            self._connection.Bucket(self._aws_config.awsBucket).upload_file(self._config.storeFileName,
-                                                                            self._aws_file_name)
+        written = super(S3BasedDataStore, self).write_store(result_text=result_text)
+        # nothing changed - the file in s3 is up to date
+        if written and not self._dry_run:
+            with open(os.path.expanduser(self._config.storeFileName), 'rb') as f:
+                data = f.read()
+
+            # the ETag of the object uploaded in one part is the md5 of its content
+            if self._etag == '"%s"' % hashlib.md5(data).hexdigest():
+                log.info("%s file in s3 is up to date" % self._aws_file_name)
+                return written
+
+            response = self._connection.put_object(Bucket=self._aws_config.awsBucket, Key=self._aws_file_name,
+                                                   Body=data)
+            self._etag = response["ETag"]
+            self._write_etag(self._etag)
+            log.debug("%s file copied to s3" % self._aws_file_name)
+        return written
+
+    def refresh(self):
+        self._etag = self._download(os.path.expanduser(self._config.storeFileName))
+        FileBasedDataStore.refresh(self)
+
+    def _download(self, file_name):
+        """
+        Download the object into the file unless the file is the copy of the current object already
+        :return: ETag of the object, None if the object does not exist
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            etag = self._connection.head_object(Bucket=self._aws_config.awsBucket, Key=self._aws_file_name)["ETag"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                raise
+            log.warning("%s file does not exist in s3, starting with empty store" % self._aws_file_name)
+            for path in (file_name, self._etag_file_name):
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
+
+        if os.path.exists(file_name) and etag == self._read_etag():
+            log.info("%s file in s3 has not changed, using the local copy" % self._aws_file_name)
+            return etag
+
+        self._connection.download_file(self._aws_config.awsBucket, self._aws_file_name, file_name)
+        self._write_etag(etag)
+        log.debug("%s file copied from s3" % file_name)
+        return etag
+
+    def _read_etag(self):
+        if not os.path.exists(self._etag_file_name):
+            return None
+        with open(self._etag_file_name, 'r') as f:
+            return f.read().strip()
+
+    def _write_etag(self, etag):
+        with open(self._etag_file_name, 'w') as f:
+            f.write(etag)
+
+
+class ConnectionPool(object):
+    """
+    Pool of the db connections shared by all the DBBasedDataStore operations. The pools live as long as the process
+    does so the warm lambda invocations reuse the connections opened by the previous ones. The connection is checked
+    before it is handed out and replaced if it was broken in the meantime
+    """
+
+    def __init__(self, config):
+        """
+        :param config: as described by namedtuple in feed_config.DB
+        """
+        from psycopg2.pool import ThreadedConnectionPool
+
+        start = time.time()
+        kwargs = {"sslmode": config.sslmode} if config.sslmode else {}
+        size = max(1, config.poolSize)
+        self._pool = ThreadedConnectionPool(1, size, config.url, **kwargs)
+        log.info("db pool of %i connections opened in %.1f ms" % (size, (time.time() - start) * 1000))
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow the connection from the pool, the connection is returned to the pool when the block is done
+        """
+        start = time.time()
+        conn = self._acquire()
+        log.info("db connection acquired in %.1f ms" % ((time.time() - start) * 1000))
+        try:
+            yield conn
+        finally:
+            self._pool.putconn(conn)
+
+    def close(self):
+        self._pool.closeall()
+
+    def _acquire(self):
+        conn = self._pool.getconn()
+        if not self._healthy(conn):
+            log.warning("db connection is broken, opening new one")
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        return conn
+
+    @staticmethod
+    def _healthy(conn):
+        import psycopg2
+
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as curs:
+                curs.execute("select 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(config):
+    """
+    Get the pool for the db config, the pool is created on first use
+    :param config: as described by namedtuple in feed_config.DB
+    :return: ConnectionPool
+    """
+    key = (config.url, config.sslmode)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(config)
+        return _pools[key]
+
+
+def close_pools():
+    """
+    Close all the connections of all the pools
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+UPSERT_STORE_QUERY = \
+    "insert into store (v_last_id, t_stamp, v_etag, v_modified, j_seen, j_outbox, v_hash, v_name) values %s " \
+    "on conflict (v_name) do update set v_last_id = excluded.v_last_id, t_stamp = excluded.t_stamp, " \
+    "v_etag = excluded.v_etag, v_modified = excluded.v_modified, j_seen = excluded.j_seen, " \
+    "j_outbox = excluded.j_outbox, v_hash = excluded.v_hash " \
+    "where (store.v_last_id, store.t_stamp, store.v_etag, store.v_modified, store.j_seen, store.j_outbox, " \
+    "store.v_hash) is distinct from (excluded.v_last_id, excluded.t_stamp, excluded.v_etag, excluded.v_modified, " \
+    "excluded.j_seen, excluded.j_outbox, excluded.v_hash) returning v_name"
+
+
+# store_audit is partitioned by day - see sql/initial.sql. The partitions are named by the day they hold
+AUDIT_PARTITION_PREFIX = "store_audit_p"
+AUDIT_DEFAULT_PARTITION = "store_audit_default"
+# number of the partitions of the days to come kept ready so the audit rows do not land in the default partition
+AUDIT_PARTITIONS_AHEAD = 7
+AUDIT_DELETE_BATCH = 5000
+
+AUDIT_PARTITIONED_QUERY = \
+    "select exists (select 1 from pg_partitioned_table where partrelid = 'store_audit'::regclass)"
+AUDIT_PARTITIONS_QUERY = \
+    "select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid " \
+    "where i.inhparent = 'store_audit'::regclass"
+CREATE_AUDIT_PARTITION_QUERY = \
+    "create table if not exists %s partition of store_audit for values from ('%s') to ('%s')"
+DROP_AUDIT_PARTITION_QUERY = "drop table if exists %s"
+# ctid of the batch is looked up by the update_ts index, the delete never scans the whole table
+DELETE_AUDIT_BATCH_QUERY = \
+    "delete from %s where ctid = any(array(select ctid from %s where update_ts < now() - interval '1 day' * %%s " \
+    "limit %%s))"
+
 
-            
 class DBBasedDataStore(DataStore):
     def __init__(self, config, dry_run=False):
         DataStore.__init__(self, dry_run)
@@ -146,85 +490,427 @@ class DBBasedDataStore(DataStore):
         :return dict of store objects indexed by service name
         """
         self._stores = {}
+        self._changed = set()
         log.info("reading db store")
-        conn = self._get_connection()
-        with conn.cursor() as curs:
-
-            curs.execute("select v_name, v_last_id, t_stamp from store")
-            data = curs.fetchone()
-            
-            while data is not None:
-                section_name = util.encode(data[0])
-                last_id = data[1]
-                time = data[2]
-                if last_id and time: 
-                    record = STORE(section_name, data[1], time)
-                    log.debug("processing store record %s" % (record,))
-                    self._stores[section_name] = record
-                else:
-                    log.error("Could not parse the record for %s" % data)
-                    self._stores[section_name] = None
-                    
-                data = curs.fetchone()
-                
-        conn.close()
+        with get_pool(self._config).connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute("select v_name, v_last_id, t_stamp, v_etag, v_modified, j_seen, j_outbox, v_hash "
+                             "from store")
+                rows = curs.fetchall()
+
+        for data in rows:
+            section_name = util.encode(data[0])
+            last_id = data[1]
+            # -1 is written for the service without the timestamp
+            time = data[2] if data[2] and data[2] > 0 else None
+            seen = _load_ids(data[5])
+            outbox = _load_outbox(data[6])
+            if _is_record(last_id, seen, outbox):
+                record = STORE(section_name, last_id, time, data[3], data[4], seen, outbox, data[7])
+                log.debug("processing store record %s" % (record,))
+                self._stores[section_name] = record
+            else:
+                log.error("Could not parse the record for %s" % (data,))
+                self._stores[section_name] = None
 
     def write_store(self, result_text=None):
         """
         After the services were updated with latest information the writeStore has to be called to persists the
-        data into the file. The file will be read on startup
+        data into the db. Only the records changed since the store was read are sent and the db leaves the rows
+        equal to the ones sent as they are - no update, no audit record
         :param result_text the list item that will be populated with text writen to db
         :return: number of items written
-        """        
+        """
         def collect(service_name, store):
             post_id = store.lastProcessedId if store.lastProcessedId else None
             time = int(store.lastProcessedUpdateTimestamp) if store.lastProcessedUpdateTimestamp else -1
-            return (post_id, time, service_name)
-
-        results = list(map(lambda sname: collect(sname, self._stores[sname]), self._stores.keys()))
-        print(results)
-        
-        log.info("writing db store")
-        
-        conn = self._get_connection()
-        with conn.cursor() as curs:
-            curs.execute("select v_name from store")
-            existing_names = list(map(lambda rec: rec[0], curs.fetchall()))
-            log.info("Existing: %s" % ",".join(existing_names))
-            
-            for record in results:
-                query = 'update store set v_last_id=%s, t_stamp=%s where v_name=%s' if record[2] in existing_names else \
-                    'insert into store (v_last_id, t_stamp, v_name) values (%s, %s, %s)'
-                log.info("Query %s, %s", query, record)
-                if not self._dry_run:
-                    curs.execute(query, record)
-            conn.commit()
-        conn.close()
-                
-        log.info("Saved %i records" % len(results))
+            return (post_id, time, store.etag, store.modified, _dump_ids(store.seen), _dump_outbox(store.outbox),
+                    store.bodyHash, service_name)
+
+        results = list(map(lambda sname: collect(sname, self._stores[sname]), self.changed()))
+
+        log.info("writing db store, %i of %i records changed" % (len(results), len(self._stores)))
+        log.debug("Records %s" % results)
+
+        written = len(results)
+        if results and not self._dry_run:
+            from psycopg2.extras import execute_values
+
+            with get_pool(self._config).connection() as conn:
+                with conn.cursor() as curs:
+                    # all the records are sent in one statement - one round trip no matter how many services there are
+                    # the rows inserted or updated are returned, the ones equal to the db are not - the single page
+                    # leaves them all on the cursor
+                    execute_values(curs, UPSERT_STORE_QUERY, results, page_size=len(results))
+                    written = len(curs.fetchall())
+                conn.commit()
+            self._changed = set()
+
+        self.skipped = max(0, len(self._stores) - written)
+        log.info("Saved %i records, %i unchanged" % (written, self.skipped))
         if result_text is not None:
             result_text.append(results)
-        return len(results)
+        return written
 
-    def clean_audit_log(self, days):
+    def clean_audit_log(self, days, batch_size=None):
         """
-        Function is purposely built for cleaning up the logs written to audit table
+        Function is purposely built for cleaning up the logs written to audit table. The partitions of the days older
+        than the retention are dropped whole and the partitions of the days to come are created. The rows of the
+        default partition - and of the whole table on the deployments created before the partitioning - are deleted
+        in the bounded batches, each in its own transaction, so the lock is short no matter how big the table is
         :param days How many days back to go to delete the records
+        :param batch_size max number of rows deleted at once
         :return None
         """
-        conn = self._get_connection()
-        with conn.cursor() as curs:
-            query = "delete from store_audit where update_ts < now() - interval '%s days'"
-            log.info("Delete audit records %s" % (query % days))
+        batch_size = batch_size if batch_size else AUDIT_DELETE_BATCH
+        with get_pool(self._config).connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute(AUDIT_PARTITIONED_QUERY)
+                partitioned = curs.fetchone()[0]
+                table = "store_audit"
+                if partitioned:
+                    # the days of the partitions follow the clock of the db the audit rows are stamped by
+                    curs.execute("select current_date")
+                    today = curs.fetchone()[0]
+                    curs.execute(AUDIT_PARTITIONS_QUERY)
+                    names = set(row[0] for row in curs.fetchall())
+                    self._rotate_partitions(conn, curs, today, names, days)
+                    table = AUDIT_DEFAULT_PARTITION if AUDIT_DEFAULT_PARTITION in names else None
+                conn.rollback()
+
+                deleted = 0
+                while table:
+                    query = DELETE_AUDIT_BATCH_QUERY % (table, table)
+                    log.info("Delete audit records %s" % (query % (days, batch_size)))
+                    if self._dry_run:
+                        break
+                    curs.execute(query, (days, batch_size))
+                    conn.commit()
+                    deleted += curs.rowcount
+                    if curs.rowcount < batch_size:
+                        break
+                log.info("Deleted %i audit records" % deleted)
+
+    def _rotate_partitions(self, conn, curs, today, names, days):
+        cutoff = today - timedelta(days=days)
+        statements = []
+        for name in sorted(names):
+            day = _partition_day(name)
+            # the partition holds one day - it is dropped once all of the day is past the retention
+            if day and day + timedelta(days=1) <= cutoff:
+                statements.append(DROP_AUDIT_PARTITION_QUERY % name)
+        # today is not created - the rows written before its partition existed went to the default partition
+        for ahead in range(1, AUDIT_PARTITIONS_AHEAD + 1):
+            day = today + timedelta(days=ahead)
+            name = "%s%s" % (AUDIT_PARTITION_PREFIX, day.strftime("%Y%m%d"))
+            if name not in names:
+                statements.append(CREATE_AUDIT_PARTITION_QUERY % (name, day, day + timedelta(days=1)))
+
+        for statement in statements:
+            log.info("Audit partitions: %s" % statement)
             if not self._dry_run:
-                curs.execute(query, (days,))
-                conn.commit()
-        conn.close()
-        
-    def _get_connection(self):
-        import psycopg2
-        if self._config.sslmode:
-            return psycopg2.connect(self._config.url, sslmode=self._config.sslmode)
+                curs.execute(statement)
+        if statements and not self._dry_run:
+            conn.commit()
+
+
+def _partition_day(name):
+    if not name.startswith(AUDIT_PARTITION_PREFIX):
+        return None
+    try:
+        return datetime.strptime(name[len(AUDIT_PARTITION_PREFIX):], "%Y%m%d").date()
+    except ValueError:
+        return None
+
+
+SQLITE_SCHEMA = (
+    "create table if not exists store(v_name text not null primary key, v_last_id text, t_stamp integer, "
+    "v_etag text, v_modified text, j_seen text, j_outbox text, v_hash text)",
+    "create table if not exists store_audit(v_name text not null, v_last_id text, t_stamp integer, "
+    "update_ts integer not null)",
+    "create index if not exists store_audit_update_ts on store_audit(update_ts)",
+    # the trigger of the older databases logged every update - it is replaced by the one logging the cursor moves
+    "drop trigger if exists store_log_trigger",
+    "create trigger store_log_trigger after update on store for each row "
+    "when old.v_last_id is not new.v_last_id or old.t_stamp is not new.t_stamp begin "
+    "insert into store_audit (v_name, v_last_id, t_stamp, update_ts) "
+    "values (old.v_name, old.v_last_id, old.t_stamp, cast(strftime('%s', 'now') as integer)); end")
+SELECT_SQLITE_QUERY = "select v_name, v_last_id, t_stamp, v_etag, v_modified, j_seen, j_outbox, v_hash from store"
+UPSERT_SQLITE_QUERY = \
+    "insert into store (v_last_id, t_stamp, v_etag, v_modified, j_seen, j_outbox, v_hash, v_name) " \
+    "values (?, ?, ?, ?, ?, ?, ?, ?) " \
+    "on conflict (v_name) do update set v_last_id = excluded.v_last_id, t_stamp = excluded.t_stamp, " \
+    "v_etag = excluded.v_etag, v_modified = excluded.v_modified, j_seen = excluded.j_seen, " \
+    "j_outbox = excluded.j_outbox, v_hash = excluded.v_hash " \
+    "where (store.v_last_id, store.t_stamp, store.v_etag, store.v_modified, store.j_seen, store.j_outbox, " \
+    "store.v_hash) is not (excluded.v_last_id, excluded.t_stamp, excluded.v_etag, excluded.v_modified, " \
+    "excluded.j_seen, excluded.j_outbox, excluded.v_hash)"
+CLEAN_SQLITE_AUDIT_QUERY = \
+    "delete from store_audit where update_ts < cast(strftime('%s', 'now') as integer) - ? * 86400"
+
+
+class SQLiteBasedDataStore(DataStore):
+    """
+    Store kept in the local SQLite database in the WAL mode so the readers such as clean_db and the writer do not
+    block each other. The records are read one by one by the service name when the run asks for them - the primary
+    key is the index - and only the changed records are upserted, the rest of the database is never touched
+    """
+
+    def __init__(self, config, dry_run=False):
+        """
+        :param config: as described by namedtuple in feed_config.SQLITE
+        """
+        DataStore.__init__(self, dry_run)
+        self._config = config
+        self._conn = None
+        self._missing = set()
+        self._complete = False
+        self._read_store()
+
+    def _connection(self):
+        if self._conn is None:
+            path = os.path.expanduser(self._config.fileName)
+            log.info("opening sqlite store %s" % path)
+            self._conn = sqlite3.connect(path, timeout=self._config.busyTimeout, check_same_thread=False)
+            self._conn.execute("pragma journal_mode=wal")
+            with self._conn:
+                for statement in SQLITE_SCHEMA:
+                    self._conn.execute(statement)
+        return self._conn
+
+    def _read_store(self):
+        """
+        Drop the records read so far, they are read again when asked for
+        """
+        self._stores = {}
+        self._changed = set()
+        self._missing = set()
+        self._complete = False
+
+    def _load(self, rows):
+        for data in rows:
+            section_name = util.encode(data[0])
+            # the records changed by the run are newer than the ones in the database
+            if section_name in self._changed:
+                continue
+            seen = _load_ids(data[5])
+            outbox = _load_outbox(data[6])
+            if _is_record(data[1], seen, outbox):
+                self._stores[section_name] = STORE(section_name, data[1], data[2], data[3], data[4], seen, outbox,
+                                                   data[7])
+            else:
+                log.error("Could not parse the record for %s" % (data,))
+                self._stores[section_name] = None
+
+    def _load_all(self):
+        if not self._complete:
+            self._load(self._connection().execute(SELECT_SQLITE_QUERY).fetchall())
+            self._missing = set()
+            self._complete = True
+
+    def __getitem__(self, section):
+        name = util.encode(section)
+        if not self._complete and name not in self._stores and name not in self._missing:
+            rows = self._connection().execute(SELECT_SQLITE_QUERY + " where v_name = ?", (name,)).fetchall()
+            self._load(rows)
+            if not rows:
+                self._missing.add(name)
+        return DataStore.__getitem__(self, section)
+
+    def __setitem__(self, section, store):
+        if section:
+            # the record is read first so the one that did not change is not written again
+            self[section]
+        DataStore.__setitem__(self, section, store)
+
+    def outbox(self, now=None, services=None):
+        if services is None:
+            self._load_all()
         else:
-            return psycopg2.connect(self._config.url)            
+            for service in services:
+                self[service]
+        return DataStore.outbox(self, now, services)
 
+    def __len__(self):
+        self._load_all()
+        return DataStore.__len__(self)
+
+    def __str__(self):
+        self._load_all()
+        return DataStore.__str__(self)
+
+    def write_store(self, result_text=None):
+        """
+        Upsert the records changed since the store was read in one transaction
+        :param result_text the list item that will be populated with the rows written
+        :return: number of items written
+        """
+        def collect(service_name, store):
+            return (store.lastProcessedId, store.lastProcessedUpdateTimestamp, store.etag, store.modified,
+                    _dump_ids(store.seen), _dump_outbox(store.outbox), store.bodyHash, service_name)
+
+        results = [collect(name, self._stores[name]) for name in self.changed()]
+        log.info("writing sqlite store, %i records changed" % len(results))
+
+        written = len(results)
+        if results and not self._dry_run:
+            conn = self._connection()
+            with conn:
+                # the rows equal to the ones sent are not updated and do not count
+                written = conn.executemany(UPSERT_SQLITE_QUERY, results).rowcount
+            self._changed = set()
+
+        # only the records read by the run are known, the rest were not touched at all
+        self.skipped = max(0, len(self._stores) - written)
+        log.info("Saved %i records, %i unchanged" % (written, self.skipped))
+        if result_text is not None:
+            result_text.append(results)
+        return written
+
+    def clean_audit_log(self, days):
+        """
+        Delete the audit records older than the number of days, the update_ts index keeps it to the rows deleted
+        """
+        log.info("Delete audit records older than %s days" % days)
+        if not self._dry_run:
+            conn = self._connection()
+            with conn:
+                conn.execute(CLEAN_SQLITE_AUDIT_QUERY, (days,))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+SELECT_LEASES_QUERY = "select v_name, t_expires < now(), t_expires from store_lease"
+CLAIM_LEASES_QUERY = \
+    "insert into store_lease (v_name, v_owner, t_expires) values %s " \
+    "on conflict (v_name) do update set v_owner = excluded.v_owner, t_expires = excluded.t_expires " \
+    "where store_lease.t_expires < now() or store_lease.v_owner = excluded.v_owner returning v_name"
+CLAIM_LEASES_TEMPLATE = "(%s, %s, now() + %s * interval '1 second')"
+EXTEND_LEASES_QUERY = \
+    "update store_lease set t_expires = now() + %s * interval '1 second' where v_owner = %s and v_name = any(%s)"
+RELEASE_LEASES_QUERY = "update store_lease set t_expires = now() where v_owner = %s and v_name = any(%s)"
+
+
+class ServiceLeases(object):
+    """
+    Purpose of the class is to split the services between the workers sharing the db store. The worker claims the
+    lease of the service before processing it - the services leased by the other workers are skipped. The lease is
+    extended by the heartbeat while the worker is busy and released when it is done, the lease of the crashed worker
+    expires and the service is claimed by the next worker. The released leases are kept so the services processed
+    the longest time ago are claimed first
+    """
+
+    def __init__(self, config, timeout, owner=None, dry_run=False):
+        """
+        :param config: as described by namedtuple in feed_config.DB
+        :param timeout: seconds the lease is valid for without the heartbeat
+        :param owner: name of the worker - unique one is generated if not passed
+        """
+        self._config = config
+        self._timeout = timeout
+        self._owner = owner if owner else "%s-%i-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._dry_run = dry_run
+        self._claimed = []
+        self._stop = None
+        self._thread = None
+
+    @property
+    def owner(self):
+        return self._owner
+
+    def claimed(self):
+        return list(self._claimed)
+
+    def claim(self, services, limit):
+        """
+        Claim the leases of at most limit services that are not leased by the other workers
+        :param services: candidate services
+        :param limit: max number of services to claim
+        :return: the list of services claimed in the order of the candidates
+        """
+        with get_pool(self._config).connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute(SELECT_LEASES_QUERY)
+                leases = dict((row[0], (row[1], row[2])) for row in curs.fetchall())
+
+            # never leased services first, then the ones released the longest time ago
+            names = [util.encode(service) for service in services]
+            free = [name for name in names if name not in leases]
+            free.extend(sorted([name for name in names if name in leases and leases[name][0]],
+                               key=lambda name: leases[name][1]))
+            candidates = free[:limit]
+
+            if not candidates or self._dry_run:
+                claimed = set(candidates)
+            else:
+                from psycopg2.extras import execute_values
+
+                with conn.cursor() as curs:
+                    # one page - the names of all the leases claimed are left on the cursor
+                    execute_values(curs, CLAIM_LEASES_QUERY,
+                                   [(name, self._owner, self._timeout) for name in candidates],
+                                   template=CLAIM_LEASES_TEMPLATE, page_size=len(candidates))
+                    rows = curs.fetchall()
+                conn.commit()
+                claimed = set(row[0] for row in rows)
+
+        self._claimed = [name for name in candidates if name in claimed]
+        log.info("%s claimed %i of %i services (%i leased by other workers)" %
+                 (self._owner, len(self._claimed), len(names), len(names) - len(free)))
+        return self._claimed
+
+    def extend(self):
+        """
+        Extend the leases claimed
+        :return: number of leases still held
+        """
+        if not self._claimed or self._dry_run:
+            return len(self._claimed)
+
+        with get_pool(self._config).connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute(EXTEND_LEASES_QUERY, (self._timeout, self._owner, self._claimed))
+                held = curs.rowcount
+            conn.commit()
+
+        if held < len(self._claimed):
+            log.warning("%s lost %i leases" % (self._owner, len(self._claimed) - held))
+        return held
+
+    def start_heartbeat(self, interval=None):
+        """
+        Extend the leases in the background until released
+        :param interval: seconds between the extensions - third of the timeout by default
+        """
+        interval = interval if interval else self._timeout / 3.0
+        self._stop = threading.Event()
+
+        def beat(stop):
+            while not stop.wait(interval):
+                try:
+                    self.extend()
+                except Exception as e:
+                    log.error("Could not extend the leases -> %s" % e)
+
+        self._thread = threading.Thread(target=beat, args=(self._stop,), name="lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def release(self):
+        """
+        Stop the heartbeat and release the leases claimed
+        """
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+        if self._claimed and not self._dry_run:
+            with get_pool(self._config).connection() as conn:
+                with conn.cursor() as curs:
+                    curs.execute(RELEASE_LEASES_QUERY, (self._owner, self._claimed))
+                conn.commit()
+            log.info("%s released %i services" % (self._owner, len(self._claimed)))
+        self._claimed = []
@@ -7,44 +7,143 @@ from collections import namedtuple
 
 log = logging.getLogger(__name__)
 
-MAIN = namedtuple("Main", "numToProcessAtOneTime storeFileName")
-SERVICE = namedtuple("Service", "serviceName url numPosts")
-AWS_STORAGE = namedtuple("AWS", "awsAccessKey awsAccessSecret awsBucket awsFileName")
-TWITTER = namedtuple("TwitterApp", "appTwitterKey appTwitterSecret userTwitterKey userTwitterSecret")
-DB = namedtuple("DB", "url sslmode")
+DEFAULT_SEEN_INDEX_SIZE = 50
+DEFAULT_TWITTER_WORKERS = 4
+DEFAULT_TWEET_MAX_ATTEMPTS = 5
+DEFAULT_TWEET_RETRY_DELAY = 60
+
+# the policy tells how the budget of the run is shared between the services - see POLICY_* below
+MAIN = namedtuple("Main", "numToProcessAtOneTime storeFileName seenIndexSize policy",
+                  defaults=(DEFAULT_SEEN_INDEX_SIZE, "date"))
+# cursor tells how the already published posts are cut off - by the last processed id or by the publish timestamp
+# minInterval / maxInterval bound the polling interval of the service in the daemon mode
+SERVICE = namedtuple("Service", "serviceName url numPosts cursor minInterval maxInterval", defaults=("id", None, None))
+AWS_STORAGE = namedtuple("AWS", "awsAccessKey awsAccessSecret awsBucket awsFileName awsEndpointUrl", defaults=(None,))
+# the failed post is retried maxAttempts times, retryDelay seconds after the first failure doubling every next time
+TWITTER = namedtuple("TwitterApp",
+                     "appTwitterKey appTwitterSecret userTwitterKey userTwitterSecret numWorkers maxAttempts retryDelay",
+                     defaults=(DEFAULT_TWITTER_WORKERS, DEFAULT_TWEET_MAX_ATTEMPTS, DEFAULT_TWEET_RETRY_DELAY))
+DB = namedtuple("DB", "url sslmode poolSize", defaults=(2,))
+# busyTimeout is the number of seconds the writer waits for the lock held by the other process
+SQLITE = namedtuple("SQLite", "fileName busyTimeout", defaults=(30.0,))
+# parser is the backend the downloaded feeds are parsed with - see PARSER_* below
+FETCH = namedtuple("Fetch", "numWorkers perHostLimit timeout streaming maxBytes parser",
+                   defaults=(False, None, "feedparser"))
+DAEMON = namedtuple("Daemon", "minInterval maxInterval backoff")
+METRICS = namedtuple("Metrics", "reportFile prometheusFile statsdHost statsdPort prefix")
+# size is the max number of services the worker claims per run - 0 turns the sharding off
+SHARD = namedtuple("Shard", "size leaseTimeout owner")
 
 APP_TWITTER_KEY_ENV = "APP_TWITTER_KEY"
 APP_TWITTER_SECRET_ENV = "APP_TWITTER_SECRET"
 USER_TWITTER_KEY_ENV = "USER_TWITTER_KEY"
 USER_TWITTER_SECRET_ENV = "USER_TWITTER_SECRET"
+TWITTER_WORKERS_ENV = "TWITTER_WORKERS"
+TWEET_MAX_ATTEMPTS_ENV = "TWEET_MAX_ATTEMPTS"
+TWEET_RETRY_DELAY_ENV = "TWEET_RETRY_DELAY"
 
 AWS_KEY_ENV = "AWS_KEY"
 AWS_SECRET_ENV = "AWS_SECRET"
 AWS_S3_BUCKET_ENV = "AWS_S3_BUCKET"
 AWS_S3_STORE_FILE_NAME_ENV = "AWS_S3_STORE_FILE_NAME"
+AWS_S3_ENDPOINT_URL_ENV = "AWS_S3_ENDPOINT_URL"
 
 TWEETS_AT_ONE_TIME_ENV = "TWEETS_AT_ONE_TIME"
 STORE_FILE_NAME_ENV = "STORE_FILE_NAME"
+SEEN_INDEX_SIZE_ENV = "SEEN_INDEX_SIZE"
+POLICY_ENV = "POLICY"
 
 DATABASE_URL = "DATABASE_URL"
 SSL_MODE = "SSL_MODE"
+DB_POOL_SIZE_ENV = "DB_POOL_SIZE"
+
+SQLITE_FILE_NAME_ENV = "SQLITE_FILE_NAME"
+SQLITE_BUSY_TIMEOUT_ENV = "SQLITE_BUSY_TIMEOUT"
+
+FETCH_WORKERS_ENV = "FETCH_WORKERS"
+FETCH_PER_HOST_ENV = "FETCH_PER_HOST"
+FETCH_TIMEOUT_ENV = "FETCH_TIMEOUT"
+FETCH_STREAMING_ENV = "FETCH_STREAMING"
+FETCH_MAX_BYTES_ENV = "FETCH_MAX_BYTES"
+FETCH_PARSER_ENV = "FETCH_PARSER"
+
+DAEMON_MIN_INTERVAL_ENV = "DAEMON_MIN_INTERVAL"
+DAEMON_MAX_INTERVAL_ENV = "DAEMON_MAX_INTERVAL"
+DAEMON_BACKOFF_ENV = "DAEMON_BACKOFF"
+
+METRICS_REPORT_FILE_ENV = "METRICS_REPORT_FILE"
+METRICS_PROMETHEUS_FILE_ENV = "METRICS_PROMETHEUS_FILE"
+METRICS_PREFIX_ENV = "METRICS_PREFIX"
+STATSD_HOST_ENV = "STATSD_HOST"
+STATSD_PORT_ENV = "STATSD_PORT"
+
+SHARD_SIZE_ENV = "SHARD_SIZE"
+LEASE_TIMEOUT_ENV = "LEASE_TIMEOUT"
+WORKER_NAME_ENV = "WORKER_NAME"
+
+# all the env variables the config is built from
+ENV_VARIABLES = (APP_TWITTER_KEY_ENV, APP_TWITTER_SECRET_ENV, USER_TWITTER_KEY_ENV, USER_TWITTER_SECRET_ENV,
+                 TWITTER_WORKERS_ENV, TWEET_MAX_ATTEMPTS_ENV, TWEET_RETRY_DELAY_ENV, AWS_KEY_ENV, AWS_SECRET_ENV,
+                 AWS_S3_BUCKET_ENV, AWS_S3_STORE_FILE_NAME_ENV, AWS_S3_ENDPOINT_URL_ENV, TWEETS_AT_ONE_TIME_ENV,
+                 STORE_FILE_NAME_ENV, SEEN_INDEX_SIZE_ENV, POLICY_ENV, DATABASE_URL, SSL_MODE, DB_POOL_SIZE_ENV,
+                 SQLITE_FILE_NAME_ENV, SQLITE_BUSY_TIMEOUT_ENV, FETCH_WORKERS_ENV, FETCH_PER_HOST_ENV,
+                 FETCH_TIMEOUT_ENV, FETCH_STREAMING_ENV, FETCH_MAX_BYTES_ENV, FETCH_PARSER_ENV, DAEMON_MIN_INTERVAL_ENV,
+                 DAEMON_MAX_INTERVAL_ENV, DAEMON_BACKOFF_ENV, METRICS_REPORT_FILE_ENV, METRICS_PROMETHEUS_FILE_ENV,
+                 METRICS_PREFIX_ENV, STATSD_HOST_ENV, STATSD_PORT_ENV, SHARD_SIZE_ENV, LEASE_TIMEOUT_ENV,
+                 WORKER_NAME_ENV)
+
+CURSOR_ID = "id"
+CURSOR_TIMESTAMP = "timestamp"
+
+# date: the pending posts of all the services are merged by publish date, newest first
+# fair: round robin - every service gets its first post in before any service gets its second one, the feeds are
+# fetched only until the first round uses up the budget
+# order: the services are handled in the order of the config, the feeds are fetched only until the budget is used up
+POLICY_DATE = "date"
+POLICY_FAIR = "fair"
+POLICY_ORDER = "order"
+
+# feedparser: the universal parser, slow but copes with any broken markup
+# fast: the C accelerated ElementTree extracting only what the run needs, feedparser parses the malformed documents
+PARSER_FEEDPARSER = "feedparser"
+PARSER_FAST = "fast"
 
 DEFAULT_STORE_PATH = "~/.twStore"
 DEFAULT_S3_BUCKET = "rsstotwitter"
 DEFAULT_AWS_S3_STORE_FILE_NAME = ".twStore"
+DEFAULT_DB_POOL_SIZE = 2
+DEFAULT_SQLITE_PATH = "~/.twStore.db"
+DEFAULT_SQLITE_BUSY_TIMEOUT = 30.0
+DEFAULT_FETCH_WORKERS = 8
+DEFAULT_FETCH_PER_HOST = 2
+DEFAULT_FETCH_TIMEOUT = 30
+DEFAULT_FETCH_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_DAEMON_MIN_INTERVAL = 5 * 60
+DEFAULT_DAEMON_MAX_INTERVAL = 24 * 60 * 60
+DEFAULT_DAEMON_BACKOFF = 2.0
+DEFAULT_STATSD_PORT = 8125
+DEFAULT_METRICS_PREFIX = "rss_to_twitter"
+DEFAULT_LEASE_TIMEOUT = 5 * 60
 
 class Config(object):
     """
     Purpose of the class is to keep information about configurations
+    The parser passed on the command line overrides the FETCH_PARSER env
     """
 
-    def __init__(self, *files):
+    def __init__(self, *files, parser=None):
         self._services = {}
+        self._urls = {}
 
         self._main = MAIN(int(os.environ[TWEETS_AT_ONE_TIME_ENV]) if TWEETS_AT_ONE_TIME_ENV in os.environ else 15,
                           os.path.expanduser(
                               os.environ[
-                                  STORE_FILE_NAME_ENV] if STORE_FILE_NAME_ENV in os.environ else DEFAULT_STORE_PATH))
+                                  STORE_FILE_NAME_ENV] if STORE_FILE_NAME_ENV in os.environ else DEFAULT_STORE_PATH),
+                          int(os.environ[SEEN_INDEX_SIZE_ENV]) if SEEN_INDEX_SIZE_ENV in os.environ
+                          else DEFAULT_SEEN_INDEX_SIZE,
+                          os.environ[POLICY_ENV] if POLICY_ENV in os.environ else POLICY_DATE)
+        if self._main.policy not in (POLICY_DATE, POLICY_FAIR, POLICY_ORDER):
+            raise SystemError("Policy %s is not supported" % self._main.policy)
 
         aws_store_file_name = os.environ[AWS_S3_STORE_FILE_NAME_ENV] \
             if AWS_S3_STORE_FILE_NAME_ENV in os.environ \
@@ -53,18 +152,61 @@ class Config(object):
         self._aws = AWS_STORAGE(os.environ[AWS_KEY_ENV] if AWS_KEY_ENV in os.environ else None,
                                 os.environ[AWS_SECRET_ENV] if AWS_SECRET_ENV in os.environ else None,
                                 os.environ[AWS_S3_BUCKET_ENV] if AWS_S3_BUCKET_ENV in os.environ else DEFAULT_S3_BUCKET,
-                                aws_store_file_name
+                                aws_store_file_name,
+                                os.environ[AWS_S3_ENDPOINT_URL_ENV] if AWS_S3_ENDPOINT_URL_ENV in os.environ else None
                                 )
 
         self._twitterApp = TWITTER(os.environ[APP_TWITTER_KEY_ENV] if APP_TWITTER_KEY_ENV in os.environ else None,
                                    os.environ[APP_TWITTER_SECRET_ENV] if APP_TWITTER_SECRET_ENV in os.environ else None,
                                    os.environ[USER_TWITTER_KEY_ENV] if USER_TWITTER_KEY_ENV in os.environ else None,
                                    os.environ[
-                                       USER_TWITTER_SECRET_ENV] if USER_TWITTER_SECRET_ENV in os.environ else None)
+                                       USER_TWITTER_SECRET_ENV] if USER_TWITTER_SECRET_ENV in os.environ else None,
+                                   int(os.environ[TWITTER_WORKERS_ENV]) if TWITTER_WORKERS_ENV in os.environ
+                                   else DEFAULT_TWITTER_WORKERS,
+                                   int(os.environ[TWEET_MAX_ATTEMPTS_ENV]) if TWEET_MAX_ATTEMPTS_ENV in os.environ
+                                   else DEFAULT_TWEET_MAX_ATTEMPTS,
+                                   float(os.environ[TWEET_RETRY_DELAY_ENV]) if TWEET_RETRY_DELAY_ENV in os.environ
+                                   else DEFAULT_TWEET_RETRY_DELAY)
 
         self._db = DB(os.environ[DATABASE_URL] if DATABASE_URL in os.environ else None,
-                      "true" == os.environ[SSL_MODE] if SSL_MODE in os.environ else False)
-        
+                      "true" == os.environ[SSL_MODE] if SSL_MODE in os.environ else False,
+                      int(os.environ[DB_POOL_SIZE_ENV]) if DB_POOL_SIZE_ENV in os.environ else DEFAULT_DB_POOL_SIZE)
+
+        self._sqlite = SQLITE(
+            os.path.expanduser(os.environ[SQLITE_FILE_NAME_ENV] if SQLITE_FILE_NAME_ENV in os.environ
+                               else DEFAULT_SQLITE_PATH),
+            float(os.environ[SQLITE_BUSY_TIMEOUT_ENV]) if SQLITE_BUSY_TIMEOUT_ENV in os.environ
+            else DEFAULT_SQLITE_BUSY_TIMEOUT)
+
+        self._fetch = FETCH(
+            int(os.environ[FETCH_WORKERS_ENV]) if FETCH_WORKERS_ENV in os.environ else DEFAULT_FETCH_WORKERS,
+            int(os.environ[FETCH_PER_HOST_ENV]) if FETCH_PER_HOST_ENV in os.environ else DEFAULT_FETCH_PER_HOST,
+            float(os.environ[FETCH_TIMEOUT_ENV]) if FETCH_TIMEOUT_ENV in os.environ else DEFAULT_FETCH_TIMEOUT,
+            "true" == os.environ[FETCH_STREAMING_ENV] if FETCH_STREAMING_ENV in os.environ else False,
+            int(os.environ[FETCH_MAX_BYTES_ENV]) if FETCH_MAX_BYTES_ENV in os.environ else DEFAULT_FETCH_MAX_BYTES,
+            parser or (os.environ[FETCH_PARSER_ENV] if FETCH_PARSER_ENV in os.environ else PARSER_FEEDPARSER))
+        if self._fetch.parser not in (PARSER_FEEDPARSER, PARSER_FAST):
+            raise SystemError("Parser %s is not supported" % self._fetch.parser)
+
+        self._daemon = DAEMON(
+            float(os.environ[DAEMON_MIN_INTERVAL_ENV]) if DAEMON_MIN_INTERVAL_ENV in os.environ
+            else DEFAULT_DAEMON_MIN_INTERVAL,
+            float(os.environ[DAEMON_MAX_INTERVAL_ENV]) if DAEMON_MAX_INTERVAL_ENV in os.environ
+            else DEFAULT_DAEMON_MAX_INTERVAL,
+            float(os.environ[DAEMON_BACKOFF_ENV]) if DAEMON_BACKOFF_ENV in os.environ else DEFAULT_DAEMON_BACKOFF)
+
+        self._metrics = METRICS(
+            os.environ[METRICS_REPORT_FILE_ENV] if METRICS_REPORT_FILE_ENV in os.environ else None,
+            os.environ[METRICS_PROMETHEUS_FILE_ENV] if METRICS_PROMETHEUS_FILE_ENV in os.environ else None,
+            os.environ[STATSD_HOST_ENV] if STATSD_HOST_ENV in os.environ else None,
+            int(os.environ[STATSD_PORT_ENV]) if STATSD_PORT_ENV in os.environ else DEFAULT_STATSD_PORT,
+            os.environ[METRICS_PREFIX_ENV] if METRICS_PREFIX_ENV in os.environ else DEFAULT_METRICS_PREFIX)
+
+        self._shard = SHARD(
+            int(os.environ[SHARD_SIZE_ENV]) if SHARD_SIZE_ENV in os.environ else 0,
+            float(os.environ[LEASE_TIMEOUT_ENV]) if LEASE_TIMEOUT_ENV in os.environ else DEFAULT_LEASE_TIMEOUT,
+            os.environ[WORKER_NAME_ENV] if WORKER_NAME_ENV in os.environ else None)
+
         config = configparser.ConfigParser()
         for configFile in files:
             log.info("reading config file %s" % configFile)
@@ -78,14 +220,26 @@ class Config(object):
             section_name = util.encode(section)
             log.info("configuring section %s" % section_name)
 
+            cursor = config.get(section, "cursor").strip() if config.has_option(section, "cursor") else CURSOR_ID
+            if cursor not in (CURSOR_ID, CURSOR_TIMESTAMP):
+                raise SystemError("Cursor %s of %s is not supported" % (cursor, section_name))
+
             service = SERVICE(
                 section_name,
                 config.get(section, 'url'),
-                config.getint(section, "numPosts") if config.has_option(section, "numPosts") else None
+                config.getint(section, "numPosts") if config.has_option(section, "numPosts") else None,
+                cursor,
+                config.getfloat(section, "minInterval") if config.has_option(section, "minInterval") else None,
+                config.getfloat(section, "maxInterval") if config.has_option(section, "maxInterval") else None
             )
             self._services[section_name] = service
             log.debug("Service %s" % (self._services[section_name],))
 
+        # the same feed may be configured in several sections - index them by url so the feed is fetched once
+        self._urls = {}
+        for section_name, service in self._services.items():
+            self._urls.setdefault(service.url, []).append(section_name)
+
     def __getitem__(self, section):
         """
         Given the section the method returns a map of values
@@ -101,21 +255,48 @@ class Config(object):
         """
         return list(self._services.keys())
 
+    def urls(self, services=None):
+        """
+        The index of the feed urls to the sections using them
+        :param services: limit the index to the sections, all the sections by default
+        :return: dict of url to the list of section names
+        """
+        if services is None:
+            return dict((url, list(sections)) for url, sections in self._urls.items())
+
+        wanted = set(util.encode(service) for service in services)
+        index = {}
+        for url, sections in self._urls.items():
+            sections = [section for section in sections if section in wanted]
+            if sections:
+                index[url] = sections
+        return index
+
     def globalConfig(self, type):
         """
         Get the config based on the type
-        type: MAIN, TWITTER, AWS
+        type: MAIN, TWITTER, AWS, DB, SQLITE, FETCH, DAEMON, METRICS, SHARD
         otherwise SystemError will be raised
         :return: config
         """
-        if type is "MAIN":
+        if type == "MAIN":
             return self._main
-        elif type is "TWITTER":
+        elif type == "TWITTER":
             return self._twitterApp
-        elif type is "AWS":
+        elif type == "AWS":
             return self._aws
-        elif type is "DB":
+        elif type == "DB":
             return self._db
+        elif type == "SQLITE":
+            return self._sqlite
+        elif type == "FETCH":
+            return self._fetch
+        elif type == "DAEMON":
+            return self._daemon
+        elif type == "METRICS":
+            return self._metrics
+        elif type == "SHARD":
+            return self._shard
         else:
             raise SystemError("Type %s is not supported" % type)
 
@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import threading
+
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+from xml.etree.ElementTree import ParseError
+from feed_config import PARSER_FAST
+from feed_parser import fast_parse, stream_parse, to_record, StreamParseError
+from metrics import RunReport
+
+log = logging.getLogger(__name__)
+
+# etag and modified are the validators returned by the previous response of the feed, used for the conditional GET
+# lastId and numPosts tell the streaming parser when it can stop reading the feed
+# bodyHash is the hash of the body handled by the previous run - the same body is not parsed again
+FEED_REQUEST = namedtuple("FeedRequest", "url etag modified lastId numPosts bodyHash",
+                          defaults=(None, None, None, None, None))
+
+HTTP_NOT_MODIFIED = 304
+
+USER_AGENT = "rssToTwitter (+https://github.com/soularis999/rssToTwitter)"
+
+
+class FeedFetcher(object):
+    """
+    The purpose of the class is to download and parse the feeds of all the services concurrently so one slow host
+    does not hold back the rest of the services. The number of connections opened to a single host is limited
+    """
+
+    def __init__(self, fetch_config, report=None):
+        """
+        :param fetch_config: as described by namedtuple in feed_config.FETCH
+        :param report: RunReport the fetch and parse stages and the downloaded bytes are recorded to
+        """
+        self._fetch_config = fetch_config
+        self._report = report if report else RunReport()
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+    def fetch_all(self, feed_requests):
+        """
+        Fetch and parse all the feeds overlapping the network I/O
+        :param feed_requests: list of FEED_REQUEST
+        :return: list of parsed feeds in the same order as the requests were passed in
+        """
+        if not feed_requests:
+            return []
+
+        workers = max(1, min(self._fetch_config.numWorkers, len(feed_requests)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda feed_request: self.fetch(*feed_request), feed_requests))
+
+    def fetch_iter(self, feed_requests):
+        """
+        Fetch and parse the feeds lazily - at most numWorkers feeds are downloaded ahead of the one consumed and the
+        feeds not reached when the iteration is closed are never requested
+        :param feed_requests: list of FEED_REQUEST
+        :return: generator of parsed feeds in the same order as the requests were passed in
+        """
+        if not feed_requests:
+            return
+
+        workers = max(1, min(self._fetch_config.numWorkers, len(feed_requests)))
+        requests = iter(feed_requests)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = deque(executor.submit(self.fetch, *feed_request) for _, feed_request in zip(range(workers),
+                                                                                                  requests))
+            try:
+                while futures:
+                    feeds = futures.popleft().result()
+                    feed_request = next(requests, None)
+                    if feed_request:
+                        futures.append(executor.submit(self.fetch, *feed_request))
+                    yield feeds
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def fetch(self, url, etag=None, modified=None, last_id=None, num_posts=None, body_hash=None):
+        """
+        Download and parse a single feed, the entries are returned as feed_parser.POST_RECORD. The network errors are
+        logged and reported as a feed without status.
+        If the validators are passed the request is conditional and the feed that was not modified since is reported
+        with 304 status and no entries. Many hosts never answer with 304 - the body with the same hash as the one of
+        the previous run is not parsed and the feed is reported as unchanged with no entries
+        :param url: feed url
+        :param etag: ETag of the previous response
+        :param modified: Last-Modified of the previous response
+        :param last_id: id of the last processed post - the streaming parser stops reading there
+        :param num_posts: max number of posts needed - the streaming parser stops reading after them
+        :param body_hash: hash of the body handled by the previous run
+        :return: parsed feed with the http status, validators and the body hash of the response
+        """
+        headers = {"User-Agent": USER_AGENT}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+
+        request = Request(url, headers=headers)
+        with self._host_limit(url):
+            try:
+                # the fetch stage is the connection and the reading of the body, the parse is timed on its own
+                with ExitStack() as fetch_stage:
+                    fetch_stage.enter_context(self._report.stage("fetch"))
+                    with urlopen(request, timeout=self._fetch_config.timeout) as response:
+                        status = response.status
+                        etag = response.headers.get("ETag")
+                        modified = response.headers.get("Last-Modified")
+                        response_headers = dict(response.headers)
+                        reader = _CountingReader(response)
+                        try:
+                            if self._fetch_config.streaming:
+                                # the document is parsed while it is downloaded - the reading and the parsing can
+                                # not be told apart so they are timed as the stream stage
+                                fetch_stage.close()
+                                with self._report.stage("stream"):
+                                    (feeds, body) = self._stream(url, reader, last_id, num_posts)
+                            else:
+                                (feeds, body) = (None, self._read(url, reader))
+                        finally:
+                            self._report.incr("bytes_downloaded", reader.bytes)
+            except HTTPError as e:
+                self._report.incr("feeds_not_modified" if e.code == HTTP_NOT_MODIFIED else "fetch_errors")
+                return {"status": e.code, "href": url, "entries": [], "etag": etag, "modified": modified}
+            except (URLError, OSError) as e:
+                log.error("Error fetching feeds %s -> %s" % (url, e))
+                self._report.incr("fetch_errors")
+                return {}
+
+        if feeds is None:
+            (feeds, body_hash) = self._parse(url, body, response_headers, body_hash)
+        else:
+            # the streamed document is not read in full so it has no hash
+            body_hash = None
+
+        self._report.incr("feeds_fetched")
+        if feeds is None:
+            self._report.incr("parses_avoided")
+            return {"status": status, "href": url, "etag": etag, "modified": modified, "bytes": reader.bytes,
+                    "hash": body_hash, "unchanged": True, "bozo": 0, "entries": []}
+
+        # only the records of the entries are kept, the parsed feed is released right here in the worker
+        return {"status": status, "href": url, "etag": etag, "modified": modified, "bytes": reader.bytes,
+                "hash": body_hash, "bozo": feeds.get("bozo", 0),
+                "entries": [to_record(entry) for entry in feeds.get("entries", [])]}
+
+    def _stream(self, url, response, last_id, num_posts):
+        """
+        :return: tuple of the parsed feed and the body - the body is read only when the document can not be streamed
+        """
+        try:
+            return stream_parse(response, last_id, num_posts, self._fetch_config.maxBytes), None
+        except StreamParseError as e:
+            log.warning("Could not stream %s (%s), falling back to the full parse" % (url, e.error))
+            return None, self._read(url, response, e.data)
+
+    def _read(self, url, response, data=b""):
+        """
+        :return: body of the response up to the max bytes, data is the part of the body that was already read
+        """
+        max_bytes = self._fetch_config.maxBytes
+        body = data + (response.read(max_bytes - len(data)) if max_bytes else response.read())
+        log.debug("Fetched %s -> %i bytes" % (url, len(body)))
+        if max_bytes and len(body) >= max_bytes:
+            log.warning("Feed %s is truncated after %i bytes" % (url, len(body)))
+        return body
+
+    def _parse(self, url, body, headers, known_hash):
+        """
+        :return: tuple of the parsed feed and the hash of the body - the feed is None when the body has the known hash
+        """
+        body_hash = hashlib.md5(body).hexdigest()
+        if known_hash and body_hash == known_hash:
+            log.debug("Feed %s has not changed since the previous run" % url)
+            return None, body_hash
+
+        if self._fetch_config.parser == PARSER_FAST:
+            try:
+                with self._report.stage("parse"):
+                    return fast_parse(body), body_hash
+            except ParseError as e:
+                log.warning("Could not parse %s with the fast parser (%s), falling back to feedparser" % (url, e))
+                self._report.incr("parser_fallbacks")
+
+        # feedparser is slow to import - the streaming and the fast runs load it only when the feed is malformed
+        from feedparser import parse
+
+        with self._report.stage("parse"):
+            return parse(body, response_headers=headers), body_hash
+
+    @contextmanager
+    def _host_limit(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(max(1, self._fetch_config.perHostLimit))
+            limit = self._host_limits[host]
+
+        with limit:
+            yield
+
+
+class _CountingReader(object):
+    """
+    Counts the bytes read from the response
+    """
+
+    def __init__(self, response):
+        self._response = response
+        self.headers = response.headers
+        self.bytes = 0
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self.bytes += len(data)
+        return data
@@ -0,0 +1,184 @@
+import calendar
+import logging
+import time
+
+from collections import namedtuple
+from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
+from xml.etree.ElementTree import XMLPullParser, ParseError, fromstring
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 16 * 1024
+
+# compact form of the feed entry the run keeps - the id the cursor is kept by, the title and the link the tweet is
+# made of and the publish date in seconds since epoch, None if the entry has no date. The record has no per instance
+# dict and does not hold the content, summaries and html of the entry
+POST_RECORD = namedtuple("PostRecord", "id title link timestamp")
+
+ENTRY_TAGS = ("item", "entry")
+RDF_ABOUT = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"
+DC_DATE = "{http://purl.org/dc/elements/1.1/}date"
+
+
+class StreamParseError(Exception):
+    """
+    Raised when the document can not be parsed incrementally. Carries the bytes consumed so far so the caller can
+    fall back to the full parser without downloading the feed again
+    """
+
+    def __init__(self, data, error):
+        Exception.__init__(self, str(error))
+        self.data = data
+        self.error = error
+
+
+def stream_parse(stream, stop_id=None, num_posts=None, max_bytes=None, chunk_size=CHUNK_SIZE):
+    """
+    Incrementally parse the RSS 2.0, RSS 1.0 or Atom document reading the stream chunk by chunk. Only the id, link,
+    title and published date of the entries are extracted - the entries are shaped the same way feedparser shapes them.
+    The reading stops as soon as the entry with stop_id or num_posts entries were read so the rest of the document
+    is never downloaded
+    :param stream: file like object to read the document from
+    :param stop_id: the id of the last processed post
+    :param num_posts: max number of entries to read
+    :param max_bytes: hard cap on the number of bytes read from the stream
+    :param chunk_size: number of bytes to read at once
+    :return: dict with the entries, bozo flag is set if the document was truncated
+    """
+    parser = XMLPullParser(events=("start", "end"))
+    consumed = []
+    read_bytes = 0
+    entries = []
+    parents = []
+
+    try:
+        while True:
+            size = chunk_size if not max_bytes else min(chunk_size, max_bytes - read_bytes)
+            chunk = stream.read(size) if size > 0 else b''
+            if not chunk:
+                if max_bytes and read_bytes >= max_bytes:
+                    log.warning("Feed is truncated after %i bytes" % read_bytes)
+                    return {"entries": entries, "bozo": 1, "bozo_exception": "truncated after %i bytes" % read_bytes}
+                parser.close()
+                return {"entries": entries, "bozo": 0}
+
+            consumed.append(chunk)
+            read_bytes += len(chunk)
+            parser.feed(chunk)
+
+            for event, elem in parser.read_events():
+                if event == "start":
+                    parents.append(elem)
+                    continue
+
+                parents.pop()
+                if _local_name(elem.tag) not in ENTRY_TAGS:
+                    continue
+
+                entry = _entry(elem)
+                entries.append(entry)
+                # the entry is extracted, drop the element so memory does not grow with the size of the feed
+                elem.clear()
+                if parents:
+                    parents[-1].remove(elem)
+
+                if (stop_id and stop_id == _entry_id(entry)) or (num_posts and len(entries) >= num_posts):
+                    log.debug("Stopped reading the feed after %i bytes" % read_bytes)
+                    return {"entries": entries, "bozo": 0}
+    except ParseError as e:
+        raise StreamParseError(b''.join(consumed), e)
+
+
+def fast_parse(data):
+    """
+    Parse the whole RSS 2.0, RSS 1.0 or Atom document at once with the C accelerated ElementTree. The entries are
+    extracted the same way the streaming parser extracts them - shaped the way feedparser shapes them - but none of
+    the sanitizing, encoding detection and date normalization of feedparser is done
+    :param data: bytes of the document
+    :return: dict with the entries
+    :raise ParseError: the document is not well formed, the caller is expected to fall back to feedparser
+    """
+    root = fromstring(data)
+    # the items of RSS 1.0 are siblings of the channel, not its children - they are looked up by name at any depth
+    return {"entries": [_entry(elem) for elem in root.iter() if _local_name(elem.tag) in ENTRY_TAGS], "bozo": 0}
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else None
+
+
+def _text(elem):
+    text = ''.join(elem.itertext()).strip()
+    return text if text else None
+
+
+def to_record(entry):
+    """
+    Extract the POST_RECORD from the entry shaped the way feedparser shapes them - the entry without the published
+    date is dated by the date it was updated at
+    """
+    published = entry.get('published_parsed') or entry.get('updated_parsed')
+    return POST_RECORD(_entry_id(entry), entry.get('title') or None, entry.get('link') or None,
+                       calendar.timegm(published) if published else None)
+
+
+def _entry_id(entry):
+    return entry.get('id') or entry.get('link') or entry.get('title')
+
+
+def _entry(elem):
+    entry = {}
+    guid_is_link = False
+    if elem.get(RDF_ABOUT):
+        entry['id'] = elem.get(RDF_ABOUT)
+
+    for child in elem:
+        name = _local_name(child.tag)
+        if name in ("guid", "id"):
+            entry['id'] = _text(child)
+            guid_is_link = name == "guid" and child.get("isPermaLink", "true") == "true"
+        elif name == "title":
+            entry['title'] = _text(child)
+        elif name == "link":
+            if child.get("href") is not None:
+                # atom link - the alternate one is the link of the entry
+                if child.get("rel", "alternate") == "alternate" or 'link' not in entry:
+                    entry['link'] = child.get("href")
+            else:
+                entry['link'] = _text(child)
+        elif name in ("pubDate", "published"):
+            published = _parse_date(_text(child))
+            if published:
+                entry['published_parsed'] = published
+        elif name == "updated" or child.tag == DC_DATE:
+            # feedparser keeps the atom updated and the dublin core date of RSS 1.0 as the updated date
+            updated = _parse_date(_text(child))
+            if updated:
+                entry['updated_parsed'] = updated
+
+    if 'link' not in entry and guid_is_link and entry.get('id'):
+        entry['link'] = entry['id']
+    return entry
+
+
+def _parse_date(value):
+    """
+    Parse RFC 822 (RSS) or ISO 8601 (Atom) date into the UTC struct_time
+    """
+    if not value:
+        return None
+
+    parsed = parsedate_tz(value)
+    if parsed:
+        return time.gmtime(mktime_tz(parsed))
+
+    try:
+        date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        log.debug("Could not parse date %s" % value)
+        return None
+
+    if date.tzinfo:
+        return date.utctimetuple()
+    return time.gmtime(calendar.timegm(date.timetuple()))
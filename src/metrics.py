@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+METRIC_PREFIX = "rss_to_twitter"
+STATSD_MAX_PACKET = 1400
+
+
+class RunReport(object):
+    """
+    Purpose of the class is to collect the durations and the counters of one run. Every stage keeps the number of
+    times it ran, the total and the longest duration. The stages running on several threads at once - fetching and
+    parsing of the feeds - are summed up so their total may be longer than the wall time of the run
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.services = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the block as the run of the stage
+        """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.record(name, self._clock() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"count": 0, "seconds": 0.0, "max": 0.0})
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            stage["max"] = max(stage["max"], seconds)
+
+    def incr(self, name, value=1, service=None):
+        """
+        Add to the counter of the run or of the service if passed
+        """
+        with self._lock:
+            counters = self.services.setdefault(service, {}) if service else self.counters
+            counters[name] = counters.get(name, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            return {"started": self._started,
+                    "stages": dict((name, dict(stage)) for name, stage in self.stages.items()),
+                    "counters": dict(self.counters),
+                    "services": dict((name, dict(counters)) for name, counters in self.services.items())}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self, prefix=METRIC_PREFIX):
+        """
+        :return: the report in the prometheus text exposition format
+        """
+        report = self.to_dict()
+        lines = []
+
+        def metric(name, help_text, samples):
+            if not samples:
+                return
+            lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+            lines.append("# TYPE %s_%s gauge" % (prefix, name))
+            for labels, value in samples:
+                label_text = ",".join('%s="%s"' % (key, _escape_label(value)) for key, value in labels)
+                lines.append("%s_%s%s %s" % (prefix, name, "{%s}" % label_text if label_text else "", _number(value)))
+
+        stages = sorted(report["stages"].items())
+        metric("stage_seconds", "Total time spent in the stage during the last run",
+               [((("stage", name),), stage["seconds"]) for name, stage in stages])
+        metric("stage_max_seconds", "Longest single run of the stage during the last run",
+               [((("stage", name),), stage["max"]) for name, stage in stages])
+        metric("stage_count", "Number of times the stage ran during the last run",
+               [((("stage", name),), stage["count"]) for name, stage in stages])
+        for name, value in sorted(report["counters"].items()):
+            metric(_metric_name(name), "Counter %s of the last run" % name, [((), value)])
+
+        service_counters = sorted(set(name for counters in report["services"].values() for name in counters))
+        for name in service_counters:
+            metric("service_%s" % _metric_name(name), "Counter %s of the service during the last run" % name,
+                   [((("service", service),), counters[name])
+                    for service, counters in sorted(report["services"].items()) if name in counters])
+        metric("last_run_timestamp_seconds", "Time the last run started at", [((), report["started"])])
+        return "\n".join(lines) + "\n"
+
+    def to_statsd(self, prefix=METRIC_PREFIX):
+        """
+        :return: the list of the statsd lines - the stage durations as timers in ms, the counters as counters
+        """
+        report = self.to_dict()
+        lines = []
+        for name, stage in sorted(report["stages"].items()):
+            lines.append("%s.stage.%s:%s|ms" % (prefix, _metric_name(name), _number(stage["seconds"] * 1000)))
+        for name, value in sorted(report["counters"].items()):
+            lines.append("%s.%s:%s|c" % (prefix, _metric_name(name), _number(value)))
+        for service, counters in sorted(report["services"].items()):
+            for name, value in sorted(counters.items()):
+                lines.append("%s.service.%s.%s:%s|c" % (prefix, _metric_name(service), _metric_name(name),
+                                                         _number(value)))
+        return lines
+
+    def summary(self):
+        report = self.to_dict()
+        return ", ".join("%s %.1f ms" % (name, stage["seconds"] * 1000)
+                         for name, stage in sorted(report["stages"].items()))
+
+
+def emit(report, metrics_config):
+    """
+    Write the report to the outputs configured
+    :param report: RunReport
+    :param metrics_config: as described by namedtuple in feed_config.METRICS
+    """
+    log.info("Run stages: %s" % report.summary())
+    log.info("Run counters: %s" % report.to_dict()["counters"])
+    if not metrics_config:
+        return
+
+    try:
+        if metrics_config.reportFile:
+            _write_atomically(metrics_config.reportFile, report.to_json())
+        if metrics_config.prometheusFile:
+            _write_atomically(metrics_config.prometheusFile, report.to_prometheus(metrics_config.prefix))
+        if metrics_config.statsdHost:
+            send_statsd(report.to_statsd(metrics_config.prefix), metrics_config.statsdHost, metrics_config.statsdPort)
+    except (OSError, socket.error) as e:
+        # metrics must never fail the run
+        log.error("Could not emit the run report -> %s" % e)
+
+
+def send_statsd(lines, host, port):
+    """
+    Send the lines over UDP packing as many of them into one datagram as fits
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        packet = []
+        size = 0
+        for line in lines:
+            if packet and size + len(line) + 1 > STATSD_MAX_PACKET:
+                sock.sendto("\n".join(packet).encode("utf-8"), (host, port))
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            sock.sendto("\n".join(packet).encode("utf-8"), (host, port))
+    finally:
+        sock.close()
+
+
+def _write_atomically(file_name, text):
+    # the collector must never see half written file
+    path = os.path.expanduser(file_name)
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", str(name)).lower()
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return ("%.6f" % value).rstrip("0").rstrip(".") if isinstance(value, float) else str(value)
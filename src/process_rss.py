@@ -3,155 +3,442 @@
 Purpose of the script is to poll the services for updates, compare the updates to the stored data and publish the
 updates to twitter
 """
+import bisect
+import heapq
+import itertools
 import logging
 import sys
 import getopt
+import util
 
-from data_store import FileBasedDataStore, S3BasedDataStore, DBBasedDataStore, STORE
-from feedparser import parse
+from data_store import FileBasedDataStore, S3BasedDataStore, DBBasedDataStore, SQLiteBasedDataStore, ServiceLeases, \
+    STORE, SeenIndex
+from feed_fetch import FeedFetcher, FEED_REQUEST, HTTP_NOT_MODIFIED
 from twitter_post import TwitterPost
-from feed_config import Config
-from datetime import datetime
+from feed_config import Config, CURSOR_ID, CURSOR_TIMESTAMP, POLICY_DATE, POLICY_FAIR, POLICY_ORDER
+from metrics import RunReport, emit
 
 log = logging.getLogger(__name__)
 
 
-def get_id_from_post(post):
-    """
-    Given the post the method returns the derived id of the post
-    :param post: post
-    :return: id
-    """
-    title = post['title'] if 'title' in post and post['title'] else None
-    url = post['link'] if 'link' in post and post['link'] else title
-    return post['id'] if 'id' in post and post['id'] else url
-
-
-def cleanup_feeds(store, num_posts, entries):
+def cleanup_feeds(store, num_posts, entries, cursor=CURSOR_ID):
     """
     Given the list of entries the method will return the trimmed list of posts that can be published
     The filtering comprises of limiting the posts to only those that were not published and limiting to max configured
     number of posts for the particular service. Assumption is that the posts are already sorted from most recent to most
-    furthest
+    furthest. The posts found in the seen index or in the outbox of the store are dropped as well so the post is not
+    published again when the last processed post was edited, reordered or dropped from the feed
+    With the timestamp cursor the posts are not assumed to be sorted - see _cleanup_by_timestamp
     :param conf_data:
-    :param entries:
+    :param entries: feed_parser.POST_RECORD list
+    :param cursor: CURSOR_ID or CURSOR_TIMESTAMP
     :return:
     """
     if not entries:
         return []
 
+    if cursor == CURSOR_TIMESTAMP:
+        return _cleanup_by_timestamp(store, num_posts, entries)
+
     first_post = min(len(entries), num_posts if num_posts else len(entries))
     if store:
         for index, post in enumerate(entries[:first_post]):
-            if store.lastProcessedId == get_id_from_post(post):
+            if store.lastProcessedId == post.id:
                 first_post = index
                 break
 
+    seen = _taken_ids(store)
+    if seen:
+        return reversed([post for post in entries[:first_post] if post.id not in seen])
     return reversed(entries[:first_post])
 
 
-def parse_published_date(post):
+def _cleanup_by_timestamp(store, num_posts, entries):
     """
-    Parse publisher and return datetime object
+    The published date is converted once per entry, the newest num_posts entries are selected with the heap and the
+    cursor is found by binary search past the stored timestamp. The entries published in the same second as the stored
+    one are kept unless they were already published. Entries without published date can not be placed on the time
+    line so they are filtered by id only and treated as the newest ones
     """
-    if 'published_parsed' in post:
-        return datetime(post['published_parsed'].tm_year, post['published_parsed'].tm_mon,
-                        post['published_parsed'].tm_mday, post['published_parsed'].tm_hour,
-                        post['published_parsed'].tm_min, post['published_parsed'].tm_sec)
-    else:
-        return datetime.now()
+    dated = []
+    undated = []
+    for index, post in enumerate(entries):
+        if post.timestamp is not None:
+            # -index keeps the feed order for the posts published at the same time
+            dated.append((post.timestamp, -index, post))
+        else:
+            undated.append(post)
+
+    limit = num_posts if num_posts else len(entries)
+    newest = sorted(heapq.nlargest(limit, dated, key=lambda item: item[:2]), key=lambda item: item[:2])
+
+    start = 0
+    if store and store.lastProcessedUpdateTimestamp:
+        start = bisect.bisect_left([item[0] for item in newest], store.lastProcessedUpdateTimestamp)
+
+    seen = _taken_ids(store)
+    last_id = store.lastProcessedId if store else None
+
+    def is_new(post):
+        return post.id != last_id and post.id not in seen
+
+    posts = [item[2] for item in newest[start:] if is_new(item[2])]
+    posts.extend(reversed([post for post in undated if is_new(post)]))
+    return posts[-limit:]
+
+
+def _taken_ids(store):
+    # ids of the posts of the service posted already or waiting in the outbox
+    if not store:
+        return set()
+    return set(store.seen).union(post.postId for post in store.outbox)
+
+
+def _timeline(timestamp):
+    """
+    Sort key of the publish timestamp - the posts without the date can not be placed on the time line so they go after
+    the dated ones and keep their feed order, see _cleanup_by_timestamp
+    """
+    return (timestamp is None, timestamp or 0)
 
 
 def process_posts(conf_data, post, tp):
     """
     Process the post - generating the text for twitter and the id that contains
-    (service id, post id)
+    (service name, post id, publish date) - the date is None when the feed does not give one
     :param conf_data: config data
-    :param post: post
+    :param post: feed_parser.POST_RECORD
     :param tp: twitter publisher
     :return: true if prepare was successfull or False otherwise
     """
-    title = post['title'] if 'title' in post and post['title'] else None
-    url = post['link'] if 'link' in post and post['link'] else None
-    id = get_id_from_post(post)
-    date = (parse_published_date(post) - datetime.utcfromtimestamp(0)).total_seconds()
+    key = (conf_data.serviceName, post.id, post.timestamp)
+    return tp.prepare(key, post.title, post.link)
+
 
-    key = (conf_data, id, date)
-    return tp.prepare(key, title, url)
+def create_store(config, run_type="local", dry_run=False):
+    """
+    Create the store for the run type - local, aws, db or sqlite
+    """
+    if run_type == "aws":
+        return S3BasedDataStore(config.globalConfig("MAIN"), config.globalConfig("AWS"), dry_run)
+    elif run_type == "db":
+        return DBBasedDataStore(config.globalConfig("DB"), dry_run)
+    elif run_type == "sqlite":
+        return SQLiteBasedDataStore(config.globalConfig("SQLITE"), dry_run)
+    return FileBasedDataStore(config.globalConfig("MAIN"), dry_run)
 
 
-def process(dry_run=False, run_type="local", *files):
+def claim_shard(config, run_type="local", dry_run=False, report=None):
+    """
+    Claim the shard of the services when the sharded processing is configured
+    :return: tuple of the leases and the services claimed - (None, None) when the sharding is off and all the
+        services are processed
+    """
+    shard = config.globalConfig("SHARD")
+    if not shard or not shard.size:
+        return None, None
+    if run_type != "db":
+        raise SystemError("Sharded processing requires the db store, %s given" % run_type)
+
+    report = report if report else RunReport()
+    leases = ServiceLeases(config.globalConfig("DB"), shard.leaseTimeout, shard.owner, dry_run)
+    with report.stage("claim"):
+        services = leases.claim(config.services(), shard.size)
+    report.incr("services_claimed", len(services))
+    if services:
+        leases.start_heartbeat()
+    return leases, services
+
+
+def process(dry_run=False, run_type="local", *files, parser=None):
     """
     Given the config files the method coordinates the retrieval of the data and publishing it to twitter
     :param dry_run: is this a test run - in this case data will be read but not published to twitter and store will not
         be updated
     :param files: config files
+    :param parser: feed parser backend chosen on the command line, None for the one of the config
     """
-    config = Config(*files)
-    mainConfig = config.globalConfig("MAIN")
-    twitter = config.globalConfig("TWITTER")
-    aws = config.globalConfig("AWS")
-    db = config.globalConfig("DB")
+    report = RunReport()
+    with report.stage("config"):
+        config = Config(*files, parser=parser)
 
     log.info("Running with %s, %s" % (run_type, dry_run))
 
-    print(run_type is "db")
-    store = None
-    if run_type == "aws":
-        store = S3BasedDataStore(mainConfig, aws, dry_run)
-    elif run_type == "db":
-        store = DBBasedDataStore(db, dry_run)
+    # the store is read after the services are claimed so the writes of their previous owner are seen
+    (leases, services) = claim_shard(config, run_type, dry_run, report)
+    if leases and not services:
+        log.info("All the services are leased by the other workers")
+        emit(report, config.globalConfig("METRICS"))
+        return []
+
+    try:
+        with report.stage("store_read"):
+            store = create_store(config, run_type, dry_run)
+        tp = TwitterPost(config.globalConfig("TWITTER"), dry_run, outbox=store)
+
+        (data, all_feeds) = process_services(config, store, tp, services, report=report)
+    finally:
+        if leases:
+            leases.release()
+    emit(report, config.globalConfig("METRICS"))
+    return data
+
+
+def process_services(config, store, tp, services=None, report=None):
+    """
+    Fetch the feeds of the services, publish the new posts and update the store
+    :param config: config
+    :param store: data store
+    :param tp: twitter publisher
+    :param services: services to process - all the configured services by default
+    :param report: RunReport the stages and counters of the run are recorded to
+    :return: tuple of the store result text and the dict of the fetched feeds by service
+    """
+    report = report if report else RunReport()
+    mainConfig = config.globalConfig("MAIN")
+    fetch = config.globalConfig("FETCH")
+
+    services = config.services() if services is None else services
+    conf_datas = [config[service] for service in services]
+    feed_requests = dict((util.encode(service), _feed_request(conf_data, store[service]))
+                         for service, conf_data in zip(services, conf_datas))
+
+    # the posts waiting in the outbox since the earlier runs go first
+    tp.restore(services)
+
+    # the rate limit window may not allow the whole batch
+    budget = mainConfig.numToProcessAtOneTime
+    available = tp.available()
+    if available is not None and available < budget:
+        log.info("Rate limit allows %i posts only" % available)
+        budget = available
+
+    # the sections sharing the url get the same feed - it is downloaded and parsed once
+    urls = config.urls(services)
+    ordered_urls = list(_unique(conf_data.url for conf_data in conf_datas))
+    requests = [_merge_requests([feed_requests[section] for section in urls[url]]) for url in ordered_urls]
+    if budget <= 0:
+        log.info("No posts can be published, the feeds are not fetched")
+        fetched = iter(())
+        report.incr("feeds_skipped", len(requests))
     else:
-        store = FileBasedDataStore(mainConfig, dry_run)
-        
-    tp = TwitterPost(twitter, dry_run)
-    
-    num_items = 0
-    for service in config.services():
-        conf_data = config[service]
-        store_record = store[service]
+        # the feeds are fetched only as far as the merge of the policy needs them to use up the budget
+        fetched = FeedFetcher(fetch, report).fetch_iter(requests)
+    feeds_by_url = {}
+    all_feeds = {}
+    remaining = {}
+    candidates_by_service = {}
+
+    def service_posts(index, service, conf_data):
+        """
+        The posts of the service that can be published, oldest first - newest first for the date policy
+        """
+        while conf_data.url not in feeds_by_url:
+            feeds_by_url[ordered_urls[len(feeds_by_url)]] = next(fetched)
+        feeds = all_feeds[service] = feeds_by_url[conf_data.url]
         log.info("Processing service %s -> %s" % (service, conf_data))
+        report.incr("bytes_downloaded", feeds.get('bytes', 0), service=conf_data.serviceName)
 
-        feeds = parse(conf_data.url)
+        if _not_modified(conf_data.url, feeds):
+            report.incr("not_modified", service=conf_data.serviceName)
+            return []
         if _not_valid(conf_data.url, feeds):
-            continue
-
-        for post in cleanup_feeds(store_record, conf_data.numPosts, feeds['entries']):
-            if num_items >= mainConfig.numToProcessAtOneTime:
-                break
-
-            if process_posts(conf_data, post, tp):
-                num_items += 1
+            report.incr("fetch_errors", service=conf_data.serviceName)
+            return []
+        if feeds.get('unchanged'):
+            # the host ignored the conditional GET but sent the body handled in full by the previous run
+            log.info("No news for %s, the body has not changed" % conf_data.url)
+            report.incr("unchanged", service=conf_data.serviceName)
+            return []
+
+        with report.stage("cleanup_feeds"):
+            posts = list(cleanup_feeds(store[service], conf_data.numPosts, feeds['entries'], conf_data.cursor))
+        if mainConfig.policy == POLICY_DATE:
+            posts.reverse()
+        remaining[service] = len(posts)
+        candidates = candidates_by_service[service] = [(_timeline(post.timestamp), index, rank, service, conf_data,
+                                                        post) for rank, post in enumerate(posts)]
+        return candidates
+
+    streams = (service_posts(index, service, conf_data)
+               for index, (service, conf_data) in enumerate(zip(services, conf_datas)))
+    if budget <= 0:
+        candidates = ()
+    elif mainConfig.policy == POLICY_ORDER:
+        candidates = itertools.chain.from_iterable(streams)
+    elif mainConfig.policy == POLICY_FAIR:
+        candidates = _round_robin(streams)
+    else:
+        # the newest posts of all the services go first - the merge needs the head of every stream so all the feeds
+        # are read. Only the heads of the streams are compared so every service keeps its own order
+        candidates = heapq.merge(*streams, key=lambda candidate: (candidate[0], -candidate[1]), reverse=True)
 
-        if num_items >= mainConfig.numToProcessAtOneTime:
+    num_items = 0
+    for (date, index, rank, service, conf_data, post) in candidates:
+        remaining[service] -= 1
+        with report.stage("prepare"):
+            prepared = process_posts(conf_data, post, tp)
+        if prepared:
+            num_items += 1
+        if num_items >= budget:
             break
+    if hasattr(fetched, "close"):
+        fetched.close()
+
+    # the validators and the body hash can be moved forward only when all the new posts of the feed were handled,
+    # otherwise the posts left behind would never be seen again behind the 304 response or the unchanged body
+    validators = dict((service, (all_feeds[service].get('etag'), all_feeds[service].get('modified'),
+                                 all_feeds[service].get('hash')))
+                      for service, count in remaining.items() if not count)
+    if len(all_feeds) < len(services):
+        log.info("Budget used up before %i services were fetched" % (len(services) - len(all_feeds)))
+        report.incr("services_not_reached", len(services) - len(all_feeds))
 
     log.info("Processed %i items " % num_items)
+    report.incr("posts_prepared", num_items)
 
     # get results dict indexed by (service id / post id) key
-    results = tp.post()
-
-    filtered_services = {}
-    for key in sorted(results.keys(), key=lambda key: key[2], reverse=True):
+    with report.stage("post"):
+        results = tp.post()
+
+    for (service_name, post_id, date), result in results.items():
+        report.incr("posts_posted" if result else "posts_failed")
+        report.incr("posted" if result else "failed", service=service_name)
+
+    # the posts held back by the rate limit are not published yet - the store must not move past them
+    held = {}
+    for (service_name, post_id, date) in tp.pending():
+        report.incr("posts_held")
+        report.incr("held", service=service_name)
+        held[service_name] = min(date, held[service_name], key=_timeline) if service_name in held else date
+        validators.pop(service_name, None)
+
+    # the posts not reached within the budget are taken by the next run - with the date policy they are older than
+    # the ones published so the cursor of the service stays where it was
+    for service, candidates in candidates_by_service.items():
+        for candidate in candidates[len(candidates) - remaining[service]:]:
+            (service_name, date) = (candidate[4].serviceName, candidate[5].timestamp)
+            held[service_name] = min(date, held[service_name], key=_timeline) if service_name in held else date
+
+    # the cursor moves only past the confirmed posts, the failed ones wait in the outbox for the retry. The retried
+    # post confirmed now is older than the cursor already - the cursor never moves back to it. The timestamp of the
+    # cursor moves only to the time given by the feed, the posts without the date are kept out by the seen index
+    cursors = {}
+    dated_cursors = {}
+    posted = {}
+    for key in sorted(results.keys(), key=lambda key: _timeline(key[2])):
         log.debug("Keys %s -> %s" % (key, results[key]))
-        (conf_data, post_id, date) = key[:3]
-        if conf_data not in filtered_services or filtered_services[conf_data][2] < date:
-            filtered_services[conf_data] = key
-
-    for conf_data in filtered_services:
-        item = filtered_services[conf_data]
-        store[conf_data.serviceName] = STORE(conf_data.serviceName, item[1], item[2])
+        (service_name, post_id, date) = key[:3]
+        if not results[key]:
+            continue
+        posted.setdefault(service_name, []).append(post_id)
+        if service_name not in held or _timeline(date) < _timeline(held[service_name]):
+            cursors[service_name] = key
+            if date is not None:
+                dated_cursors[service_name] = key
+
+    for service_name in posted:
+        store_record = store[service_name]
+        (etag, modified, body_hash) = validators[service_name] if service_name in validators else \
+            (store_record.etag, store_record.modified, store_record.bodyHash) if store_record else (None, None, None)
+        seen = _seen_ids(store_record, posted[service_name], mainConfig.seenIndexSize)
+        record = store_record if store_record else STORE(service_name, None, None)
+        key = dated_cursors.get(service_name)
+        if key and not (record.lastProcessedUpdateTimestamp and key[2] < record.lastProcessedUpdateTimestamp):
+            record = record._replace(lastProcessedId=key[1], lastProcessedUpdateTimestamp=key[2])
+        key = cursors.get(service_name)
+        if key and key[2] is None:
+            # the id cursor follows the feed order past the posts without the date, the time line stays where it was
+            record = record._replace(lastProcessedId=key[1])
+        store[service_name] = record._replace(etag=etag, modified=modified, seen=seen, bodyHash=body_hash)
+
+    # the services without new posts still need the latest validators for the next conditional GET
+    updated = set(posted)
+    for service in validators:
+        store_record = store[service]
+        if service not in updated and store_record:
+            (etag, modified, body_hash) = validators[service]
+            store[service] = store_record._replace(etag=etag, modified=modified, bodyHash=body_hash)
 
     # in the end - write the store
     data = []
-    store.write_store(data)
-    return data
+    with report.stage("write_store"):
+        written = store.write_store(data)
+    report.incr("records_written", written if written else 0)
+    report.incr("records_skipped", store.skipped)
+    return data, all_feeds
+
+
+def _seen_ids(store_record, post_ids, size):
+    index = SeenIndex(store_record.seen if store_record else (), size)
+    for post_id in post_ids:
+        index.add(post_id)
+    return index.ids()
+
+
+def _feed_request(conf_data, store_record):
+    if conf_data.cursor == CURSOR_TIMESTAMP:
+        # the feed is not assumed to be sorted so the streaming parser can not stop early
+        return FEED_REQUEST(conf_data.url, store_record.etag, store_record.modified,
+                            bodyHash=store_record.bodyHash) if store_record else FEED_REQUEST(conf_data.url)
+    if store_record:
+        return FEED_REQUEST(conf_data.url, store_record.etag, store_record.modified, store_record.lastProcessedId,
+                            conf_data.numPosts, store_record.bodyHash)
+    return FEED_REQUEST(conf_data.url, numPosts=conf_data.numPosts)
+
+
+def _merge_requests(feed_requests):
+    """
+    Merge the requests of the sections sharing the url into the one that suits all of them. The validators, the body
+    hash and the last id are kept only when all the sections agree on them, the number of posts is the largest one
+    """
+    def common(field):
+        values = set(getattr(feed_request, field) for feed_request in feed_requests)
+        return values.pop() if len(values) == 1 else None
+
+    num_posts = [feed_request.numPosts for feed_request in feed_requests]
+    return FEED_REQUEST(feed_requests[0].url, common("etag"), common("modified"), common("lastId"),
+                        None if None in num_posts else max(num_posts), common("bodyHash"))
+
+
+def _round_robin(streams):
+    """
+    Every service gets its first post in before any service gets its second one. The streams are taken one by one so
+    the feeds of the services not reached by the first round are not fetched
+    """
+    taken = []
+    for candidates in streams:
+        if candidates:
+            yield candidates[0]
+            taken.append(candidates)
+    for rank in itertools.count(1):
+        taken = [candidates for candidates in taken if len(candidates) > rank]
+        if not taken:
+            return
+        for candidates in taken:
+            yield candidates[rank]
+
+
+def _unique(values):
+    seen = set()
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            yield value
+
+
+def _not_modified(url, feeds):
+    if 'status' in feeds and feeds['status'] == HTTP_NOT_MODIFIED:
+        log.info("No news for %s" % url)
+        return True
+    return False
+
 
 def _not_valid(url, feeds):
     if 'status' not in feeds:
         log.error("Error getting feeds %s" % url)
         return True
-    elif feeds['status'] is not 200:
+    elif feeds['status'] != 200:
         log.error("Error getting feeds %s %s" % (url, feeds['status']))
         return True
     return False
@@ -159,8 +446,9 @@ def _not_valid(url, feeds):
 def usage():
     print("""Usage: processRss -d <config files>
              Where:
-             -t | --type [Optional] - can be local, db or aws - defaults to local
+             -t | --type [Optional] - can be local, db, sqlite or aws - defaults to local
              -d | --dryrun: do not publish to twitter - just get data and update the store
+             -p | --parser [Optional] - can be feedparser or fast - overrides FETCH_PARSER
              -v | --verbose: the verbose output
              -h | --help: help
              
@@ -168,9 +456,13 @@ def usage():
              """)
 
 
-def main(params):
+def parse_options(params, usage=usage):
+    """
+    Parse the command line
+    :return: tuple of dry run flag, run type, log level, feed parser backend and the config files
+    """
     try:
-        opts, args = getopt.getopt(params, "t:dh:v", ["type", "dryRun", "help", "verbose"])
+        opts, args = getopt.getopt(params, "t:dh:vp:", ["type", "dryRun", "help", "verbose", "parser="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -178,6 +470,7 @@ def main(params):
     is_dry_run = False
     log_level = logging.INFO
     run_type = "local"
+    parser = None
     for option, var in opts:
         if option in ("-t", "--type"):
             run_type = var.strip()
@@ -188,13 +481,19 @@ def main(params):
             is_dry_run = True
         elif option in ("-v", "--verbose"):
             log_level = logging.DEBUG
+        elif option in ("-p", "--parser"):
+            parser = var.strip()
 
-    if run_type not in ["local", "aws", "db"]:
+    if run_type not in ["local", "aws", "db", "sqlite"]:
         usage()
         sys.exit(2)
-        
+    return is_dry_run, run_type, log_level, parser, args
+
+
+def main(params):
+    (is_dry_run, run_type, log_level, parser, args) = parse_options(params)
     logging.basicConfig(level=log_level)
-    process(is_dry_run, run_type, *args)
+    process(is_dry_run, run_type, *args, parser=parser)
 
 
 if __name__ == "__main__":
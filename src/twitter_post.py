@@ -1,57 +1,269 @@
-import oauth2
+import queue
+import threading
+import time
 import urllib.parse
 import logging
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 TWITTER_STATUS_POST_URL = "https://api.twitter.com/1.1/statuses/update.json?"
+HTTP_TOO_MANY_REQUESTS = "429"
+# length of the rate limit window of the api, used when the 429 response does not say when the window resets
+RATE_LIMIT_WINDOW = 15 * 60
+
+# state of the rate limit window as reported by the api, None when not known yet
+RATE_LIMIT = namedtuple("RateLimit", "limit remaining reset")
 
 log = logging.getLogger(__name__)
 
+# oauth2 is slow to import - it is loaded with the first post so the dry runs and the cold starts do not pay for it
+oauth2 = None
+
+
+def _oauth2():
+    global oauth2
+    if oauth2 is None:
+        import oauth2
+    return oauth2
+
+
+class RateLimitBucket(object):
+    """
+    Token bucket driven by the x-rate-limit-* headers of the api responses. The bucket holds the requests that are
+    left in the current window and is refilled when the window resets. Until the first response is seen the budget
+    is not known and the requests are not limited
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._limit = None
+        self._remaining = None
+        self._reset = None
+
+    def acquire(self):
+        """
+        Take one request from the budget of the current window
+        :return: True if the request can be sent, False if it would be over budget
+        """
+        with self._lock:
+            self._refill()
+            if self._remaining is None:
+                return True
+            if self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            return True
+
+    def update(self, resp):
+        """
+        Update the budget from the response headers. The 429 response empties the bucket until the reset, without
+        the reset header the window ends after retry-after or the default window
+        :param resp: response headers
+        """
+        limit = _int_header(resp, "x-rate-limit-limit")
+        remaining = _int_header(resp, "x-rate-limit-remaining")
+        reset = _int_header(resp, "x-rate-limit-reset")
+        if HTTP_TOO_MANY_REQUESTS == resp.get("status"):
+            remaining = 0
+            if reset is None:
+                retry_after = _int_header(resp, "retry-after")
+                reset = int(self._clock()) + (RATE_LIMIT_WINDOW if retry_after is None else retry_after)
+
+        with self._lock:
+            if limit is not None:
+                self._limit = limit
+            if reset is not None and reset != self._reset:
+                # new window
+                self._reset = reset
+                self._remaining = remaining
+            elif remaining is not None:
+                # the responses of parallel requests come back out of order - the lowest count is the latest one
+                self._remaining = remaining if self._remaining is None else min(self._remaining, remaining)
+
+    def state(self):
+        """
+        :return: RATE_LIMIT of the current window
+        """
+        with self._lock:
+            self._refill()
+            return RATE_LIMIT(self._limit, self._remaining, self._reset)
+
+    def _refill(self):
+        if self._reset is not None and self._clock() >= self._reset:
+            self._remaining = self._limit
+            self._reset = None
+
+
+def _int_header(resp, name):
+    try:
+        return int(resp[name]) if name in resp else None
+    except ValueError:
+        return None
+
 
 class TwitterPost(object):
     """
     The purpose of the class is to authenticate into the twitter system and be able to post the tweets
     In theory you can post with different users but through same application
+    The posts are published by a small set of workers, each worker borrows the client from the pool. The clients are
+    kept between the posts and the calls to post so the keep-alive connections are reused
+    The posts over the rate limit budget are not sent - they are held back for the next call to post
+    With the outbox the prepared posts are kept in the store until twitter confirms them, the failed posts are retried
+    with the growing delay by the later calls to post - see restore
     """
 
-    def __init__(self, twitter_config, dry_run=False):
+    def __init__(self, twitter_config, dry_run=False, bucket=None, outbox=None, clock=time.time):
         """
         The constructor is taking two params, the application key and secret
         :param twitter_config: as described  by namedtuple in feedConfig.TWITTER
         :param dryRun: the flag can be set to just log the messages instead of publishing them to twitter
+        :param bucket: RateLimitBucket - a new one is created if not passed
+        :param outbox: data_store.DataStore the prepared posts are kept in until confirmed, not kept if not passed
         """
-        self._consumer = oauth2.Consumer(twitter_config.appTwitterKey, twitter_config.appTwitterSecret)
+        self._consumer = None
         self._twitter_config = twitter_config
-        self._params = {"status": None}
         self._dry_run = dry_run
         self._posts = []
+        self._token = None
+        self._clients = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._bucket = bucket if bucket else RateLimitBucket()
+        self._outbox = outbox
+        self._clock = clock
 
     def post(self):
         """
         method attempts to post all the currently stored items on Twitter using the authentication credentials provided
                 in constructor param - twitter_config.
-        :return Returns back a tuple of (id, and boolean if post was successful or not)
+        :return Returns back a tuple of (id, and boolean if post was successful or not). The posts held back because of
+                the rate limit are not part of the result, see pending
         """
-        # your application key and val
-        tok = oauth2.Token(self._twitter_config.userTwitterKey, self._twitter_config.userTwitterSecret)
-        client = oauth2.Client(self._consumer, tok)
+        posts = self._posts
+        self._posts = []
+
+        flags = []
+        if posts:
+            workers = max(1, min(self._twitter_config.numWorkers, len(posts)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                flags = list(executor.map(self._post, posts))
 
+        held = []
         results = {}
-        for post in self._posts:
-            self._params["status"] = post[1]
-            query = urllib.parse.urlencode(self._params)
+        for post, flag in zip(posts, flags):
+            if flag is None:
+                held.append(post)
+            else:
+                results[post[0]] = flag
+                self._settle(post, flag)
 
-            log.info("Posting: %s%s" % (TWITTER_STATUS_POST_URL, query))
-            result = True
-            if not self._dry_run:
-                (resp, content) = client.request(TWITTER_STATUS_POST_URL + query, method="POST")
-                if "200" != resp["status"]:
-                    log.error("Error posting url %s -> %s" % (query, content))
-                    result = False
+        if held:
+            log.warning("Holding back %i posts until the rate limit window resets at %s" %
+                        (len(held), self._bucket.state().reset))
+        self._posts = held + self._posts
+        return results
 
-            results[post[0]] = result
+    def restore(self, services=None):
+        """
+        Queue the posts of the outbox that are due to be sent again, the posts queued already are skipped
+        :param services: limit the posts to the services, all the services by default
+        :return: number of posts queued
+        """
+        if self._outbox is None:
+            return 0
 
-        self._posts = []
-        return results
+        pending = set(self.pending())
+        restored = [(key, post.text, post.attempts) for key, post in self._outbox.outbox(self._clock(), services)
+                    if key not in pending]
+        if restored:
+            log.info("Retrying %i posts from the outbox" % len(restored))
+        self._posts = restored + self._posts
+        return len(restored)
+
+    def pending(self):
+        """
+        :return: the ids of the posts that were prepared or held back but not posted yet
+        """
+        return [post[0] for post in self._posts]
+
+    def rate_limit(self):
+        """
+        :return: RATE_LIMIT state of the rate limit bucket
+        """
+        return self._bucket.state()
+
+    def available(self):
+        """
+        :return: number of posts that can still be sent in the current window excluding the ones pending, None if
+                the budget is not known
+        """
+        remaining = self._bucket.state().remaining
+        return None if remaining is None else max(0, remaining - len(self._posts))
+
+    def _settle(self, post, flag):
+        # the confirmed post leaves the outbox, the failed one waits there for the next attempt
+        if self._outbox is None:
+            return
+        (key, text, attempts) = post
+        if flag:
+            self._outbox.remove(key)
+            return
+
+        attempts += 1
+        if attempts >= self._twitter_config.maxAttempts:
+            log.error("Giving up on %s after %i attempts" % (key, attempts))
+            self._outbox.remove(key)
+        else:
+            delay = self._twitter_config.retryDelay * 2 ** (attempts - 1)
+            log.warning("Retrying %s in %is" % (key, delay))
+            self._outbox.reschedule(key, attempts, self._clock() + delay)
+
+    def _post(self, post):
+        # True / False when posted or failed, None when rate limited and the post should be held back
+        query = urllib.parse.urlencode({"status": post[1]})
+        log.info("Posting: %s%s" % (TWITTER_STATUS_POST_URL, query))
+        if self._dry_run:
+            return True
+
+        # the budget is taken right before sending so the responses of the earlier posts are already counted
+        if not self._bucket.acquire():
+            return None
+
+        client = self._acquire()
+        try:
+            (resp, content) = client.request(TWITTER_STATUS_POST_URL + query, method="POST")
+        except Exception as e:
+            log.error("Error posting url %s -> %s" % (query, e))
+            return False
+        finally:
+            self._clients.put(client)
+
+        self._bucket.update(resp)
+        if HTTP_TOO_MANY_REQUESTS == resp["status"]:
+            log.warning("Rate limited posting url %s" % query)
+            return None
+        if "200" != resp["status"]:
+            log.error("Error posting url %s -> %s" % (query, content))
+            return False
+        return True
+
+    def _acquire(self):
+        try:
+            return self._clients.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if not self._token:
+                # your application key and val
+                self._consumer = _oauth2().Consumer(self._twitter_config.appTwitterKey,
+                                                    self._twitter_config.appTwitterSecret)
+                self._token = _oauth2().Token(self._twitter_config.userTwitterKey,
+                                              self._twitter_config.userTwitterSecret)
+
+        log.debug("Opening new twitter client")
+        return _oauth2().Client(self._consumer, self._token)
 
     def _generatePost(self, data, url):
         text = data + ' ' + (url if url else '')
@@ -77,5 +289,11 @@ class TwitterPost(object):
         if not text:
             return False
 
-        self._posts.append((post_id, text))
+        # the post could be already held back by the rate limit
+        if post_id in self.pending():
+            return False
+
+        self._posts.append((post_id, text, 0))
+        if self._outbox is not None:
+            self._outbox.enqueue(post_id, text)
         return True
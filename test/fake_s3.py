@@ -0,0 +1,33 @@
+import hashlib
+
+from botocore.exceptions import ClientError
+
+
+class FakeS3(object):
+    """
+    Local stand-in for the s3 client keeping the objects in memory, the names of the calls made are kept in calls.
+    The end to end benchmark stores the data in it as well
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def _etag(self, data):
+        return '"%s"' % hashlib.md5(data).hexdigest()
+
+    def head_object(self, Bucket, Key):
+        self.calls.append("head_object")
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ETag": self._etag(self.objects[(Bucket, Key)])}
+
+    def download_file(self, Bucket, Key, Filename):
+        self.calls.append("download_file")
+        with open(Filename, 'wb') as f:
+            f.write(self.objects[(Bucket, Key)])
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append("put_object")
+        self.objects[(Bucket, Key)] = Body
+        return {"ETag": self._etag(Body)}
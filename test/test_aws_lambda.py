@@ -0,0 +1,62 @@
+import os
+import unittest
+import mock
+
+import aws_lambda
+
+TMP_CONFIG_FILE_PATH = "/tmp/twLambdaConfig"
+
+
+class TestLambda(unittest.TestCase):
+    def setUp(self):
+        aws_lambda._context.clear()
+        with open(TMP_CONFIG_FILE_PATH, "w") as f:
+            f.write("[service1]\nurl=test1url\n")
+
+    def tearDown(self):
+        aws_lambda._context.clear()
+        os.remove(TMP_CONFIG_FILE_PATH)
+
+    @mock.patch("aws_lambda.emit")
+    @mock.patch("aws_lambda.process_services")
+    @mock.patch("aws_lambda.TwitterPost")
+    @mock.patch("aws_lambda.create_store")
+    @mock.patch("aws_lambda.Config")
+    def test_warm_start(self, mock_config, mock_store, mock_post, mock_process, mock_emit):
+        # given
+        mock_process.return_value = (["result"], {})
+        mock_config.return_value.globalConfig.side_effect = {}.get
+        event = {"DRYRUN": True, "IS_AWS": True, "FILES": [TMP_CONFIG_FILE_PATH]}
+
+        # when - cold and warm invocations
+        self.assertEqual(aws_lambda.lambda_handler(event, None), ["result"])
+        self.assertEqual(aws_lambda.lambda_handler(event, None), ["result"])
+
+        # then - the context is built once, the store is refreshed on the warm invocation
+        self.assertEqual(mock_config.call_count, 1)
+        self.assertEqual(mock_store.call_args, mock.call(mock_config.return_value, "aws", True))
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(mock_store.return_value.refresh.call_count, 1)
+        self.assertEqual(mock_process.call_args,
+                         mock.call(mock_config.return_value, mock_store.return_value, mock_post.return_value,
+                                   None, report=mock.ANY))
+        self.assertIn("store_refresh", mock_emit.call_args[0][0].to_dict()["stages"])
+
+        # when - the config file changed
+        os.utime(TMP_CONFIG_FILE_PATH, (0, 0))
+        aws_lambda.lambda_handler(event, None)
+
+        # then
+        self.assertEqual(mock_config.call_count, 2)
+
+        # when - the env changed
+        with mock.patch.dict(os.environ, {"TWEETS_AT_ONE_TIME": "3"}):
+            aws_lambda.lambda_handler(event, None)
+
+        # then
+        self.assertEqual(mock_config.call_count, 3)
+        self.assertEqual(mock_store.return_value.refresh.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main(TestLambda)
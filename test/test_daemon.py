@@ -0,0 +1,169 @@
+import unittest
+import mock
+
+from feed_config import SERVICE, DAEMON
+from daemon import PollScheduler, run
+from feed_parser import POST_RECORD
+
+HOUR = 60 * 60
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1500000000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def feed(*stamps):
+    return {"status": 200, "entries": [POST_RECORD(str(stamp), None, None, stamp)
+                                       for stamp in sorted(stamps, reverse=True)]}
+
+
+class TestPollScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = PollScheduler(DAEMON(300, 24 * HOUR, 2.0), self.clock)
+
+    def test_learns_interval(self):
+        # given
+        busy = SERVICE("busy", "url1", 5)
+        quiet = SERVICE("quiet", "url2", 5)
+        self.scheduler.add(busy)
+        self.scheduler.add(quiet)
+        now = int(self.clock.now)
+
+        # when - one feed posts every 10 minutes, the other one every week
+        self.assertEqual(self.scheduler.due(), ["busy", "quiet"])
+        self.scheduler.update(busy, feed(now - 600, now - 1200, now - 1800))
+        self.scheduler.update(quiet, feed(now - 7 * 24 * HOUR, now - 14 * 24 * HOUR))
+
+        # then
+        self.assertEqual(self.scheduler.interval("busy"), 600)
+        self.assertEqual(self.scheduler.interval("quiet"), 24 * HOUR)
+        self.assertEqual(self.scheduler.next_due(), self.clock.now + 600)
+        self.assertEqual(self.scheduler.due(), [])
+
+        self.clock.sleep(600)
+        self.assertEqual(self.scheduler.due(), ["busy"])
+
+    def test_backoff(self):
+        # given
+        service = SERVICE("service", "url", 5)
+        self.scheduler.add(service)
+        now = int(self.clock.now)
+        self.scheduler.due()
+        self.scheduler.update(service, feed(now - 300, now - 900))
+        self.assertEqual(self.scheduler.interval("service"), 600)
+
+        # when - nothing new, not modified and failed polls
+        self.scheduler.update(service, feed(now - 300, now - 900))
+        self.assertEqual(self.scheduler.interval("service"), 1200)
+        self.scheduler.update(service, {"status": 304, "entries": []})
+        self.assertEqual(self.scheduler.interval("service"), 2400)
+        self.scheduler.update(service, {})
+        self.assertEqual(self.scheduler.interval("service"), 4800)
+
+        # then - new post brings the learned interval back
+        self.scheduler.update(service, feed(now + 300))
+        self.assertEqual(self.scheduler.interval("service"), 600)
+
+    def test_service_floor_and_ceiling(self):
+        # given
+        service = SERVICE("service", "url", 5, minInterval=900, maxInterval=2000)
+        self.scheduler.add(service)
+        now = int(self.clock.now)
+
+        # when
+        self.scheduler.update(service, feed(now - 60, now - 120))
+
+        # then
+        self.assertEqual(self.scheduler.interval("service"), 900)
+
+        # when
+        for i in range(3):
+            self.scheduler.update(service, {})
+
+        # then
+        self.assertEqual(self.scheduler.interval("service"), 2000)
+
+
+class TestDaemon(unittest.TestCase):
+    @mock.patch("daemon.process_services")
+    def test_run(self, mock_process):
+        # given
+        clock = Clock()
+        now = int(clock.now)
+        services = {"BUSY": SERVICE("BUSY", "url1", 5), "QUIET": SERVICE("QUIET", "url2", 5)}
+        config = mock.MagicMock()
+        config.services.return_value = ["BUSY", "QUIET"]
+        config.__getitem__.side_effect = lambda service: services[service]
+        config.globalConfig.side_effect = {"DAEMON": DAEMON(300, 24 * HOUR, 2.0)}.get
+        tp = mock.MagicMock()
+        tp.pending.return_value = []
+
+        # the busy feed has the new post on every poll
+        def effect(config, store, tp, due, report):
+            return [], dict((service, feed(int(clock.now) - 1, int(clock.now) - 601) if service == "BUSY"
+                             else feed(now - 7 * 24 * HOUR, now - 14 * 24 * HOUR)) for service in due)
+
+        mock_process.side_effect = effect
+
+        # when - run for the hour
+        scheduler = run(config, "store", tp, clock, clock.sleep, max_cycles=6)
+
+        # then - the quiet feed was polled once, the busy one every 10 minutes
+        polled = [call[0][3] for call in mock_process.call_args_list]
+        self.assertEqual(polled[0], ["BUSY", "QUIET"])
+        self.assertEqual(polled[1:], [["BUSY"]] * 5)
+        self.assertEqual(scheduler.interval("BUSY"), 600)
+        self.assertEqual(scheduler.interval("QUIET"), 24 * HOUR)
+        self.assertEqual(clock.now - now, HOUR)
+
+    @mock.patch("daemon.process_services")
+    def test_run_postpones_not_fetched(self, mock_process):
+        # given - the budget is used up before the second feed is fetched
+        clock = Clock()
+        services = {"FIRST": SERVICE("FIRST", "url1", 5), "SECOND": SERVICE("SECOND", "url2", 5)}
+        config = mock.MagicMock()
+        config.services.return_value = ["FIRST", "SECOND"]
+        config.__getitem__.side_effect = lambda service: services[service]
+        config.globalConfig.side_effect = {"DAEMON": DAEMON(300, 24 * HOUR, 2.0)}.get
+        tp = mock.MagicMock()
+        tp.pending.return_value = []
+        mock_process.return_value = ([], {"FIRST": feed()})
+
+        # when
+        scheduler = run(config, "store", tp, clock, clock.sleep, max_cycles=2)
+
+        # then - the second feed is polled again after the shortest interval without backing off
+        self.assertEqual([call[0][3] for call in mock_process.call_args_list], [["FIRST", "SECOND"], ["SECOND"]])
+        self.assertEqual(scheduler.interval("FIRST"), 600)
+        self.assertEqual(scheduler.interval("SECOND"), 300)
+
+    @mock.patch("daemon.process_services")
+    def test_run_survives_errors(self, mock_process):
+        # given
+        clock = Clock()
+        config = mock.MagicMock()
+        config.services.return_value = ["SERVICE"]
+        config.__getitem__.return_value = SERVICE("SERVICE", "url", 5)
+        config.globalConfig.side_effect = {"DAEMON": DAEMON(300, 24 * HOUR, 2.0)}.get
+        tp = mock.MagicMock()
+        tp.pending.return_value = []
+        mock_process.side_effect = Exception("db is down")
+
+        # when
+        scheduler = run(config, "store", tp, clock, clock.sleep, max_cycles=3)
+
+        # then
+        self.assertEqual(mock_process.call_count, 3)
+        self.assertEqual(scheduler.interval("SERVICE"), 2400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,17 +1,29 @@
 import os
+import sqlite3
 import unittest
 import mock
 
-from feed_config import MAIN, AWS_STORAGE
-from data_store import FileBasedDataStore, S3BasedDataStore, STORE
+from datetime import date
+
+from feed_config import MAIN, AWS_STORAGE, DB, SQLITE
+from data_store import FileBasedDataStore, S3BasedDataStore, DBBasedDataStore, SQLiteBasedDataStore, STORE, OUTBOX, \
+    SeenIndex, \
+    UPSERT_STORE_QUERY, \
+    ServiceLeases, CLAIM_LEASES_QUERY, CLAIM_LEASES_TEMPLATE, EXTEND_LEASES_QUERY, RELEASE_LEASES_QUERY, \
+    SELECT_LEASES_QUERY, close_pools, CREATE_AUDIT_PARTITION_QUERY, DELETE_AUDIT_BATCH_QUERY, AUDIT_DELETE_BATCH
+from .fake_s3 import FakeS3
 
 TMP_STORE_FILE_PATH = "/tmp/twStore"
+TMP_SQLITE_PATH = "/tmp/twStore.db"
 
 
 class TestDataStore(unittest.TestCase):
     def setUp(self):
-        if os.path.exists(TMP_STORE_FILE_PATH):
-            os.remove(TMP_STORE_FILE_PATH)
+        for path in (TMP_STORE_FILE_PATH, TMP_STORE_FILE_PATH + ".etag", TMP_SQLITE_PATH, TMP_SQLITE_PATH + "-wal",
+                     TMP_SQLITE_PATH + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        close_pools()
 
     def test_set_and_get(self):
         config = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
@@ -42,7 +54,8 @@ class TestDataStore(unittest.TestCase):
         # then
         self.assertTrue(os.path.exists(TMP_STORE_FILE_PATH))
         self.assertEqual(sorted(open(TMP_STORE_FILE_PATH).readlines()),
-                         ["T1||\n", "T2||\n", "T3|id3|\n", "T4||5555545\n", "T5|id5|444555666\n", "T6|id6|555666777\n"])
+                         ["T1|||||\n", "T2|||||\n", "T3|id3||||\n", "T4||5555545|||\n", "T5|id5|444555666|||\n",
+                          "T6|id6|555666777|||\n"])
 
         # when - try reading the file back
         self.assertEqual(len(config), 6)
@@ -54,7 +67,8 @@ class TestDataStore(unittest.TestCase):
         self.assertEqual(len(config), 6)
         self.assertIsNone(config['T1'])
         self.assertIsNone(config['T2'])
-        self.assertIsNone(config['T3'])
+        # the cursor of the feed without the dates has no timestamp
+        self.assertEqual(config['T3'], STORE("T3", "id3", None))
         self.assertIsNone(config['T4'])
 
         self.assertEqual(config['T5'].serviceName, 'T5')
@@ -65,6 +79,141 @@ class TestDataStore(unittest.TestCase):
         self.assertEqual(config['T6'].lastProcessedId, 'id6')
         self.assertEqual(config['T6'].lastProcessedUpdateTimestamp, 555666777)
 
+    def test_validators(self):
+        config = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+
+        # when
+        config["T1"] = STORE("T1", "id1", 444555666, '"abc"', "Thu, 20 Jul 2017 05:10:15 GMT")
+        config["T2"] = STORE("T2", "id2", 555666777, None, "Thu, 20 Jul 2017 05:10:15 GMT")
+        config.write_store()
+        config._read_store()
+
+        # then
+        self.assertEqual(config["T1"], STORE("T1", "id1", 444555666, '"abc"', "Thu, 20 Jul 2017 05:10:15 GMT"))
+        self.assertEqual(config["T2"], STORE("T2", "id2", 555666777, None, "Thu, 20 Jul 2017 05:10:15 GMT"))
+
+    def test_seen_index(self):
+        config = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+
+        # when
+        config["T1"] = STORE("T1", "id1", 444555666, None, None, ("id|2", "id1"))
+        config.write_store()
+        config._read_store()
+
+        # then
+        self.assertEqual(open(TMP_STORE_FILE_PATH).readlines(), ['T1|id1|444555666|||["id\\u007c2", "id1"]\n'])
+        self.assertEqual(config["T1"].seen, ("id|2", "id1"))
+
+    def test_body_hash(self):
+        config = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+
+        # when - the hash column follows the empty outbox column
+        config["T1"] = STORE("T1", "id1", 444555666, bodyHash="abc")
+        config["T2"] = STORE("T2", "id2", 555666777)
+        config.write_store()
+        config._read_store()
+
+        # then
+        self.assertEqual(open(TMP_STORE_FILE_PATH).readlines(), ['T1|id1|444555666|||||abc\n',
+                                                                 'T2|id2|555666777|||\n'])
+        self.assertEqual(config["T1"], STORE("T1", "id1", 444555666, bodyHash="abc"))
+        self.assertEqual(config["T2"], STORE("T2", "id2", 555666777))
+
+    def test_seen_index_is_bounded(self):
+        # when
+        index = SeenIndex(("id1", "id2"), 3)
+        index.add("id3")
+        index.add("id2")
+        index.add("id4")
+
+        # then
+        self.assertEqual(index.ids(), ("id2", "id3", "id4"))
+        self.assertEqual(len(index), 3)
+        self.assertFalse("id1" in index)
+        self.assertTrue("id4" in index)
+
+    def test_undated_cursor(self):
+        # given - the cursor of the feed without the dates and the service left with the seen ids only
+        config = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+        config["T1"] = STORE("T1", "p2", None, seen=("p1", "p2"))
+        config["T2"] = STORE("T2", None, None, seen=("id2",))
+        config.write_store()
+
+        # when
+        config = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+
+        # then
+        self.assertEqual(config["T1"], STORE("T1", "p2", None, seen=("p1", "p2")))
+        self.assertEqual(config["T2"], STORE("T2", None, None, seen=("id2",)))
+
+    def test_read_store_without_validators(self):
+        # given - the store written before the validators were added
+        with open(TMP_STORE_FILE_PATH, "w") as f:
+            f.writelines(["T1|id1|444555666\n", "T2||\n"])
+
+        # when
+        config = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+
+        # then
+        self.assertEqual(config["T1"], STORE("T1", "id1", 444555666, None, None))
+        self.assertIsNone(config["T2"])
+
+    def test_write_changed_only(self):
+        # given
+        with open(TMP_STORE_FILE_PATH, "w") as f:
+            f.writelines(["T1|id1|444555666|||\n", "T2|id2|555666777|||\n"])
+        config = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+        os.utime(TMP_STORE_FILE_PATH, (0, 0))
+
+        # when - the same records are set
+        config["T1"] = STORE("T1", "id1", 444555666)
+        config["T2"] = STORE("T2", "id2", 555666777)
+
+        # then - the file is not touched
+        self.assertEqual(config.changed(), [])
+        self.assertEqual(config.write_store(), 0)
+        self.assertEqual(os.path.getmtime(TMP_STORE_FILE_PATH), 0)
+
+        # when
+        config["T2"] = STORE("T2", "id3", 666777888)
+
+        # then
+        self.assertEqual(config.changed(), ["T2"])
+        self.assertEqual(config.write_store(), 2)
+        self.assertEqual(config.changed(), [])
+        self.assertEqual(open(TMP_STORE_FILE_PATH).readlines(), ["T1|id1|444555666|||\n", "T2|id3|666777888|||\n"])
+
+    def test_outbox(self):
+        # given
+        store = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+        store["T1"] = STORE("T1", "id1", 444555666)
+
+        # when - the service without the record gets one too
+        store.enqueue(("T1", "id3", 555666777), "tweet | 3")
+        store.enqueue(("T2", "id2", 444555667), "tweet 2")
+        store.enqueue(("T1", "id3", 555666777), "tweet 3 again")
+        store.reschedule(("T2", "id2", 444555667), 1, 2000)
+
+        # then - oldest first
+        self.assertEqual(store.outbox(), [(("T2", "id2", 444555667), OUTBOX("id2", 444555667, "tweet 2", 1, 2000)),
+                                          (("T1", "id3", 555666777), OUTBOX("id3", 555666777, "tweet | 3"))])
+        self.assertEqual([key for key, post in store.outbox(1000)], [("T1", "id3", 555666777)])
+        self.assertEqual([key for key, post in store.outbox(services=["t2"])], [("T2", "id2", 444555667)])
+
+        # when
+        store.write_store()
+        store = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+
+        # then
+        self.assertEqual(store["T1"], STORE("T1", "id1", 444555666, outbox=(OUTBOX("id3", 555666777, "tweet | 3"),)))
+        self.assertEqual(store["T2"], STORE("T2", None, None, outbox=(OUTBOX("id2", 444555667, "tweet 2", 1, 2000),)))
+
+        # when
+        store.remove(("T1", "id3", 555666777))
+
+        # then
+        self.assertEqual(store["T1"], STORE("T1", "id1", 444555666, seen=("id3",)))
+
     def test_dry_run(self):
         config = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH), dry_run=True)
         config["T2"] = STORE("T2", "id2", None)
@@ -78,12 +227,10 @@ class TestDataStore(unittest.TestCase):
         # then
         self.assertFalse(os.path.exists(TMP_STORE_FILE_PATH))
 
-    @mock.patch("boto3.resource")
+    @mock.patch("boto3.client")
     def test_s3_store(self, mock_boto):
-        resource_mock = mock.MagicMock()
-        bucket_mock = mock.MagicMock()
-        mock_boto.return_value = resource_mock
-        resource_mock.Bucket.return_value = bucket_mock
+        s3 = FakeS3()
+        mock_boto.return_value = s3
 
         config = S3BasedDataStore(MAIN(15, TMP_STORE_FILE_PATH), AWS_STORAGE("awskey", "awssecret", "awsbucket", "awsfile"))
 
@@ -102,13 +249,15 @@ class TestDataStore(unittest.TestCase):
         # then
         self.assertEqual(mock_boto.call_args,
                          mock.call('s3', aws_access_key_id='awskey', aws_secret_access_key='awssecret'))
-        self.assertEqual(resource_mock.Bucket.call_args, mock.call("awsbucket"))
-        self.assertEqual(bucket_mock.download_file.call_args, mock.call("awsfile", "/tmp/twStore"))
-        self.assertEqual(bucket_mock.upload_file.call_args, mock.call("/tmp/twStore", "awsfile"))
+        self.assertEqual(s3.calls, ["head_object", "put_object"])
+        self.assertEqual(sorted(s3.objects[("awsbucket", "awsfile")].decode("utf-8").splitlines()),
+                         ["T1|||||", "T2|||||", "T3|id3||||", "T4||5555545|||", "T5|id5|444555666|||",
+                          "T6|id6|555666777|||"])
 
         self.assertTrue(os.path.exists(TMP_STORE_FILE_PATH))
         self.assertEqual(sorted(open(TMP_STORE_FILE_PATH).readlines()),
-                         ["T1||\n", "T2||\n", "T3|id3|\n", "T4||5555545\n", "T5|id5|444555666\n", "T6|id6|555666777\n"])
+                         ["T1|||||\n", "T2|||||\n", "T3|id3||||\n", "T4||5555545|||\n", "T5|id5|444555666|||\n",
+                          "T6|id6|555666777|||\n"])
 
         # when - try reading the file back
         self.assertEqual(len(config), 6)
@@ -120,7 +269,8 @@ class TestDataStore(unittest.TestCase):
         self.assertEqual(len(config), 6)
         self.assertIsNone(config['T1'])
         self.assertIsNone(config['T2'])
-        self.assertIsNone(config['T3'])
+        # the cursor of the feed without the dates has no timestamp
+        self.assertEqual(config['T3'], STORE("T3", "id3", None))
         self.assertIsNone(config['T4'])
 
         self.assertEqual(config['T5'].serviceName, 'T5')
@@ -131,6 +281,362 @@ class TestDataStore(unittest.TestCase):
         self.assertEqual(config['T6'].lastProcessedId, 'id6')
         self.assertEqual(config['T6'].lastProcessedUpdateTimestamp, 555666777)
 
+    @mock.patch("boto3.client")
+    def test_s3_store_not_changed(self, mock_boto):
+        # given
+        s3 = FakeS3()
+        mock_boto.return_value = s3
+        config = S3BasedDataStore(MAIN(15, TMP_STORE_FILE_PATH), AWS_STORAGE(None, None, "awsbucket", "awsfile"))
+
+        # when
+        written = config.write_store()
+
+        # then
+        self.assertEqual(written, 0)
+        self.assertEqual(s3.calls, ["head_object"])
+        self.assertEqual(mock_boto.call_args, mock.call('s3'))
+
+    @mock.patch("boto3.client")
+    def test_s3_store_sync(self, mock_boto):
+        # given - the store in s3 was written by the previous run
+        s3 = FakeS3()
+        s3.objects[("awsbucket", "awsfile")] = b"T1|id1|111|||\n"
+        mock_boto.return_value = s3
+        aws = AWS_STORAGE(None, None, "awsbucket", "awsfile", "http://localhost:9000")
+
+        # when - first run downloads the file
+        config = S3BasedDataStore(MAIN(15, TMP_STORE_FILE_PATH), aws)
+
+        # then
+        self.assertEqual(mock_boto.call_args, mock.call('s3', endpoint_url="http://localhost:9000"))
+        self.assertEqual(s3.calls, ["head_object", "download_file"])
+        self.assertEqual(config["T1"].lastProcessedId, "id1")
+
+        # when - the object has not changed, local copy is used
+        s3.calls = []
+        config = S3BasedDataStore(MAIN(15, TMP_STORE_FILE_PATH), aws)
+
+        # then
+        self.assertEqual(s3.calls, ["head_object"])
+        self.assertEqual(config["T1"].lastProcessedId, "id1")
+
+        # when - the same content is written, nothing is uploaded
+        config._changed.add("T1")
+        config.write_store()
+
+        # then
+        self.assertEqual(s3.calls, ["head_object"])
+
+        # when - the object was changed by somebody else, it is downloaded again
+        s3.objects[("awsbucket", "awsfile")] = b"T1|id2|222|||\n"
+        config = S3BasedDataStore(MAIN(15, TMP_STORE_FILE_PATH), aws)
+
+        # then
+        self.assertEqual(s3.calls, ["head_object", "head_object", "download_file"])
+        self.assertEqual(config["T1"].lastProcessedId, "id2")
+
+        # when - new content is uploaded
+        s3.calls = []
+        config["T1"] = STORE("T1", "id3", 333)
+        config.write_store()
+        config = S3BasedDataStore(MAIN(15, TMP_STORE_FILE_PATH), aws)
+
+        # then - the ETag returned by the upload is cached so the next run does not download
+        self.assertEqual(s3.calls, ["put_object", "head_object"])
+        self.assertEqual(s3.objects[("awsbucket", "awsfile")], b"T1|id3|333|||\n")
+        self.assertEqual(config["T1"].lastProcessedId, "id3")
+
+        # when - the long living store is refreshed after somebody else wrote the object
+        s3.calls = []
+        s3.objects[("awsbucket", "awsfile")] = b"T1|id4|444|||\n"
+        config.refresh()
+
+        # then
+        self.assertEqual(s3.calls, ["head_object", "download_file"])
+        self.assertEqual(config["T1"].lastProcessedId, "id4")
+
+    @mock.patch("psycopg2.extras.execute_values")
+    @mock.patch("psycopg2.connect")
+    def test_db_store(self, mock_connect, mock_execute_values):
+        # given
+        mock_connect.return_value.closed = 0
+        cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [("t1", "id1", 444555666, '"abc"', None, '["id0", "id1"]', None, "h1"),
+                                        ("t2", None, -1, None, None, None, None, None)]
+
+        # when
+        store = DBBasedDataStore(DB("postgres://test", None))
+
+        # then - the whole store is read with one fetch
+        self.assertEqual(mock_connect.call_args_list, [mock.call("postgres://test")])
+        cursor.fetchone.assert_not_called()
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store["T1"], STORE("T1", "id1", 444555666, '"abc"', None, ("id0", "id1"), bodyHash="h1"))
+        self.assertIsNone(store["T2"])
+
+        # when
+        store["T2"] = STORE("T2", "id2", 555666777)
+        store["T3"] = STORE("T3", "id3", 666777888, None, "Thu, 20 Jul 2017 05:10:15 GMT", ("id3",), bodyHash="h3")
+        cursor.fetchall.return_value = [("T3",)]
+        written = store.write_store()
+
+        # then - the changed records are upserted in one statement, the db skipped the one equal to its row
+        self.assertEqual(written, 1)
+        self.assertEqual(store.skipped, 2)
+        mock_execute_values.assert_called_once_with(
+            cursor, UPSERT_STORE_QUERY, [("id2", 555666777, None, None, "", "", None, "T2"),
+                                         ("id3", 666777888, None, "Thu, 20 Jul 2017 05:10:15 GMT", '["id3"]', "",
+                                          "h3", "T3")],
+            page_size=2)
+        mock_connect.return_value.commit.assert_called_once_with()
+        # the connection is reused
+        self.assertEqual(mock_connect.call_args_list, [mock.call("postgres://test")])
+
+        # when - nothing changed since
+        store["T2"] = STORE("T2", "id2", 555666777)
+
+        # then
+        self.assertEqual(store.write_store(), 0)
+        self.assertEqual(mock_execute_values.call_count, 1)
+
+    @mock.patch("psycopg2.extras.execute_values")
+    @mock.patch("psycopg2.connect")
+    def test_db_store_undated_cursor(self, mock_connect, mock_execute_values):
+        # given
+        mock_connect.return_value.closed = 0
+        cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = []
+        store = DBBasedDataStore(DB("postgres://test", None))
+        store["T1"] = STORE("T1", "p2", None, seen=("p1", "p2"))
+        store["T2"] = STORE("T2", None, None, seen=("id2",))
+        cursor.fetchall.return_value = [("T1",), ("T2",)]
+        store.write_store()
+
+        # when - the rows written are read back
+        cursor.fetchall.return_value = [(row[-1],) + row[:-1] for row in mock_execute_values.call_args[0][2]]
+        store = DBBasedDataStore(DB("postgres://test", None))
+
+        # then
+        self.assertEqual(store["T1"], STORE("T1", "p2", None, seen=("p1", "p2")))
+        self.assertEqual(store["T2"], STORE("T2", None, None, seen=("id2",)))
+
+    def test_sqlite_store(self):
+        # given
+        store = SQLiteBasedDataStore(SQLITE(TMP_SQLITE_PATH))
+        store["T1"] = STORE("T1", "id1", 444555666, '"abc"', None, ("id0", "id1"), bodyHash="h1")
+        store.enqueue(("T2", "id2", 555666777), "tweet | 2")
+        self.assertEqual(store.write_store(), 2)
+
+        # when - the store is opened again
+        store = SQLiteBasedDataStore(SQLITE(TMP_SQLITE_PATH))
+        statements = []
+        store._connection().set_trace_callback(statements.append)
+
+        # then - the records are read one by one when asked for
+        self.assertEqual(store["T1"], STORE("T1", "id1", 444555666, '"abc"', None, ("id0", "id1"), bodyHash="h1"))
+        self.assertIsNone(store["T3"])
+        self.assertIsNone(store["T3"])
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(store.outbox(services=["T2"]), [(("T2", "id2", 555666777), OUTBOX("id2", 555666777,
+                                                                                           "tweet | 2"))])
+        self.assertEqual(len(store), 2)
+
+        # when - the same record is set again and one record changes
+        store["T1"] = STORE("T1", "id1", 444555666, '"abc"', None, ("id0", "id1"), bodyHash="h1")
+        store.remove(("T2", "id2", 555666777))
+        del statements[:]
+
+        # then - only the changed record is written
+        self.assertEqual(store.write_store(), 1)
+        # the statement is traced again for every statement of the audit trigger
+        self.assertEqual(len(set(statement for statement in statements if statement.startswith("insert into store"))),
+                         1)
+        self.assertEqual(store["T2"], STORE("T2", None, None, seen=("id2",)))
+        self.assertEqual(store.skipped, 1)
+
+        # then - the cursor did not move so there is no audit record, the other connection reads while the store is
+        # open
+        conn = sqlite3.connect(TMP_SQLITE_PATH)
+        self.assertEqual(conn.execute("pragma journal_mode").fetchone(), ("wal",))
+        self.assertEqual(conn.execute("select count(*) from store_audit").fetchone(), (0,))
+
+        # when - the cursor moves
+        store["T2"] = STORE("T2", "id2", 555666777, seen=("id2",))
+        store.write_store()
+
+        # then
+        self.assertEqual(conn.execute("select v_name, v_last_id from store_audit").fetchall(), [("T2", None)])
+
+        # when - the other instance writes the same record again
+        other = SQLiteBasedDataStore(SQLITE(TMP_SQLITE_PATH))
+        other._stores["T2"] = STORE("T2", "id1", 444555666)
+        other["T2"] = STORE("T2", "id2", 555666777, seen=("id2",))
+
+        # then - the row equal to the one in the database is not updated
+        self.assertEqual(other.write_store(), 0)
+        self.assertEqual(other.skipped, 1)
+        self.assertEqual(conn.execute("select count(*) from store_audit").fetchone(), (1,))
+        other.close()
+
+        # when
+        conn.execute("update store_audit set update_ts = update_ts - 3 * 86400")
+        conn.commit()
+        store.clean_audit_log(2)
+
+        # then
+        self.assertEqual(conn.execute("select count(*) from store_audit").fetchone(), (0,))
+        conn.close()
+        store.close()
+
+    def test_sqlite_store_undated_cursor(self):
+        # given
+        store = SQLiteBasedDataStore(SQLITE(TMP_SQLITE_PATH))
+        store["T1"] = STORE("T1", "p2", None, seen=("p1", "p2"))
+        store["T2"] = STORE("T2", None, None, seen=("id2",))
+        store.write_store()
+        store.close()
+
+        # when
+        store = SQLiteBasedDataStore(SQLITE(TMP_SQLITE_PATH))
+
+        # then
+        self.assertEqual(store["T1"], STORE("T1", "p2", None, seen=("p1", "p2")))
+        self.assertEqual(store["T2"], STORE("T2", None, None, seen=("id2",)))
+        store.close()
+
+    def test_sqlite_store_dry_run(self):
+        # when
+        store = SQLiteBasedDataStore(SQLITE(TMP_SQLITE_PATH), True)
+        store["T1"] = STORE("T1", "id1", 444555666)
+        store.write_store()
+
+        # then
+        self.assertIsNone(SQLiteBasedDataStore(SQLITE(TMP_SQLITE_PATH))["T1"])
+
+    @mock.patch("psycopg2.connect")
+    def test_db_pool_replaces_broken_connection(self, mock_connect):
+        # given - the pooled connection was closed by the server in the meantime
+        broken = mock.MagicMock(closed=0)
+        healthy = mock.MagicMock(closed=0)
+        healthy.cursor.return_value.__enter__.return_value.fetchall.return_value = []
+        healthy.cursor.return_value.__enter__.return_value.fetchone.return_value = (False,)
+        healthy.cursor.return_value.__enter__.return_value.rowcount = 0
+        mock_connect.side_effect = [broken, healthy]
+        store = DBBasedDataStore(DB("postgres://test", True, 3))
+        broken.closed = 2
+
+        # when
+        store.clean_audit_log(10)
+
+        # then
+        self.assertEqual(mock_connect.call_args_list, [mock.call("postgres://test", sslmode=True)] * 2)
+        broken.close.assert_called_once_with()
+        healthy.cursor.return_value.__enter__.return_value.execute.assert_called_with(
+            DELETE_AUDIT_BATCH_QUERY % ("store_audit", "store_audit"), (10, AUDIT_DELETE_BATCH))
+
+    @mock.patch("psycopg2.connect")
+    def test_clean_audit_log_partitioned(self, mock_connect):
+        # given
+        mock_connect.return_value.closed = 0
+        cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = []
+        store = DBBasedDataStore(DB("postgres://test", None))
+        cursor.fetchone.side_effect = [(True,), (date(2026, 10, 18),)]
+        cursor.fetchall.return_value = [("store_audit_p20261001",), ("store_audit_p20261008",),
+                                        ("store_audit_p20261019",), ("store_audit_default",)]
+        rowcounts = [2, 1]
+
+        def execute(query, params=None):
+            if query.startswith("delete"):
+                cursor.rowcount = rowcounts.pop(0)
+
+        cursor.execute.reset_mock()
+        cursor.execute.side_effect = execute
+
+        # when
+        store.clean_audit_log(10, 2)
+
+        # then - the partition of the expired day is dropped, the days to come are created and the default partition
+        # is cleaned in the batches until the batch is not full
+        statements = [call[0][0] for call in cursor.execute.call_args_list if not call[0][0].startswith("select")]
+        self.assertEqual(statements[0], "drop table if exists store_audit_p20261001")
+        self.assertEqual(statements[1:7], [CREATE_AUDIT_PARTITION_QUERY % ("store_audit_p202610%i" % day,
+                                                                           date(2026, 10, day), date(2026, 10, day + 1))
+                                           for day in range(20, 26)])
+        self.assertEqual(statements[7:],
+                         [DELETE_AUDIT_BATCH_QUERY % ("store_audit_default", "store_audit_default")] * 2)
+        self.assertEqual(cursor.execute.call_args[0][1], (10, 2))
+
+    @mock.patch("psycopg2.extras.execute_values")
+    @mock.patch("psycopg2.connect")
+    def test_db_store_dry_run(self, mock_connect, mock_execute_values):
+        # given
+        mock_connect.return_value.closed = 0
+        mock_connect.return_value.cursor.return_value.__enter__.return_value.fetchall.return_value = []
+        store = DBBasedDataStore(DB("postgres://test", None), dry_run=True)
+
+        # when
+        store["T1"] = STORE("T1", "id1", 444555666)
+        store.write_store()
+
+        # then
+        mock_execute_values.assert_not_called()
+
+    @mock.patch("psycopg2.extras.execute_values")
+    @mock.patch("psycopg2.connect")
+    def test_service_leases(self, mock_connect, mock_execute_values):
+        # given - t2 is leased by another worker, t3 lease of the crashed worker expired, t4 was released earlier
+        mock_connect.return_value.closed = 0
+        cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+        cursor.fetchall.side_effect = [[("T2", False, 300), ("T3", True, 200), ("T4", True, 100)],
+                                       [("T1",), ("T4",)]]
+        leases = ServiceLeases(DB("postgres://test", None), 60, "worker1")
+
+        # when
+        claimed = leases.claim(["t1", "t2", "t3", "t4", "t5"], 3)
+
+        # then - never leased first, then the longest released ones, t3 was taken by another worker in the meantime
+        mock_execute_values.assert_called_once_with(
+            cursor, CLAIM_LEASES_QUERY, [("T1", "worker1", 60), ("T5", "worker1", 60), ("T4", "worker1", 60)],
+            template=CLAIM_LEASES_TEMPLATE, page_size=3)
+        self.assertEqual(claimed, ["T1", "T4"])
+        self.assertEqual(leases.claimed(), ["T1", "T4"])
+
+        # when
+        cursor.rowcount = 1
+        self.assertEqual(leases.extend(), 1)
+
+        # then
+        cursor.execute.assert_called_with(EXTEND_LEASES_QUERY, (60, "worker1", ["T1", "T4"]))
+
+        # when
+        leases.start_heartbeat(0.01)
+        leases.release()
+
+        # then
+        cursor.execute.assert_called_with(RELEASE_LEASES_QUERY, ("worker1", ["T1", "T4"]))
+        self.assertEqual(leases.claimed(), [])
+
+    @mock.patch("psycopg2.extras.execute_values")
+    @mock.patch("psycopg2.connect")
+    def test_service_leases_dry_run(self, mock_connect, mock_execute_values):
+        # given
+        mock_connect.return_value.closed = 0
+        cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [("T1", False, 300)]
+        leases = ServiceLeases(DB("postgres://test", None), 60, dry_run=True)
+
+        # when
+        claimed = leases.claim(["t1", "t2"], 5)
+        leases.extend()
+        leases.release()
+
+        # then - the leases are read but not written
+        cursor.execute.assert_any_call(SELECT_LEASES_QUERY)
+        self.assertEqual(claimed, ["T2"])
+        mock_execute_values.assert_not_called()
+        self.assertNotIn(mock.call(RELEASE_LEASES_QUERY, mock.ANY), cursor.execute.call_args_list)
+
 
 if __name__ == "__main__":
     unittest.main(TestDataStore)
@@ -1,4 +1,5 @@
 import unittest
+import mock
 import feed_config
 import os
 import logging
@@ -74,14 +75,71 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(config['LINKEDIN'].serviceName, 'LINKEDIN')
         self.assertEqual(config['LINKEDIN'].url, 'https://engineering.linkedin.com/blog.rss')
         self.assertEqual(config['LINKEDIN'].numPosts, 1)
+        self.assertEqual(config['LINKEDIN'].cursor, feed_config.CURSOR_TIMESTAMP)
         self.assertEqual(config['NETFLIX'].serviceName, 'NETFLIX')
         self.assertEqual(config['NETFLIX'].url, 'https://netflix.com/feed/netflix-techblog')
         self.assertEqual(config['NETFLIX'].numPosts, 1)
+        self.assertEqual(config['NETFLIX'].cursor, feed_config.CURSOR_ID)
+        self.assertEqual(config['NETFLIX'].minInterval, 600)
+        self.assertEqual(config['NETFLIX'].maxInterval, 3600)
+        self.assertIsNone(config['LINKEDIN'].minInterval)
+        self.assertEqual(config.globalConfig("DAEMON").minInterval, feed_config.DEFAULT_DAEMON_MIN_INTERVAL)
+        self.assertEqual(config.globalConfig("DAEMON").maxInterval, feed_config.DEFAULT_DAEMON_MAX_INTERVAL)
         self.assertEqual(['LINKEDIN', 'NETFLIX'], sorted(config.services()))
 
         if __name__ == "__main__":
             unittest.main(TestConfig)
 
+    def test_urls(self):
+        # given
+        file = '/tmp/twTestConfig.cfg'
+        with open(file, 'w') as f:
+            f.write("[a]\nurl=url1\n[b]\nurl=url2\n[c]\nurl=url1\n")
+
+        # when
+        config = feed_config.Config(file)
+        os.remove(file)
+
+        # then
+        self.assertEqual(config.urls(), {"url1": ["A", "C"], "url2": ["B"]})
+        self.assertEqual(config.urls(["c", "b"]), {"url1": ["C"], "url2": ["B"]})
+        self.assertEqual(config.urls(["a"]), {"url1": ["A"]})
+
+    def test_policy(self):
+        # when
+        with mock.patch.dict(os.environ, {feed_config.POLICY_ENV: feed_config.POLICY_FAIR}):
+            config = feed_config.Config('./testConfig.cfg')
+
+        # then
+        self.assertEqual(config.globalConfig("MAIN").policy, feed_config.POLICY_FAIR)
+        self.assertEqual(feed_config.Config('./testConfig.cfg').globalConfig("MAIN").policy, feed_config.POLICY_DATE)
+
+        # when
+        with mock.patch.dict(os.environ, {feed_config.POLICY_ENV: "random"}):
+            self.assertRaises(SystemError, feed_config.Config, './testConfig.cfg')
+
+    def test_parser(self):
+        # when
+        with mock.patch.dict(os.environ, {feed_config.FETCH_PARSER_ENV: feed_config.PARSER_FAST}):
+            config = feed_config.Config('./testConfig.cfg')
+
+        # then
+        self.assertEqual(config.globalConfig("FETCH").parser, feed_config.PARSER_FAST)
+        self.assertEqual(feed_config.Config('./testConfig.cfg').globalConfig("FETCH").parser,
+                         feed_config.PARSER_FEEDPARSER)
+
+        # when - the parser of the command line wins over the env
+        with mock.patch.dict(os.environ, {feed_config.FETCH_PARSER_ENV: feed_config.PARSER_FAST}):
+            config = feed_config.Config('./testConfig.cfg', parser=feed_config.PARSER_FEEDPARSER)
+
+        # then
+        self.assertEqual(config.globalConfig("FETCH").parser, feed_config.PARSER_FEEDPARSER)
+
+        # when
+        with mock.patch.dict(os.environ, {feed_config.FETCH_PARSER_ENV: "lxml"}):
+            self.assertRaises(SystemError, feed_config.Config, './testConfig.cfg')
+        self.assertRaises(SystemError, feed_config.Config, './testConfig.cfg', parser="lxml")
+
     def test_validation(self):
         # when
         with self.assertRaises(SystemError) as e:
@@ -0,0 +1,243 @@
+import io
+import threading
+import time
+import unittest
+import mock
+
+from urllib.error import HTTPError, URLError
+from feed_config import FETCH
+from feed_fetch import FeedFetcher, FEED_REQUEST
+from feed_parser import POST_RECORD
+from metrics import RunReport
+
+RSS = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+<channel>
+<title>%s</title>
+<item><guid>%s-post2</guid><title>post 2 title</title><link>http://test.com/2</link>
+<pubDate>Thu, 20 Jul 2017 05:10:15 GMT</pubDate></item>
+<item><guid>%s-post1</guid><title>post 1 title</title><link>http://test.com/1</link>
+<pubDate>Mon, 15 May 2017 20:36:55 GMT</pubDate></item>
+</channel>
+</rss>"""
+
+
+def response(name, status=200, headers=None):
+    resp = mock.MagicMock()
+    resp.__enter__.return_value = resp
+    resp.status = status
+    resp.headers = dict({"Content-Type": "application/rss+xml"}, **(headers if headers else {}))
+    resp.read.return_value = (RSS % (name, name, name)).encode("utf-8")
+    return resp
+
+
+class TestFeedFetcher(unittest.TestCase):
+    @mock.patch("feed_fetch.urlopen")
+    def test_fetch_all_keeps_order(self, mock_urlopen):
+        # given - the first feed is the slowest one
+        def effect(request, timeout):
+            name = request.full_url.split("/")[-1]
+            if name == "a":
+                time.sleep(0.05)
+            return response(name)
+
+        mock_urlopen.side_effect = effect
+
+        # when
+        feeds = FeedFetcher(FETCH(4, 2, 10)).fetch_all([FEED_REQUEST("http://a.com/a"),
+                                                        FEED_REQUEST("http://b.com/b"),
+                                                        FEED_REQUEST("http://c.com/c")])
+
+        # then
+        self.assertEqual([feed["entries"][0].id for feed in feeds], ["a-post2", "b-post2", "c-post2"])
+        self.assertEqual([feed["status"] for feed in feeds], [200, 200, 200])
+        self.assertEqual(feeds[1]["entries"], [POST_RECORD("b-post2", "post 2 title", "http://test.com/2", 1500527415),
+                                               POST_RECORD("b-post1", "post 1 title", "http://test.com/1", 1494880615)])
+        for call in mock_urlopen.call_args_list:
+            self.assertEqual(call[1]["timeout"], 10)
+
+    @mock.patch("feed_fetch.urlopen")
+    def test_fetch_iter_is_lazy(self, mock_urlopen):
+        # given
+        mock_urlopen.side_effect = lambda request, timeout: response(request.full_url.split("/")[-1])
+        feed_requests = [FEED_REQUEST("http://test.com/%i" % number) for number in range(10)]
+
+        # when - only the first feeds are consumed
+        feeds = FeedFetcher(FETCH(2, 2, 10)).fetch_iter(feed_requests)
+        titles = [next(feeds)["entries"][0].id, next(feeds)["entries"][0].id]
+        feeds.close()
+
+        # then - the feeds are in order and no more than the workers are fetched ahead
+        self.assertEqual(titles, ["0-post2", "1-post2"])
+        self.assertLessEqual(mock_urlopen.call_count, 4)
+
+    @mock.patch("feed_fetch.urlopen")
+    def test_per_host_limit(self, mock_urlopen):
+        # given
+        lock = threading.Lock()
+        active = {"now": 0, "max": 0}
+
+        def effect(request, timeout):
+            with lock:
+                active["now"] += 1
+                active["max"] = max(active["max"], active["now"])
+            time.sleep(0.02)
+            with lock:
+                active["now"] -= 1
+            return response("a")
+
+        mock_urlopen.side_effect = effect
+
+        # when
+        feeds = FeedFetcher(FETCH(8, 2, 10)).fetch_all([FEED_REQUEST("http://a.com/%i" % i) for i in range(8)])
+
+        # then
+        self.assertEqual(len(feeds), 8)
+        self.assertEqual(active["max"], 2)
+
+    @mock.patch("feed_fetch.urlopen")
+    def test_errors(self, mock_urlopen):
+        # given
+        def effect(request, timeout):
+            if request.full_url == "http://a.com/missing":
+                raise HTTPError(request.full_url, 404, "Not Found", {}, None)
+            elif request.full_url == "http://b.com/timeout":
+                raise URLError("timed out")
+            return response("c")
+
+        mock_urlopen.side_effect = effect
+        report = RunReport()
+
+        # when
+        feeds = FeedFetcher(FETCH(2, 2, 10), report).fetch_all([FEED_REQUEST("http://a.com/missing"),
+                                                                FEED_REQUEST("http://b.com/timeout"),
+                                                                FEED_REQUEST("http://c.com/c")])
+
+        # then
+        self.assertEqual(feeds[0]["status"], 404)
+        self.assertEqual(feeds[1], {})
+        self.assertEqual(feeds[2]["status"], 200)
+        self.assertEqual(feeds[2]["bytes"], len((RSS % ("c", "c", "c")).encode("utf-8")))
+
+        data = report.to_dict()
+        self.assertEqual(data["counters"],
+                         {"fetch_errors": 2, "feeds_fetched": 1, "bytes_downloaded": feeds[2]["bytes"]})
+        self.assertEqual(data["stages"]["fetch"]["count"], 3)
+        self.assertEqual(data["stages"]["parse"]["count"], 1)
+
+    @mock.patch("feed_fetch.urlopen")
+    def test_conditional_get(self, mock_urlopen):
+        # given
+        def effect(request, timeout):
+            if request.get_header("If-none-match") == '"abc"':
+                raise HTTPError(request.full_url, 304, "Not Modified", {}, None)
+            return response("b", headers={"ETag": '"def"', "Last-Modified": "Thu, 20 Jul 2017 05:10:15 GMT"})
+
+        mock_urlopen.side_effect = effect
+
+        # when
+        feeds = FeedFetcher(FETCH(2, 2, 10)).fetch_all([
+            FEED_REQUEST("http://a.com/a", '"abc"', "Wed, 19 Jul 2017 05:10:15 GMT"),
+            FEED_REQUEST("http://b.com/b", '"xyz"')])
+
+        # then
+        self.assertEqual(feeds[0], {"status": 304, "href": "http://a.com/a", "entries": [], "etag": '"abc"',
+                                    "modified": "Wed, 19 Jul 2017 05:10:15 GMT"})
+        self.assertEqual(feeds[1]["status"], 200)
+        self.assertEqual(feeds[1]["etag"], '"def"')
+        self.assertEqual(feeds[1]["modified"], "Thu, 20 Jul 2017 05:10:15 GMT")
+        self.assertEqual(len(feeds[1]["entries"]), 2)
+
+        requests = sorted([call[0][0] for call in mock_urlopen.call_args_list], key=lambda r: r.full_url)
+        self.assertEqual(requests[0].get_header("If-modified-since"), "Wed, 19 Jul 2017 05:10:15 GMT")
+        self.assertEqual(requests[1].get_header("If-none-match"), '"xyz"')
+        self.assertIsNone(requests[1].get_header("If-modified-since"))
+
+    @mock.patch("feed_fetch.urlopen")
+    def test_streaming(self, mock_urlopen):
+        # given - second feed is not well formed xml so it can not be streamed
+        def effect(request, timeout):
+            resp = response("a")
+            data = RSS % ("a", "a", "a")
+            if request.full_url == "http://b.com/b":
+                data = data.replace("post 2 title", "post 2 & title")
+            resp.read.side_effect = io.BytesIO(data.encode("utf-8")).read
+            return resp
+
+        mock_urlopen.side_effect = effect
+        report = RunReport()
+
+        # when
+        feeds = FeedFetcher(FETCH(2, 2, 10, True, 1024 * 1024), report).fetch_all([
+            FEED_REQUEST("http://a.com/a", lastId="a-post2"),
+            FEED_REQUEST("http://b.com/b", lastId="a-post2")])
+
+        # then
+        self.assertEqual(feeds[0]["status"], 200)
+        self.assertEqual([entry.id for entry in feeds[0]["entries"]], ["a-post2"])
+        self.assertEqual(feeds[1]["status"], 200)
+        self.assertEqual([entry.id for entry in feeds[1]["entries"]], ["a-post2", "a-post1"])
+        self.assertEqual(feeds[1]["entries"][0].title, "post 2 & title")
+
+        # the streamed reading is not counted as the fetch, only the feed that could not be streamed is parsed
+        stages = report.to_dict()["stages"]
+        self.assertEqual((stages["fetch"]["count"], stages["stream"]["count"], stages["parse"]["count"]), (2, 2, 1))
+
+    @mock.patch("feed_fetch.urlopen")
+    def test_fast_parser(self, mock_urlopen):
+        # given - second feed is not well formed xml so the fast parser can not read it
+        def effect(request, timeout):
+            resp = response("a")
+            if request.full_url == "http://b.com/b":
+                resp.read.return_value = resp.read.return_value.replace(b"post 2 title", b"post 2 & title")
+            return resp
+
+        mock_urlopen.side_effect = effect
+        report = RunReport()
+
+        # when
+        with mock.patch("feedparser.parse", wraps=__import__("feedparser").parse) as mock_parse:
+            feeds = FeedFetcher(FETCH(2, 2, 10, parser="fast"), report).fetch_all([FEED_REQUEST("http://a.com/a"),
+                                                                                    FEED_REQUEST("http://b.com/b")])
+
+        # then - feedparser parsed only the malformed feed
+        self.assertEqual(feeds[0]["entries"], [POST_RECORD("a-post2", "post 2 title", "http://test.com/2", 1500527415),
+                                               POST_RECORD("a-post1", "post 1 title", "http://test.com/1", 1494880615)])
+        self.assertEqual([entry.id for entry in feeds[1]["entries"]], ["a-post2", "a-post1"])
+        self.assertEqual(feeds[1]["entries"][0].title, "post 2 & title")
+        self.assertEqual(mock_parse.call_count, 1)
+        self.assertEqual(report.to_dict()["counters"]["parser_fallbacks"], 1)
+
+    @mock.patch("feed_fetch.urlopen")
+    def test_body_hash(self, mock_urlopen):
+        # given
+        mock_urlopen.side_effect = lambda request, timeout: response("a")
+        report = RunReport()
+        fetcher = FeedFetcher(FETCH(2, 2, 10, parser="fast"), report)
+        first = fetcher.fetch("http://a.com/a")
+
+        # when - the host sends the same body again
+        with mock.patch("feed_fetch.fast_parse") as mock_parse:
+            feeds = fetcher.fetch_all([FEED_REQUEST("http://a.com/a", bodyHash=first["hash"])])
+
+        # then - it is not parsed
+        mock_parse.assert_not_called()
+        self.assertEqual(feeds[0]["status"], 200)
+        self.assertTrue(feeds[0]["unchanged"])
+        self.assertEqual(feeds[0]["entries"], [])
+        self.assertEqual(feeds[0]["hash"], first["hash"])
+        self.assertEqual(report.to_dict()["counters"]["parses_avoided"], 1)
+
+        # when - the body changed
+        feeds = fetcher.fetch_all([FEED_REQUEST("http://a.com/a", bodyHash="other")])
+
+        # then
+        self.assertNotIn("unchanged", feeds[0])
+        self.assertEqual(len(feeds[0]["entries"]), 2)
+
+    def test_no_urls(self):
+        self.assertEqual(FeedFetcher(FETCH(2, 2, 10)).fetch_all([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main(TestFeedFetcher)
@@ -0,0 +1,163 @@
+import io
+import unittest
+
+from feedparser import parse
+from xml.etree.ElementTree import ParseError
+from feed_parser import fast_parse, stream_parse, to_record, StreamParseError
+
+RSS = """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/">
+<channel>
+<title>test</title>
+%s
+</channel>
+</rss>"""
+
+RSS_ITEM = """<item><guid isPermaLink="false">post%i</guid><title>post %i &amp; title</title>
+<link>http://test.com/%i</link><pubDate>Thu, 20 Jul 2017 05:10:%02i +0200</pubDate>
+<content:encoded><![CDATA[%s]]></content:encoded></item>"""
+
+ATOM = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<title>test</title>
+<entry><id>tag:test,2017:1</id><title type="html">post &lt;b&gt;1&lt;/b&gt;</title>
+<link rel="self" href="http://test.com/self/1"/><link href="http://test.com/1"/>
+<published>2017-07-20T05:10:15Z</published></entry>
+<entry><id>tag:test,2017:2</id><title>post 2</title><link rel="alternate" href="http://test.com/2"/>
+<updated>2017-07-19T05:10:15+02:00</updated></entry>
+</feed>"""
+
+RDF = """<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns="http://purl.org/rss/1.0/">
+<channel rdf:about="http://test.com"><title>test</title></channel>
+<item rdf:about="http://test.com/1"><title>post 1</title><link>http://test.com/1</link></item>
+<item rdf:about="http://test.com/2"><title>post 2</title><link>http://test.com/2</link></item>
+</rdf:RDF>"""
+
+# the entries dated only by the dublin core date of RSS 1.0 or by the atom updated
+RDF_DC_DATE = """<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns="http://purl.org/rss/1.0/"
+xmlns:dc="http://purl.org/dc/elements/1.1/">
+<channel rdf:about="http://test.com"><title>test</title></channel>
+<item rdf:about="http://test.com/1"><title>post 1</title><link>http://test.com/1</link>
+<dc:date>2017-07-20T05:10:15Z</dc:date></item>
+<item rdf:about="http://test.com/2"><title>post 2</title><link>http://test.com/2</link>
+<dc:date>2017-07-19T05:10:15+02:00</dc:date></item>
+</rdf:RDF>"""
+
+ATOM_UPDATED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<title>test</title>
+<entry><id>tag:test,2017:1</id><title>post 1</title><link href="http://test.com/1"/>
+<updated>2017-07-20T05:10:15Z</updated></entry>
+<entry><id>tag:test,2017:2</id><title>post 2</title><link href="http://test.com/2"/>
+<published>2017-07-18T05:10:15Z</published><updated>2017-07-19T05:10:15Z</updated></entry>
+</feed>"""
+
+
+class CountingStream(io.BytesIO):
+    def __init__(self, data):
+        io.BytesIO.__init__(self, data)
+        self.read_bytes = 0
+
+    def read(self, size=-1):
+        chunk = io.BytesIO.read(self, size)
+        self.read_bytes += len(chunk)
+        return chunk
+
+
+def rss(num_items, content_size=10):
+    return (RSS % "\n".join([RSS_ITEM % (i, i, i, i, "x" * content_size) for i in range(num_items)])).encode("utf-8")
+
+
+class TestFeedParser(unittest.TestCase):
+    def assert_same_as_feedparser(self, data, entries):
+        expected = parse(data)["entries"]
+        self.assertEqual(len(entries), len(expected))
+        for entry, expected_entry in zip(entries, expected):
+            for key in ("id", "link", "title", "published_parsed"):
+                self.assertEqual(entry.get(key), expected_entry.get(key), key)
+            # the updated date is compared through the record - feedparser maps the missing one to the published one
+            self.assertEqual(to_record(entry), to_record(expected_entry))
+
+    def test_rss(self):
+        data = rss(3)
+        self.assert_same_as_feedparser(data, stream_parse(io.BytesIO(data))["entries"])
+
+    def test_atom(self):
+        data = ATOM.encode("utf-8")
+        self.assert_same_as_feedparser(data, stream_parse(io.BytesIO(data))["entries"])
+
+    def test_rdf(self):
+        data = RDF.encode("utf-8")
+        self.assert_same_as_feedparser(data, stream_parse(io.BytesIO(data))["entries"])
+
+    def test_stops_at_last_id(self):
+        # given
+        stream = CountingStream(rss(50, 10000))
+
+        # when
+        feeds = stream_parse(stream, stop_id="post2", chunk_size=1024)
+
+        # then
+        self.assertEqual([entry["id"] for entry in feeds["entries"]], ["post0", "post1", "post2"])
+        self.assertEqual(feeds["bozo"], 0)
+        self.assertLess(stream.read_bytes, 5 * 10000)
+
+    def test_stops_at_num_posts(self):
+        # given
+        stream = CountingStream(rss(50, 10000))
+
+        # when
+        feeds = stream_parse(stream, num_posts=2, chunk_size=1024)
+
+        # then
+        self.assertEqual([entry["id"] for entry in feeds["entries"]], ["post0", "post1"])
+        self.assertLess(stream.read_bytes, 4 * 10000)
+
+    def test_max_bytes(self):
+        # given
+        stream = CountingStream(rss(50, 10000))
+
+        # when
+        feeds = stream_parse(stream, max_bytes=25000, chunk_size=1024)
+
+        # then
+        self.assertEqual([entry["id"] for entry in feeds["entries"]], ["post0", "post1"])
+        self.assertEqual(feeds["bozo"], 1)
+        self.assertEqual(stream.read_bytes, 25000)
+
+    def test_malformed(self):
+        # given
+        data = b"<rss><channel><item><title>a & b</title></item></channel></rss>"
+
+        # when
+        with self.assertRaises(StreamParseError) as e:
+            stream_parse(io.BytesIO(data))
+
+        # then
+        self.assertEqual(e.exception.data, data)
+
+    def test_fast_parse(self):
+        for data in (rss(3), ATOM.encode("utf-8"), RDF.encode("utf-8"), RDF_DC_DATE.encode("utf-8"),
+                     ATOM_UPDATED.encode("utf-8")):
+            feeds = fast_parse(data)
+            self.assert_same_as_feedparser(data, feeds["entries"])
+            self.assertEqual(feeds["bozo"], 0)
+
+    def test_fast_parse_updated(self):
+        # when
+        entries = fast_parse(RDF_DC_DATE.encode("utf-8"))["entries"] + \
+            fast_parse(ATOM_UPDATED.encode("utf-8"))["entries"]
+
+        # then - the entries without the published date are dated by the updated one
+        self.assertEqual([to_record(entry).timestamp for entry in entries],
+                         [1500527415, 1500433815, 1500527415, 1500354615])
+
+    def test_fast_parse_malformed(self):
+        with self.assertRaises(ParseError):
+            fast_parse(b"<rss><channel><item><title>a & b</title></item></channel></rss>")
+
+
+if __name__ == "__main__":
+    unittest.main(TestFeedParser)
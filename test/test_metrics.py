@@ -0,0 +1,98 @@
+import json
+import os
+import socket
+import unittest
+
+from feed_config import METRICS
+from metrics import RunReport, emit
+
+TMP_REPORT_FILE_PATH = "/tmp/twReport.json"
+TMP_PROMETHEUS_FILE_PATH = "/tmp/twReport.prom"
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 0.5
+        return self.now
+
+
+def report():
+    run = RunReport(Clock())
+    with run.stage("fetch"):
+        pass
+    with run.stage("fetch"):
+        pass
+    with run.stage("post"):
+        pass
+    run.incr("posts_posted", 2)
+    run.incr("bytes_downloaded", 1024, service="NET\"FLIX")
+    run.incr("posted", service="NET\"FLIX")
+    return run
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        for path in (TMP_REPORT_FILE_PATH, TMP_PROMETHEUS_FILE_PATH):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_report(self):
+        # when
+        data = report().to_dict()
+
+        # then
+        self.assertEqual(data["stages"], {"fetch": {"count": 2, "seconds": 1.0, "max": 0.5},
+                                          "post": {"count": 1, "seconds": 0.5, "max": 0.5}})
+        self.assertEqual(data["counters"], {"posts_posted": 2})
+        self.assertEqual(data["services"], {"NET\"FLIX": {"bytes_downloaded": 1024, "posted": 1}})
+
+    def test_prometheus(self):
+        # when
+        lines = report().to_prometheus("rss").splitlines()
+
+        # then
+        self.assertIn("# TYPE rss_stage_seconds gauge", lines)
+        self.assertIn('rss_stage_seconds{stage="fetch"} 1', lines)
+        self.assertIn('rss_stage_max_seconds{stage="post"} 0.5', lines)
+        self.assertIn('rss_stage_count{stage="fetch"} 2', lines)
+        self.assertIn('rss_posts_posted 2', lines)
+        self.assertIn('rss_service_bytes_downloaded{service="NET\\"FLIX"} 1024', lines)
+
+    def test_statsd(self):
+        # when
+        lines = report().to_statsd("rss")
+
+        # then
+        self.assertEqual(lines, ["rss.stage.fetch:1000|ms", "rss.stage.post:500|ms", "rss.posts_posted:2|c",
+                                 "rss.service.net_flix.bytes_downloaded:1024|c", "rss.service.net_flix.posted:1|c"])
+
+    def test_emit(self):
+        # given
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.settimeout(5)
+
+        # when
+        emit(report(), METRICS(TMP_REPORT_FILE_PATH, TMP_PROMETHEUS_FILE_PATH, "127.0.0.1", sock.getsockname()[1],
+                               "rss"))
+
+        # then
+        try:
+            self.assertEqual(sock.recv(4096).decode("utf-8").splitlines()[0], "rss.stage.fetch:1000|ms")
+        finally:
+            sock.close()
+        with open(TMP_REPORT_FILE_PATH) as f:
+            self.assertEqual(json.load(f)["counters"], {"posts_posted": 2})
+        with open(TMP_PROMETHEUS_FILE_PATH) as f:
+            self.assertIn('rss_posts_posted 2', f.read())
+
+    def test_emit_never_fails(self):
+        # when - the directory does not exist
+        emit(report(), METRICS("/tmp/not/existing/report.json", None, None, 8125, "rss"))
+
+
+if __name__ == "__main__":
+    unittest.main(TestMetrics)
@@ -1,11 +1,17 @@
+import calendar
+import time
 import unittest
 import mock
 import os
 import feed_config
 
-from process_rss import process, cleanup_feeds
-from feed_config import SERVICE, TWITTER, AWS_STORAGE, MAIN, DB
-from data_store import STORE
+from process_rss import process, process_services, cleanup_feeds, parse_options
+from feed_config import SERVICE, TWITTER, AWS_STORAGE, MAIN, DB, FETCH, SHARD, CURSOR_TIMESTAMP, POLICY_DATE, \
+    POLICY_FAIR, POLICY_ORDER
+from data_store import STORE, FileBasedDataStore
+from feed_fetch import FEED_REQUEST
+from feed_parser import to_record
+from metrics import RunReport
 from collections import namedtuple
 
 TMP_STORE_FILE_PATH = "/tmp/twStore"
@@ -18,11 +24,11 @@ class TestProcess(unittest.TestCase):
         if os.path.exists(TMP_STORE_FILE_PATH):
             os.remove(TMP_STORE_FILE_PATH)
 
-    @mock.patch("process_rss.parse")
+    @mock.patch("process_rss.FeedFetcher")
     @mock.patch("process_rss.TwitterPost")
     @mock.patch("process_rss.Config")
     @mock.patch("process_rss.FileBasedDataStore")
-    def test_process(self, data_store, mock_config, mock_post, mock_parser):
+    def test_process(self, data_store, mock_config, mock_post, mock_fetcher):
         service1 = SERVICE("service1", "test1url", 5)
         service2 = SERVICE("service2", "test2url", 1)
 
@@ -30,72 +36,482 @@ class TestProcess(unittest.TestCase):
         aws = AWS_STORAGE("awsKey", "awsSecret", "awsBucket", "awsFile")
         twitter = TWITTER("test1AppKey", "test1AppSecret", "test1UserKey", "test1UserSecret")
         db = DB("postgres://test", None)
+        fetch = FETCH(4, 2, 10)
 
         # when
-        mock_config.return_value.globalConfig.side_effect = [main, twitter, aws, db]
+        mock_config.return_value.globalConfig.side_effect = {"MAIN": main, "TWITTER": twitter, "AWS": aws, "DB": db,
+                                                             "FETCH": fetch}.get
         mock_config.return_value.mainService.return_value.max_posts = 5
         mock_config.return_value.services.return_value = ["service1", "service2"]
+        mock_config.return_value.urls.return_value = {"test1url": ["SERVICE1"], "test2url": ["SERVICE2"]}
         mock_config.return_value.__getitem__.side_effect = (service1, service2)
         mock_config.return_value.globalConfig.return_value = twitter
 
         timeTuple = namedtuple("TimeTuple", "tm_year tm_mon tm_mday tm_hour tm_min tm_sec")
-        mock_parser.return_value = {
+        feed = {
             "status": 200,
             "entries": [
-                {
+                to_record({
                     "id": "postA",
                     "title": "post 2 title",
                     "published_parsed": timeTuple(2017, 7, 20, 5, 10, 15),
                     "link": "httpd://test2.com"
-                },
-                {
+                }),
+                to_record({
                     "id": "postB",
                     "title": "post 1 title",
                     "published_parsed": timeTuple(2017, 5, 15, 20, 36, 55),
                     "link": "httpd://test1.com"
-                }]
+                })]
         }
+        mock_fetcher.return_value.fetch_iter.return_value = iter([feed, feed])
+        data_store.return_value.__getitem__.return_value = None
 
+        mock_post.return_value.available.return_value = None
+        mock_post.return_value.pending.return_value = []
         mock_post.return_value.post.return_value = {
-            (service1, "postA", 1500527415): True,
-            (service1, "postB", 1494880615): True,
-            (service2, "postA", 1500527415): False
+            ("service1", "postA", 1500527415): True,
+            ("service1", "postB", 1494880615): True,
+            ("service2", "postA", 1500527415): False
         }
+        data_store.return_value.write_store.return_value = 2
+        data_store.return_value.skipped = 0
 
-        process(False, False, "file1", "file2")
+        with mock.patch("process_rss.emit") as mock_emit:
+            process(False, False, "file1", "file2")
 
         # then
         # test config open is called
-        mock_config.assert_called_once_with('file1', 'file2')
+        mock_config.assert_called_once_with('file1', 'file2', parser=None)
         # test creating twitter post
-        mock_post.assert_called_once_with(twitter, False)
+        mock_post.assert_called_once_with(twitter, False, outbox=data_store.return_value)
+        # the posts left in the outbox are retried first
+        mock_post.return_value.restore.assert_called_once_with(["service1", "service2"])
 
         # test get is called
 
         self.assertEqual(mock_config.return_value.__getitem__.call_args_list,
                          [mock.call("service1"), mock.call("service2")])
-        # test parse is called to get feed
-        self.assertEqual(mock_parser.call_args_list, [mock.call("test1url"), mock.call("test2url")])
-        # test post is called
+        # test all the feeds are fetched at once
+        mock_fetcher.assert_called_once_with(fetch, mock.ANY)
+        mock_fetcher.return_value.fetch_iter.assert_called_once_with([FEED_REQUEST("test1url", numPosts=5),
+                                                                     FEED_REQUEST("test2url", numPosts=1)])
+        # test post is called - the newest posts first
         self.assertEqual(mock_post.return_value.prepare.call_args_list,
                          [
-                             mock.call((service1, "postB", 1494880615.0), 'post 1 title', 'httpd://test1.com'),
-                             mock.call((service1, "postA", 1500527415.0), 'post 2 title', 'httpd://test2.com'),
-                             mock.call((service2, "postA", 1500527415.0), 'post 2 title', 'httpd://test2.com')])
+                             mock.call(("service1", "postA", 1500527415), 'post 2 title', 'httpd://test2.com'),
+                             mock.call(("service2", "postA", 1500527415), 'post 2 title', 'httpd://test2.com'),
+                             mock.call(("service1", "postB", 1494880615), 'post 1 title', 'httpd://test1.com')])
         mock_post.return_value.post.assert_called_once_with()
-        # test store is called to save data
-        self.assertEqual(
-            len(data_store.return_value.__setitem__.call_args_list), 2)
-        self.assertTrue(
-            mock.call('service1', STORE('service1', 'postA', 1500527415)) in
-            data_store.return_value.__setitem__.call_args_list
-        )
-        self.assertTrue(
-            mock.call('service2', STORE('service2', 'postA', 1500527415)) in
-            data_store.return_value.__setitem__.call_args_list
-        )
+        # test store is called to save data - the failed post of service2 waits in the outbox, the cursor stays
+        self.assertEqual(data_store.return_value.__setitem__.call_args_list,
+                         [mock.call('service1', STORE('service1', 'postA', 1500527415, seen=('postB', 'postA')))])
         # test write is called
         data_store.return_value.write_store.assert_called_once_with([])
+        # test the run report is emitted
+        report = mock_emit.call_args[0][0].to_dict()
+        self.assertEqual(report["counters"], {"posts_prepared": 3, "posts_posted": 2, "posts_failed": 1,
+                                              "records_written": 2, "records_skipped": 0})
+        self.assertEqual(report["services"]["service1"], {"bytes_downloaded": 0, "posted": 2})
+        self.assertEqual(report["services"]["service2"], {"bytes_downloaded": 0, "failed": 1})
+        self.assertEqual(sorted(report["stages"].keys()),
+                         ["cleanup_feeds", "config", "post", "prepare", "store_read", "write_store"])
+        self.assertEqual(report["stages"]["prepare"]["count"], 3)
+
+    @mock.patch("process_rss.FeedFetcher")
+    @mock.patch("process_rss.TwitterPost")
+    @mock.patch("process_rss.Config")
+    @mock.patch("process_rss.FileBasedDataStore")
+    def test_process_conditional_get(self, data_store, mock_config, mock_post, mock_fetcher):
+        service1 = SERVICE("service1", "test1url", 5)
+        service2 = SERVICE("service2", "test2url", 5)
+        store1 = STORE("service1", "postA", 1500527415, '"etag1"', "Thu, 20 Jul 2017 05:10:15 GMT")
+        store2 = STORE("service2", "postA", 1500527415, '"etag2"', None)
+
+        mock_config.return_value.globalConfig.side_effect = {
+            "MAIN": MAIN(10, TMP_STORE_FILE_PATH), "TWITTER": TWITTER("key", "secret", "userKey", "userSecret"),
+            "AWS": AWS_STORAGE("awsKey", "awsSecret", "awsBucket", "awsFile"), "DB": DB("postgres://test", None),
+            "FETCH": FETCH(4, 2, 10)}.get
+        mock_config.return_value.services.return_value = ["service1", "service2"]
+        mock_config.return_value.urls.return_value = {"test1url": ["SERVICE1"], "test2url": ["SERVICE2"]}
+        mock_config.return_value.__getitem__.side_effect = (service1, service2)
+        data_store.return_value.__getitem__.side_effect = lambda service: {"service1": store1,
+                                                                           "service2": store2}[service]
+
+        # when - the first feed did not change and the second one has nothing new
+        mock_fetcher.return_value.fetch_iter.return_value = iter([
+            {"status": 304, "entries": [], "etag": '"etag1"', "modified": "Thu, 20 Jul 2017 05:10:15 GMT"},
+            {"status": 200, "entries": [to_record({"id": "postA"})], "etag": '"etag3"', "modified": None}])
+        mock_post.return_value.post.return_value = {}
+        mock_post.return_value.available.return_value = None
+        mock_post.return_value.pending.return_value = []
+
+        process(False, False, "file1")
+
+        # then
+        mock_fetcher.return_value.fetch_iter.assert_called_once_with([
+            FEED_REQUEST("test1url", '"etag1"', "Thu, 20 Jul 2017 05:10:15 GMT", "postA", 5),
+            FEED_REQUEST("test2url", '"etag2"', None, "postA", 5)])
+        mock_post.return_value.prepare.assert_not_called()
+        self.assertEqual(data_store.return_value.__setitem__.call_args_list,
+                         [mock.call("service2", STORE("service2", "postA", 1500527415, '"etag3"', None))])
+
+    @mock.patch("process_rss.FeedFetcher")
+    @mock.patch("process_rss.TwitterPost")
+    @mock.patch("process_rss.Config")
+    @mock.patch("process_rss.FileBasedDataStore")
+    def test_process_rate_limited(self, data_store, mock_config, mock_post, mock_fetcher):
+        service1 = SERVICE("service1", "test1url", 5)
+        service2 = SERVICE("service2", "test2url", 5)
+
+        mock_config.return_value.globalConfig.side_effect = {
+            "MAIN": MAIN(10, TMP_STORE_FILE_PATH, 50, POLICY_ORDER),
+            "TWITTER": TWITTER("key", "secret", "userKey", "userSecret"),
+            "AWS": AWS_STORAGE("awsKey", "awsSecret", "awsBucket", "awsFile"), "DB": DB("postgres://test", None),
+            "FETCH": FETCH(4, 2, 10)}.get
+        mock_config.return_value.services.return_value = ["service1", "service2"]
+        mock_config.return_value.urls.return_value = {"test1url": ["SERVICE1"], "test2url": ["SERVICE2"]}
+        mock_config.return_value.__getitem__.side_effect = (service1, service2)
+        data_store.return_value.__getitem__.return_value = None
+        mock_fetcher.return_value.fetch_iter.return_value = iter([
+            {"status": 200, "entries": [to_record({"id": "postC", "published_parsed": time.gmtime(3)}),
+                                        to_record({"id": "postB", "published_parsed": time.gmtime(2)}),
+                                        to_record({"id": "postA", "published_parsed": time.gmtime(1)})],
+             "etag": '"etag1"'},
+            {"status": 200, "entries": [to_record({"id": "postD", "published_parsed": time.gmtime(4)})],
+             "etag": '"etag2"'}])
+        mock_post.return_value.prepare.return_value = True
+
+        # when - the rate limit allows 2 posts only and the second one got rejected
+        mock_post.return_value.available.return_value = 2
+        mock_post.return_value.post.return_value = {("service1", "postA", 1): True}
+        mock_post.return_value.pending.return_value = [("service1", "postB", 2)]
+
+        process(False, False, "file1")
+
+        # then - the store does not move past the held back post and the feed is fetched again next time
+        self.assertEqual(len(mock_post.return_value.prepare.call_args_list), 2)
+        self.assertEqual(data_store.return_value.__setitem__.call_args_list,
+                         [mock.call("service1", STORE("service1", "postA", 1, seen=("postA",)))])
+
+    @mock.patch("process_rss.FeedFetcher")
+    @mock.patch("process_rss.TwitterPost")
+    @mock.patch("process_rss.Config")
+    @mock.patch("process_rss.FileBasedDataStore")
+    def test_process_shared_url(self, data_store, mock_config, mock_post, mock_fetcher):
+        service1 = SERVICE("service1", "sharedurl", 5)
+        service2 = SERVICE("service2", "sharedurl", 2)
+        store1 = STORE("service1", "postA", 1, '"etag"')
+        store2 = STORE("service2", "postB", 2, '"etag"')
+
+        mock_config.return_value.globalConfig.side_effect = {
+            "MAIN": MAIN(10, TMP_STORE_FILE_PATH), "TWITTER": TWITTER("key", "secret", "userKey", "userSecret"),
+            "FETCH": FETCH(4, 2, 10)}.get
+        mock_config.return_value.services.return_value = ["service1", "service2"]
+        mock_config.return_value.urls.return_value = {"sharedurl": ["SERVICE1", "SERVICE2"]}
+        mock_config.return_value.__getitem__.side_effect = (service1, service2)
+        data_store.return_value.__getitem__.side_effect = lambda service: {"service1": store1,
+                                                                           "service2": store2}[service]
+        mock_fetcher.return_value.fetch_iter.return_value = iter([
+            {"status": 200, "entries": [to_record({"id": "postC"}), to_record({"id": "postB"}),
+                                        to_record({"id": "postA"})], "etag": '"etag2"'}])
+        mock_post.return_value.available.return_value = None
+        mock_post.return_value.pending.return_value = []
+        mock_post.return_value.post.return_value = {}
+        mock_post.return_value.prepare.return_value = True
+
+        # when
+        process(False, False, "file1")
+
+        # then - the feed is fetched once and each section takes its own new posts from it, newest first
+        self.assertEqual(mock_fetcher.return_value.fetch_iter.call_args,
+                         mock.call([FEED_REQUEST("sharedurl", '"etag"', None, None, 5)]))
+        self.assertEqual([(call[0][0][0], call[0][0][1]) for call in
+                          mock_post.return_value.prepare.call_args_list],
+                         [("service1", "postC"), ("service1", "postB"), ("service2", "postC")])
+
+    @mock.patch("process_rss.ServiceLeases")
+    @mock.patch("process_rss.process_services")
+    @mock.patch("process_rss.TwitterPost")
+    @mock.patch("process_rss.Config")
+    @mock.patch("process_rss.DBBasedDataStore")
+    def test_process_sharded(self, data_store, mock_config, mock_post, mock_process, mock_leases):
+        # given
+        db = DB("postgres://test", None)
+        mock_config.return_value.globalConfig.side_effect = {"DB": db, "SHARD": SHARD(2, 60, "worker1")}.get
+        mock_config.return_value.services.return_value = ["service1", "service2", "service3"]
+        mock_leases.return_value.claim.return_value = ["SERVICE2"]
+        mock_process.return_value = (["result"], {})
+
+        # when
+        self.assertEqual(process(False, "db", "file1"), ["result"])
+
+        # then - only the claimed services are processed, the leases are released in the end
+        mock_leases.assert_called_once_with(db, 60, "worker1", False)
+        mock_leases.return_value.claim.assert_called_once_with(["service1", "service2", "service3"], 2)
+        mock_leases.return_value.start_heartbeat.assert_called_once_with()
+        self.assertEqual(mock_process.call_args[0][3], ["SERVICE2"])
+        mock_leases.return_value.release.assert_called_once_with()
+
+        # when - the processing failed
+        mock_process.side_effect = RuntimeError("failed")
+        self.assertRaises(RuntimeError, process, False, "db", "file1")
+
+        # then - the leases are released for the other workers
+        self.assertEqual(mock_leases.return_value.release.call_count, 2)
+
+        # when - all the services are leased by the other workers
+        mock_leases.return_value.claim.return_value = []
+        self.assertEqual(process(False, "db", "file1"), [])
+
+        # then
+        self.assertEqual(data_store.call_count, 2)
+        self.assertEqual(mock_process.call_count, 2)
+
+        # when - sharding needs the shared db store
+        self.assertRaises(SystemError, process, False, "local", "file1")
+
+    @mock.patch("process_rss.FeedFetcher")
+    def test_process_services_policies(self, mock_fetcher):
+        # given - the feeds list the posts newest first
+        services = {"A": SERVICE("A", "urlA", None), "B": SERVICE("B", "urlB", None), "C": SERVICE("C", "urlC", None)}
+        feeds = {"urlA": [300, 200, 100], "urlB": [250, 150], "urlC": [50]}
+        config = mock.MagicMock()
+        config.services.return_value = ["A", "B", "C"]
+        config.__getitem__.side_effect = lambda service: services[service]
+        config.urls.return_value = {"urlA": ["A"], "urlB": ["B"], "urlC": ["C"]}
+        store = mock.MagicMock()
+        store.__getitem__.return_value = None
+        store.write_store.return_value = 0
+        tp = mock.MagicMock()
+        tp.available.return_value = None
+        tp.post.return_value = {}
+        tp.pending.return_value = []
+        tp.prepare.return_value = True
+
+        def feed(feed_request):
+            name = feed_request.url[-1]
+            return {"status": 200, "etag": name, "entries": [to_record({"id": "%s%i" % (name, stamp),
+                                                                          "published_parsed": time.gmtime(stamp)})
+                                                               for stamp in feeds[feed_request.url]]}
+
+        fetched = []
+
+        def fetch_iter(feed_requests):
+            for feed_request in feed_requests:
+                fetched.append(feed_request.url)
+                yield feed(feed_request)
+
+        mock_fetcher.return_value.fetch_iter.side_effect = fetch_iter
+
+        def run(policy, budget=4):
+            tp.prepare.reset_mock()
+            del fetched[:]
+            report = RunReport()
+            config.globalConfig.side_effect = {"MAIN": MAIN(budget, TMP_STORE_FILE_PATH, 50, policy),
+                                               "FETCH": FETCH(4, 2, 10)}.get
+            (data, all_feeds) = process_services(config, store, tp, report=report)
+            return [call[0][0][1] for call in tp.prepare.call_args_list], all_feeds, report
+
+        # when - the newest pending posts of all the services go first
+        (prepared, all_feeds, report) = run(POLICY_DATE)
+
+        # then
+        self.assertEqual(prepared, ["A300", "B250", "A200", "B150"])
+        self.assertEqual(sorted(all_feeds.keys()), ["A", "B", "C"])
+
+        # when - round robin
+        (prepared, all_feeds, report) = run(POLICY_FAIR)
+
+        # then
+        self.assertEqual(prepared, ["A100", "B150", "C50", "A200"])
+
+        # when - the first round uses up the budget
+        (prepared, all_feeds, report) = run(POLICY_FAIR, 2)
+
+        # then - the last feed is not fetched
+        self.assertEqual(prepared, ["A100", "B150"])
+        self.assertEqual(fetched, ["urlA", "urlB"])
+
+        # when - config order
+        (prepared, all_feeds, report) = run(POLICY_ORDER)
+
+        # then - the last feed is not fetched once the budget is used up
+        self.assertEqual(prepared, ["A100", "A200", "A300", "B150"])
+        self.assertEqual(fetched, ["urlA", "urlB"])
+        self.assertEqual(sorted(all_feeds.keys()), ["A", "B"])
+        self.assertEqual(report.counters["services_not_reached"], 1)
+
+        # when - the rate limit window is used up
+        mock_fetcher.reset_mock()
+        tp.available.return_value = 0
+        (prepared, all_feeds, report) = run(POLICY_DATE)
+
+        # then - nothing is fetched
+        self.assertEqual(prepared, [])
+        self.assertEqual(all_feeds, {})
+        mock_fetcher.return_value.fetch_iter.assert_not_called()
+        self.assertEqual(report.counters["feeds_skipped"], 3)
+
+    @mock.patch("process_rss.FeedFetcher")
+    def test_process_services_date_policy_cursor(self, mock_fetcher):
+        # given - the budget takes the newest post only
+        config = mock.MagicMock()
+        config.services.return_value = ["service1"]
+        config.__getitem__.return_value = SERVICE("service1", "url1", 5)
+        config.urls.return_value = {"url1": ["SERVICE1"]}
+        config.globalConfig.side_effect = {"MAIN": MAIN(1, TMP_STORE_FILE_PATH), "FETCH": FETCH(4, 2, 10)}.get
+        store = FileBasedDataStore(MAIN(10, TMP_STORE_FILE_PATH))
+        store["service1"] = STORE("service1", "postA", 100)
+        entries = [to_record({"id": "post%s" % name, "published_parsed": time.gmtime(stamp)})
+                   for name, stamp in (("C", 300), ("B", 200), ("A", 100))]
+        mock_fetcher.return_value.fetch_iter.side_effect = lambda feed_requests: iter([{"status": 200,
+                                                                                       "entries": entries}])
+        tp = mock.MagicMock()
+        tp.available.return_value = None
+        tp.pending.return_value = []
+        tp.prepare.return_value = True
+        tp.post.side_effect = lambda: dict((call[0][0], True) for call in tp.prepare.call_args_list)
+
+        # when
+        process_services(config, store, tp)
+
+        # then - the cursor does not move past the older post left for the next run
+        self.assertEqual([call[0][0] for call in tp.prepare.call_args_list], [("service1", "postC", 300)])
+        self.assertEqual(store["service1"], STORE("service1", "postA", 100, seen=("postC",)))
+
+        # when
+        tp.prepare.reset_mock()
+        process_services(config, store, tp)
+
+        # then - the post published already is not taken again
+        self.assertEqual([call[0][0] for call in tp.prepare.call_args_list], [("service1", "postB", 200)])
+        self.assertEqual(store["service1"], STORE("service1", "postB", 200, seen=("postC", "postB")))
+
+    @mock.patch("process_rss.FeedFetcher")
+    def test_process_services_outbox(self, mock_fetcher):
+        # given - the post failed on the earlier run waits in the outbox and shows up in the feed again
+        config = mock.MagicMock()
+        config.services.return_value = ["service1"]
+        config.__getitem__.return_value = SERVICE("service1", "url1", 5)
+        config.urls.return_value = {"url1": ["SERVICE1"]}
+        config.globalConfig.side_effect = {"MAIN": MAIN(10, TMP_STORE_FILE_PATH), "FETCH": FETCH(4, 2, 10)}.get
+        store = FileBasedDataStore(MAIN(10, TMP_STORE_FILE_PATH))
+        store["service1"] = STORE("service1", "postB", 200)
+        store.enqueue(("service1", "postA", 100), "post A")
+        store.enqueue(("service1", "postC", 300), "post C")
+        mock_fetcher.return_value.fetch_iter.return_value = iter([
+            {"status": 200, "entries": [to_record({"id": "postD", "published_parsed": time.gmtime(400)}),
+                                        to_record({"id": "postC", "published_parsed": time.gmtime(300)}),
+                                        to_record({"id": "postB", "published_parsed": time.gmtime(200)})]}])
+        tp = mock.MagicMock()
+        tp.available.return_value = None
+        tp.pending.return_value = []
+        tp.prepare.return_value = True
+
+        # the retried posts are confirmed, the new one failed
+        def post():
+            store.remove(("service1", "postA", 100))
+            store.remove(("service1", "postC", 300))
+            return {("service1", "postA", 100): True, ("service1", "postC", 300): True,
+                    ("service1", "postD", 400): False}
+
+        tp.post.side_effect = post
+
+        # when
+        process_services(config, store, tp)
+
+        # then - only the new post is prepared, the cursor moves to the newest confirmed post
+        self.assertEqual([call[0][0] for call in tp.prepare.call_args_list], [("service1", "postD", 400)])
+        self.assertEqual(store["service1"].lastProcessedId, "postC")
+        self.assertEqual(store["service1"].lastProcessedUpdateTimestamp, 300)
+        self.assertEqual(store["service1"].seen, ("postA", "postC"))
+
+    @mock.patch("process_rss.FeedFetcher")
+    def test_process_services_undated_posts(self, mock_fetcher):
+        # given - the timestamp cursor service lists a post without the date
+        config = mock.MagicMock()
+        config.services.return_value = ["service1"]
+        config.__getitem__.return_value = SERVICE("service1", "url1", 5, CURSOR_TIMESTAMP)
+        config.urls.return_value = {"url1": ["SERVICE1"]}
+        config.globalConfig.side_effect = {"MAIN": MAIN(10, TMP_STORE_FILE_PATH), "FETCH": FETCH(4, 2, 10)}.get
+        store = FileBasedDataStore(MAIN(10, TMP_STORE_FILE_PATH))
+        store["service1"] = STORE("service1", "postA", 100)
+        entries = [to_record({"id": "postU"}), to_record({"id": "postB", "published_parsed": time.gmtime(200)}),
+                   to_record({"id": "postA", "published_parsed": time.gmtime(100)})]
+        mock_fetcher.return_value.fetch_iter.side_effect = lambda feed_requests: iter([{"status": 200,
+                                                                                       "entries": entries}])
+        tp = mock.MagicMock()
+        tp.available.return_value = None
+        tp.pending.return_value = []
+        tp.prepare.return_value = True
+        tp.post.side_effect = lambda: dict((call[0][0], True) for call in tp.prepare.call_args_list)
+
+        # when
+        process_services(config, store, tp)
+
+        # then - the undated post is taken as the newest one, the cursor keeps the time given by the feed
+        self.assertEqual([call[0][0] for call in tp.prepare.call_args_list],
+                         [("service1", "postU", None), ("service1", "postB", 200)])
+        self.assertEqual(store["service1"].lastProcessedId, "postU")
+        self.assertEqual(store["service1"].lastProcessedUpdateTimestamp, 200)
+        self.assertEqual(store["service1"].seen, ("postB", "postU"))
+
+        # when - the post published later than the cursor but before the run shows up
+        entries.insert(1, to_record({"id": "postC", "published_parsed": time.gmtime(300)}))
+        tp.prepare.reset_mock()
+        process_services(config, store, tp)
+
+        # then
+        self.assertEqual([call[0][0] for call in tp.prepare.call_args_list], [("service1", "postC", 300)])
+        self.assertEqual(store["service1"].lastProcessedId, "postC")
+        self.assertEqual(store["service1"].lastProcessedUpdateTimestamp, 300)
+
+    @mock.patch("process_rss.FeedFetcher")
+    def test_process_services_body_hash(self, mock_fetcher):
+        # given - the host of service1 ignores the conditional GET, service2 has more posts than the budget
+        config = mock.MagicMock()
+        config.services.return_value = ["service1", "service2"]
+        services = {"service1": SERVICE("service1", "url1", 5), "service2": SERVICE("service2", "url2", 5)}
+        config.__getitem__.side_effect = lambda service: services[service]
+        config.urls.return_value = {"url1": ["SERVICE1"], "url2": ["SERVICE2"]}
+        config.globalConfig.side_effect = {"MAIN": MAIN(2, TMP_STORE_FILE_PATH), "FETCH": FETCH(4, 2, 10)}.get
+        store = FileBasedDataStore(MAIN(10, TMP_STORE_FILE_PATH))
+        store["service1"] = STORE("service1", "post1", 100, bodyHash="old1")
+        store["service2"] = STORE("service2", "post2", 100, bodyHash="old2")
+        mock_fetcher.return_value.fetch_iter.return_value = iter([
+            {"status": 200, "hash": "new1", "entries": [to_record({"id": "post6",
+                                                                   "published_parsed": time.gmtime(600)})]},
+            {"status": 200, "hash": "new2", "entries": [to_record({"id": "post%i" % stamp,
+                                                                   "published_parsed": time.gmtime(stamp)})
+                                                         for stamp in (500, 400, 300)]}])
+        tp = mock.MagicMock()
+        tp.available.return_value = None
+        tp.pending.return_value = []
+        tp.prepare.return_value = True
+        tp.post.side_effect = lambda: dict((call[0][0], True) for call in tp.prepare.call_args_list)
+
+        # when
+        process_services(config, store, tp)
+
+        # then - the hash of the feed handled in full moves forward, the one of the feed left behind does not
+        requests = mock_fetcher.return_value.fetch_iter.call_args[0][0]
+        self.assertEqual([feed_request.bodyHash for feed_request in requests], ["old1", "old2"])
+        self.assertEqual(store["service1"].bodyHash, "new1")
+        self.assertEqual(store["service2"].bodyHash, "old2")
+
+        # when - the same body comes back
+        tp.prepare.reset_mock()
+        mock_fetcher.return_value.fetch_iter.return_value = iter([
+            {"status": 200, "hash": "new1", "unchanged": True, "entries": []},
+            {"status": 200, "hash": "new2", "entries": []}])
+        report = RunReport()
+        process_services(config, store, tp, report=report)
+
+        # then - nothing is prepared for the unchanged feed
+        tp.prepare.assert_not_called()
+        self.assertEqual(report.services["service1"]["unchanged"], 1)
+        self.assertEqual(store["service1"].bodyHash, "new1")
 
     def test_cleanup_feeds(self):
         # given test case
@@ -124,16 +540,61 @@ class TestProcess(unittest.TestCase):
             test_case(STORE("t1", "test1", 1309458234), 5, data=[{"id": "test1"}, {"id": "test2"}], result=[]),
             test_case(STORE("t1", "test2", None), 5, data=[{"id": "test1"}, {"id": "test2"}], result=[{"id": "test1"}]),
             test_case(STORE("t1", "bla", None), 5, data=[{"id": "test1"}, {"id": "test2"}],
-                      result=[{"id": "test2"}, {"id": "test1"}])
+                      result=[{"id": "test2"}, {"id": "test1"}]),
+
+            # the last processed post is gone from the feed - the seen index still filters the published posts
+            test_case(STORE("t1", "bla", 1309458234, seen=("test2", "test3", "bla")), 5,
+                      data=[{"id": "test1"}, {"id": "test2"}, {"id": "test3"}], result=[{"id": "test1"}]),
+            test_case(STORE("t1", "test3", 1309458234, seen=("test1", "test3")), 5,
+                      data=[{"id": "test1"}, {"id": "test2"}, {"id": "test3"}, {"id": "test4"}],
+                      result=[{"id": "test2"}])
         ]
 
         for index, case in enumerate(test_cases):
             print(index, ' ', case)
 
             # when - test with None store
-            result = cleanup_feeds(case.store, case.numItems, case.data)
+            result = cleanup_feeds(case.store, case.numItems, [to_record(post) for post in case.data]
+                                   if case.data else case.data)
             # then
-            self.assertEqual(list(result), case.result)
+            self.assertEqual(list(result), [to_record(post) for post in case.result])
+
+    def test_cleanup_feeds_by_timestamp(self):
+        # given - posts are out of order, one is published at the same second as the stored post and one has no date
+        def post(post_id, day=None, hour=0):
+            return to_record({"id": post_id, "published_parsed": time.struct_time((2017, 7, day, hour, 0, 0, 0, 0, 0))
+                              if day else None})
+
+        entries = [post("p3", 3), post("p1", 1), post("p5", 5), post("p6"), post("p2", 2), post("p4", 4),
+                   post("p2b", 2)]
+        stamp = calendar.timegm((2017, 7, 2, 0, 0, 0))
+
+        # then
+        self.assertEqual(cleanup_feeds(None, 3, entries, CURSOR_TIMESTAMP),
+                         [post("p4", 4), post("p5", 5), post("p6")])
+        # the post earlier in the feed is the newer one when published at the same time
+        self.assertEqual(cleanup_feeds(None, None, entries, CURSOR_TIMESTAMP),
+                         [post("p1", 1), post("p2b", 2), post("p2", 2), post("p3", 3), post("p4", 4), post("p5", 5),
+                          post("p6")])
+        self.assertEqual(cleanup_feeds(STORE("t1", "p2", stamp), 10, entries, CURSOR_TIMESTAMP),
+                         [post("p2b", 2), post("p3", 3), post("p4", 4), post("p5", 5), post("p6")])
+        self.assertEqual(cleanup_feeds(STORE("t1", "p2", stamp, seen=("p2b", "p4", "p6")), 10, entries,
+                                       CURSOR_TIMESTAMP),
+                         [post("p3", 3), post("p5", 5)])
+        self.assertEqual(cleanup_feeds(STORE("t1", "p5", calendar.timegm((2017, 7, 5, 0, 0, 0)), seen=("p6",)), 10,
+                                       entries, CURSOR_TIMESTAMP), [])
+        self.assertEqual(cleanup_feeds(None, 5, [], CURSOR_TIMESTAMP), [])
+
+    def test_parse_options_parser(self):
+        with mock.patch.dict(os.environ, {}):
+            # when
+            options = parse_options(["-d", "-t", "sqlite", "-p", "fast", "config.cfg"])
+
+            # then - the option is returned, the env of the process is not changed
+            self.assertEqual(options[:2], (True, "sqlite"))
+            self.assertEqual(options[3:], (feed_config.PARSER_FAST, ["config.cfg"]))
+            self.assertNotIn(feed_config.FETCH_PARSER_ENV, os.environ)
+            self.assertIsNone(parse_options(["config.cfg"])[3])
 
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
 import logging
+import os
+import threading
 
 import mock
 import unittest
 import twitter_post
 
-from feed_config import TWITTER
+from feed_config import TWITTER, MAIN
+from data_store import FileBasedDataStore
+
+TMP_STORE_FILE_PATH = "/tmp/twOutboxStore"
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -64,8 +69,8 @@ class TestTwitterPost(unittest.TestCase):
 
         # then
         mock_oauth2.Consumer.assert_called_once_with('key', 'secret')
-        self.assertEqual(mock_oauth2.Token.call_args_list, [
-            mock.call("userKey", "userSecret"), mock.call("userKey", "userSecret")])
+        # the clients and their connections are kept between the posts
+        mock_oauth2.Token.assert_called_once_with("userKey", "userSecret")
         self.assertEqual(mock_oauth2.Client.return_value.request.call_args_list, [
             mock.call("https://api.twitter.com/1.1/statuses/update.json?status=tweet+1", method="POST"),
             mock.call("https://api.twitter.com/1.1/statuses/update.json?status=tweet+2", method="POST")])
@@ -126,7 +131,7 @@ class TestTwitterPost(unittest.TestCase):
         # then
         mock_oauth2.Consumer.assert_called_once_with('key', 'secret')
         mock_oauth2.Token.assert_called_once_with("userKey", "userSecret")
-        self.assertEqual(mock_oauth2.Client.return_value.request.call_args_list, [
+        self.assertCountEqual(mock_oauth2.Client.return_value.request.call_args_list, [
             mock.call("https://api.twitter.com/1.1/statuses/update.json?status=tweet+this+please", method="POST"),
             mock.call("https://api.twitter.com/1.1/statuses/update.json?status=tweet+that+please", method="POST"),
             mock.call("https://api.twitter.com/1.1/statuses/update.json?status=tweet+one+more+please", method="POST")])
@@ -153,13 +158,197 @@ class TestTwitterPost(unittest.TestCase):
         # then
         mock_oauth2.Consumer.assert_called_once_with('key', 'secret')
         mock_oauth2.Token.assert_called_once_with("userKey", "userSecret")
-        self.assertEqual(mock_oauth2.Client.return_value.request.call_args_list, [
+        self.assertCountEqual(mock_oauth2.Client.return_value.request.call_args_list, [
             mock.call("https://api.twitter.com/1.1/statuses/update.json?status=tweet+this+please", method="POST"),
             mock.call("https://api.twitter.com/1.1/statuses/update.json?status=tweet+that+please", method="POST"),
             mock.call("https://api.twitter.com/1.1/statuses/update.json?status=tweet+one+more+please", method="POST")])
 
         self.assertEqual(results, {"1": True, "2": False, "3": True})
 
+    @mock.patch("twitter_post.oauth2")
+    def test_slow_post_does_not_block(self, mock_oauth2):
+        # given - the first post is answered only after the second one was sent
+        second_sent = threading.Event()
+
+        def effect(*args, **kwargs):
+            if args[0].endswith("status=tweet+1"):
+                return ({"status": "200"} if second_sent.wait(5) else {"status": "500"}), {}
+            second_sent.set()
+            return {"status": "200"}, {}
+
+        mock_oauth2.Client.return_value.request.side_effect = effect
+
+        # when
+        post = twitter_post.TwitterPost(TWITTER("key", "secret", "userKey", "userSecret", 2))
+        post.prepare("1", "tweet 1")
+        post.prepare("2", "tweet 2")
+        results = post.post()
+
+        # then
+        self.assertEqual(results, {"1": True, "2": True})
+        self.assertLessEqual(mock_oauth2.Client.call_count, 2)
+
+    @mock.patch("twitter_post.oauth2")
+    def test_request_error(self, mock_oauth2):
+        # given
+        mock_oauth2.Client.return_value.request.side_effect = OSError("connection reset")
+
+        # when
+        post = twitter_post.TwitterPost(TWITTER("key", "secret", "userKey", "userSecret"))
+        post.prepare("1", "tweet 1")
+        results = post.post()
+
+        # then
+        self.assertEqual(results, {"1": False})
+
+    @mock.patch("twitter_post.oauth2")
+    def test_rate_limit(self, mock_oauth2):
+        # given - one request left in the window but it is taken by someone else
+        now = [1000]
+        responses = [
+            {"status": "200", "x-rate-limit-limit": "300", "x-rate-limit-remaining": "1",
+             "x-rate-limit-reset": "1900"},
+            {"status": "429", "x-rate-limit-limit": "300", "x-rate-limit-remaining": "0",
+             "x-rate-limit-reset": "1900"},
+            {"status": "200", "x-rate-limit-limit": "300", "x-rate-limit-remaining": "299",
+             "x-rate-limit-reset": "2800"},
+            {"status": "200", "x-rate-limit-limit": "300", "x-rate-limit-remaining": "298",
+             "x-rate-limit-reset": "2800"}]
+        mock_oauth2.Client.return_value.request.side_effect = lambda *args, **kwargs: (responses.pop(0), {})
+
+        post = twitter_post.TwitterPost(TWITTER("key", "secret", "userKey", "userSecret", 1), False,
+                                        twitter_post.RateLimitBucket(lambda: now[0]))
+        self.assertIsNone(post.available())
+
+        # when
+        post.prepare("1", "tweet 1")
+        post.prepare("2", "tweet 2")
+        post.prepare("3", "tweet 3")
+        results = post.post()
+
+        # then - the rejected post and the post over budget are held back, the last one is not even sent
+        self.assertEqual(results, {"1": True})
+        self.assertEqual(post.pending(), ["2", "3"])
+        self.assertEqual(mock_oauth2.Client.return_value.request.call_count, 2)
+        self.assertEqual(post.rate_limit(), twitter_post.RATE_LIMIT(300, 0, 1900))
+        self.assertEqual(post.available(), 0)
+        self.assertFalse(post.prepare("2", "tweet 2"))
+
+        # when - still in the same window
+        self.assertEqual(post.post(), {})
+        self.assertEqual(mock_oauth2.Client.return_value.request.call_count, 2)
+
+        # when - the window is reset
+        now[0] = 1900
+        results = post.post()
+
+        # then
+        self.assertEqual(results, {"2": True, "3": True})
+        self.assertEqual(post.pending(), [])
+        self.assertEqual(post.rate_limit(), twitter_post.RATE_LIMIT(300, 298, 2800))
+
+    @mock.patch("twitter_post.oauth2")
+    def test_outbox(self, mock_oauth2):
+        # given
+        if os.path.exists(TMP_STORE_FILE_PATH):
+            os.remove(TMP_STORE_FILE_PATH)
+        now = [1000]
+        store = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+        responses = [{"status": "500"}, {"status": "200"}, {"status": "500"}, {"status": "500"}]
+        mock_oauth2.Client.return_value.request.side_effect = lambda *args, **kwargs: (responses.pop(0), {})
+        config = TWITTER("key", "secret", "userKey", "userSecret", 1, 3, 60)
+        post = twitter_post.TwitterPost(config, outbox=store, clock=lambda: now[0])
+
+        # when - the post fails
+        post.prepare(("T1", "1", 100), "tweet 1")
+        post.prepare(("T1", "2", 200), "tweet 2")
+        results = post.post()
+
+        # then - the failed post waits in the outbox, the confirmed one leaves it
+        self.assertEqual(results, {("T1", "1", 100): False, ("T1", "2", 200): True})
+        self.assertEqual([(key, outbox.attempts, outbox.nextAttempt) for key, outbox in store.outbox()],
+                         [(("T1", "1", 100), 1, 1060)])
+        self.assertEqual(store["T1"].seen, ("2",))
+
+        # when - the outbox is written and read back by the next run
+        store.write_store()
+        store = FileBasedDataStore(MAIN(15, TMP_STORE_FILE_PATH))
+        post = twitter_post.TwitterPost(config, outbox=store, clock=lambda: now[0])
+
+        # then - not due yet
+        self.assertEqual(post.restore(), 0)
+
+        # when - due, failed again
+        now[0] = 1060
+        self.assertEqual(post.restore(["t1"]), 1)
+        self.assertEqual(post.post(), {("T1", "1", 100): False})
+
+        # then - the delay doubles
+        self.assertEqual([(outbox.attempts, outbox.nextAttempt) for key, outbox in store.outbox()], [(2, 1180)])
+
+        # when - the last attempt failed too
+        now[0] = 1180
+        post.restore()
+        post.post()
+
+        # then - given up on, the post is not taken from the feed again
+        self.assertEqual(store.outbox(), [])
+        self.assertEqual(store["T1"].seen, ("2", "1"))
+        os.remove(TMP_STORE_FILE_PATH)
+
+    def test_rate_limit_bucket(self):
+        # given
+        now = [1000]
+        bucket = twitter_post.RateLimitBucket(lambda: now[0])
+
+        # then - not limited until the budget is known
+        self.assertTrue(bucket.acquire())
+        self.assertEqual(bucket.state(), twitter_post.RATE_LIMIT(None, None, None))
+
+        # when - the responses of the parallel requests came back out of order
+        bucket.update({"status": "200", "x-rate-limit-limit": "3", "x-rate-limit-remaining": "1",
+                       "x-rate-limit-reset": "1100"})
+        bucket.update({"status": "200", "x-rate-limit-limit": "3", "x-rate-limit-remaining": "2",
+                       "x-rate-limit-reset": "1100"})
+
+        # then
+        self.assertTrue(bucket.acquire())
+        self.assertFalse(bucket.acquire())
+
+        # when - window reset
+        now[0] = 1100
+
+        # then
+        self.assertEqual(bucket.state(), twitter_post.RATE_LIMIT(3, 3, None))
+        self.assertTrue(bucket.acquire())
+
+    def test_rate_limit_bucket_429_without_headers(self):
+        # given
+        now = [1000]
+        bucket = twitter_post.RateLimitBucket(lambda: now[0])
+
+        # when
+        bucket.update({"status": "429"})
+
+        # then - limited until the end of the default window
+        self.assertEqual(bucket.state(), twitter_post.RATE_LIMIT(None, 0, 1000 + twitter_post.RATE_LIMIT_WINDOW))
+        self.assertFalse(bucket.acquire())
+
+        # when - window reset
+        now[0] = 1000 + twitter_post.RATE_LIMIT_WINDOW
+
+        # then
+        self.assertTrue(bucket.acquire())
+
+        # when - retry-after shortens the window
+        bucket.update({"status": "429", "x-rate-limit-limit": "3", "retry-after": "60"})
+
+        # then
+        self.assertFalse(bucket.acquire())
+        now[0] += 60
+        self.assertEqual(bucket.state(), twitter_post.RATE_LIMIT(3, 3, None))
+        self.assertTrue(bucket.acquire())
+
     @mock.patch("twitter_post.oauth2")
     def test_dry_run(self, mock_oauth2):
         # when
@@ -167,10 +356,10 @@ class TestTwitterPost(unittest.TestCase):
         post.prepare("1", "tweet this please")
         result = post.post()
 
-        # then
-        mock_oauth2.Consumer.assert_called_once_with('key', 'secret')
-        mock_oauth2.Token.assert_called_once_with("userKey", "userSecret")
-        mock_oauth2.Client.request.assert_not_called()
+        # then - nothing is sent so the oauth credentials are not even created
+        mock_oauth2.Consumer.assert_not_called()
+        mock_oauth2.Token.assert_not_called()
+        mock_oauth2.Client.assert_not_called()
         self.assertEqual(result, {"1": True})
 
 